@@ -20,7 +20,7 @@ if os.getenv("BILILIVENOTIBOT_DEBUG") != None:
     print("======> Debug flag is set <======")
     special_flag = True
 
-MY_LOGGERS = ["TinyApplication", "BilibiliLiveNotificationBot", "LiveRoom", "RoomRecord"]
+MY_LOGGERS = ["TinyApplication", "BilibiliLiveNotificationBot", "LiveRoom", "RoomRecord", "TinyHTTPServer", "StateStore", "MessageDispatcher", "CircuitBreaker", "PollScheduler", "WebhookServer", "FileIdCache", "LoopWatchdog", "RecordingTransport"]
 
 for name in MY_LOGGERS:
     logger = logging.getLogger(name)
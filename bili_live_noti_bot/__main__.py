@@ -1,6 +1,10 @@
 from .fetchconfig import *
 from .bilibililivenotificationbot import BilibiliLiveNotificationBot
+from .webhook import WebhookServer
+from .httpserver import TinyHTTPServer
 from asyncio import gather, run
+from secrets import token_urlsafe
+from urllib.parse import urlsplit
 import os
 
 """
@@ -10,21 +14,56 @@ import os
 async def main():
 
     token = getTGBotToken()
-    chat_id = getTGChatID()
+    chat_ids = getTGChatIDs()
     timezone = getTimezone()
     interval = getPollInterval()
     sub_lst = getSubscribedRooms()
+    chunk_size = getFetchChunkSize()
+    fetch_concurrency = getFetchConcurrency()
+    state_file = getStateFile()
+    keyframe_prefetch_interval = getKeyFramePrefetchInterval()
+    digest_window = getDigestWindow()
+    webhook_url = getWebhookURL()
+    record_dir = getRecordDir()
+    metrics_listen = getMetricsListen()
+    loop_profile_threshold = getLoopProfileThreshold()
+    json_decoder = getJsonDecoder()
+    webhook_secret = ""
+    if webhook_url != "":
+        # 沒有指定secret時每次啟動隨機生成，反正每次啟動都會重新setWebhook
+        webhook_secret = getWebhookSecret() or token_urlsafe(32)
 
-    bilibot = BilibiliLiveNotificationBot(token, chat_id, timezone, interval)
+    bilibot = BilibiliLiveNotificationBot(token, chat_ids, timezone, interval,
+                                            fetch_chunk_size=chunk_size, fetch_concurrency=fetch_concurrency,
+                                            state_file=state_file, webhook_url=webhook_url, webhook_secret=webhook_secret,
+                                            keyframe_prefetch_interval=keyframe_prefetch_interval, digest_window=digest_window,
+                                            record_dir=record_dir, loop_profile_threshold=loop_profile_threshold,
+                                            json_decoder=json_decoder)
+
+    if webhook_url != "":
+        host, port = getWebhookListen()
+        webhook_server = WebhookServer(host, port)
+        webhook_server.addApplication(bilibot.app, urlsplit(webhook_url).path or "/")
+        await webhook_server.start()
+
+    # metrics單獨監聽，不和webhook一起暴露到公網
+    if metrics_listen != None:
+        metrics_server = TinyHTTPServer(*metrics_listen)
+        metrics_server.addRoute("/metrics", bilibot.metrics.handleRequest)
+        await metrics_server.start()
+
+    # 先恢復持久化的狀態，再添加配置中的訂閱
+    await bilibot.restoreState()
 
     if os.getenv("BILILIVENOTIBOT_TEST") != None:
-        bilibot.poll_interval = 3
+        bilibot.setPollInterval(3)
         await bilibot.subscribeRooms(["114"])
     else:
         await bilibot.subscribeRooms(sub_lst)
 
     print("Started")
-    await gather(bilibot.appStart(), bilibot.subscribeStart())
+    await gather(bilibot.appStart(), bilibot.subscribeStart(), bilibot.dispatchStart(), bilibot.keyframeStart(),
+                 bilibot.watchdogStart())
 
 if __name__ == "__main__":
     run(main())
\ No newline at end of file
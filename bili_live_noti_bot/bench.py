@@ -0,0 +1,1006 @@
+from __future__ import annotations
+from argparse import ArgumentParser
+from asyncio import run, gather, create_task, open_connection, sleep, wait_for, Event
+from time import perf_counter, process_time
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qs
+from telegram import Bot
+from telegram.request import HTTPXRequest
+import gzip
+import httpx
+import json
+import os
+import random
+import re
+import resource
+import tracemalloc
+import pytz
+
+from .liveroom import LiveRoom
+from .jsondecoder import DECODERS, extractRoomFields
+from .stubserver import StubBilibiliServer, StubTelegramServer
+from .fileidcache import FileIdCache
+from .dispatcher import MessageDispatcher
+from .roomrecord import RoomRecord, MAX_TITLE_HISTORY, utf16Length
+from .tinyapplication import TinyApplication, CommandHandler
+from .webhook import WebhookServer, SECRET_TOKEN_HEADER
+from .cassette import RecordingTransport, ReplayTransport, loadCassette, REDACTED
+from .metrics import Histogram
+from .watchdog import LoopWatchdog
+from .circuitbreaker import CircuitBreaker, CLOSED, OPEN
+
+"""
+    bench.py: 性能測試入口
+    `python -m bili_live_noti_bot.bench <subcommand>`，各subcommand見 `--help`
+"""
+
+async def benchFetch(sizes: list[int], chunk_size: int, concurrency: int, rounds: int, latency: float,
+                        error_rate: float, error_kind: str) -> None:
+
+    """
+        對本地stub server批量查詢直播間信息，測量不同訂閱數量下的吞吐量
+        同時核對LiveRoom統計的請求數和stub server實際收到的請求數，不一致時以1退出
+    """
+
+    print(f"chunk_size={chunk_size} concurrency={concurrency} latency={latency * 1000:.0f}ms rounds={rounds} error_rate={error_rate} ({error_kind})")
+    print(f"{'rooms':>8} {'requests':>9} {'failed':>7} {'cycle(ms)':>10} {'rooms/s':>10}")
+    for size in sizes:
+        stub = StubBilibiliServer(size, latency=latency, error_rate=error_rate, error_kind=error_kind)
+        await stub.start()
+        liveroom = LiveRoom(chunk_size=chunk_size, concurrency=concurrency, baseinfo_api=stub.baseinfo_api)
+        for room_id in range(1, size + 1):
+            liveroom.addRoom(str(room_id))
+
+        # warm up: 建立連接
+        await liveroom.fetchSnapshot()
+
+        failed = 0
+        requests = 0
+        received = stub.batch_requests
+        start = perf_counter()
+        for _ in range(rounds):
+            snapshot = await liveroom.fetchSnapshot()
+            failed += len(snapshot.errors)
+            requests += snapshot.batch_requests
+        elapsed = (perf_counter() - start) / rounds
+        received = stub.batch_requests - received
+
+        print(f"{size:>8} {requests // rounds:>9} {failed // rounds:>7} {elapsed * 1000:>10.1f} {size / elapsed:>10.0f}")
+        await liveroom.httpx_client.aclose()
+        await stub.stop()
+        # drop會在讀取請求後直接斷開，stub同樣計入
+        if requests != received:
+            print(f"batch requests counted by LiveRoom ({requests}) != received by the stub server ({received})")
+            raise SystemExit(1)
+
+async def benchBreaker(rooms: int, chunk_size: int, threshold: int, base_delay: float, jitter: float, opens: int,
+                        duration: float, latency: float) -> None:
+
+    """
+        bilibili api熔斷器的正確性：bot對返回503的stub server輪詢，核對熔斷器的狀態轉換，有不符合的以1退出
+        先逐輪調用pollOnce：連續threshold輪失敗後熔斷，熔斷期間不發出請求，到期後併發的兩輪中只有一輪作為探測，
+        探測失敗時熔斷時長按指數增長，stub恢復後探測成功即恢復
+        再運行完整的輪詢循環：熔斷後的duration秒內循環照常進行，訂閱不被阻塞，stub恢復後直播間重新被查詢
+    """
+
+    # 避免循環import
+    from .bilibililivenotificationbot import BilibiliLiveNotificationBot
+
+    # 多一個直播間用於在故障期間訂閱
+    bilibili = StubBilibiliServer(rooms + 1, live_ratio=0, latency=latency, error_rate=1)
+    telegram = StubTelegramServer()
+    await bilibili.start()
+    await telegram.start()
+
+    bot = BilibiliLiveNotificationBot("1:bench", ["114514"], "Asia/Shanghai", 3, fetch_chunk_size=chunk_size)
+    bot.tg_bot = Bot("1:bench", base_url=telegram.base_url)
+    bot.dispatcher.bot = bot.tg_bot
+    bot.liveroom = LiveRoom(chunk_size=chunk_size, baseinfo_api=bilibili.baseinfo_api, keyframe_api=bilibili.keyframe_api)
+    breaker = CircuitBreaker("Bilibili API", threshold, base_delay, base_delay * 2 ** opens, jitter)
+    bot.bilibili_breaker = breaker
+    await bot.subscribeRooms([str(room_id) for room_id in range(1, rooms + 1)])
+
+    print(f"rooms={rooms} chunk_size={chunk_size} threshold={threshold} base_delay={base_delay:g}s jitter={jitter} opens={opens} duration={duration:g}s")
+    failures = []
+    def check(condition: bool, text: str) -> None:
+        print(f"{'ok' if condition else 'FAIL'}: {text}")
+        if not condition:
+            failures.append(text)
+
+    # 連續threshold輪失敗後熔斷
+    per_cycle = -(-rooms // chunk_size)
+    for cycle in range(1, threshold + 1):
+        requests = bilibili.batch_requests
+        await bot.pollOnce()
+        expected = OPEN if cycle == threshold else CLOSED
+        check(bilibili.batch_requests - requests == per_cycle and breaker.state == expected,
+                f"failed cycle {cycle}: {bilibili.batch_requests - requests} requests, {breaker.state}")
+
+    # 熔斷時長按指數增長，每次探測只放行一輪
+    for index in range(opens):
+        delay = breaker.retryDelay()
+        upper = base_delay * 2 ** index
+        check(upper * (1 - jitter) - 0.05 <= delay <= upper, f"open {index + 1}: {delay:.3f}s in [{upper * (1 - jitter):.3f}, {upper:.3f}]")
+
+        requests = bilibili.batch_requests
+        begin = perf_counter()
+        await bot.pollOnce()
+        check(bilibili.batch_requests == requests and perf_counter() - begin < 0.1 and not bot.config_lock.locked(),
+                f"open {index + 1}: cycle skipped without requests in {(perf_counter() - begin) * 1000:.1f}ms")
+
+        await sleep(breaker.retryDelay())
+        if index == opens - 1:
+            bilibili.error_rate = 0
+        requests = bilibili.batch_requests
+        await gather(bot.pollOnce(), bot.pollOnce())
+        expected = CLOSED if index == opens - 1 else OPEN
+        check(bilibili.batch_requests - requests == per_cycle and breaker.state == expected,
+                f"probe {index + 1}: {bilibili.batch_requests - requests} requests from 2 concurrent cycles, {breaker.state}")
+    check(all(record.is_living != None for record in bot.room_records.values()), "all rooms polled after recovery")
+
+    # 完整的輪詢循環：熔斷期間照常運行，恢復後繼續查詢
+    bilibili.error_rate = 1
+    cycles = 0
+    poll_once = bot.pollOnce
+    async def countedPollOnce() -> None:
+        nonlocal cycles
+        cycles += 1
+        await poll_once()
+    bot.pollOnce = countedPollOnce
+    total_opens = breaker.total_opens
+    tasks = [create_task(bot.dispatchStart()), create_task(bot.subscribeStart())]
+
+    # 直播間按各自的間隔到期，最遲在最長的間隔之後連續失敗threshold輪
+    start = perf_counter()
+    deadline = start + max(bot.scheduler.getTierIntervals().values()) + bot.scheduler.tickInterval() * (threshold + 1)
+    while breaker.state == CLOSED and perf_counter() < deadline:
+        await sleep(0.05)
+    check(breaker.state != CLOSED, f"circuit opened in the poll loop after {perf_counter() - start:.1f}s")
+    begin = perf_counter()
+    try:
+        await wait_for(bot.subscribeRooms([str(rooms + 1)]), 1)
+    except TimeoutError:
+        pass
+    check(bot.room_records.get(str(rooms + 1)) != None, f"subscribe during outage took {(perf_counter() - begin) * 1000:.1f}ms")
+
+    counted = cycles
+    await sleep(duration)
+    # 允許最後一輪還在等待deadline
+    expected = int(duration / bot.scheduler.tickInterval()) - 1
+    check(cycles - counted >= expected and not any(task.done() for task in tasks),
+            f"{cycles - counted} cycles in {duration:g}s while the circuit is tripping (expected >= {expected}), {breaker.total_opens - total_opens} opens")
+
+    bilibili.error_rate = 0
+    deadline = perf_counter() + base_delay * 2 ** opens + bot.scheduler.tickInterval() * 3
+    record = bot.room_records.get(str(rooms + 1), RoomRecord(str(rooms + 1)))
+    while (breaker.state != CLOSED or record.is_living == None) and perf_counter() < deadline:
+        await sleep(0.05)
+    check(breaker.state == CLOSED and record.is_living != None, f"recovered in the poll loop, {breaker.state}")
+
+    for task in tasks:
+        task.cancel()
+    await gather(*tasks, return_exceptions=True)
+    await bot.tg_bot.shutdown()
+    await bot.liveroom.httpx_client.aclose()
+    await telegram.stop()
+    await bilibili.stop()
+
+    print(f"{len(failures)} checks failed")
+    if failures != []:
+        raise SystemExit(1)
+
+def generateUpdate(update_id: int, chat_id: int) -> dict:
+
+    """
+        生成一個 `/bench` 命令的Update JSON，格式和telegram推送的一致
+    """
+
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 0,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "bench"},
+            "text": "/bench",
+            "entities": [{"type": "bot_command", "offset": 0, "length": 6}]
+        }
+    }
+
+async def benchWebhook(updates: int, concurrency: int, bots: int, updates_file: str) -> None:
+
+    """
+        向本地WebhookServer POST Update JSON，測量從收到請求到command handler執行完的吞吐量
+        bots個TinyApplication共用一個server，按path區分
+    """
+
+    chat_id = 114514
+    if updates_file != "":
+        with open(updates_file, "r") as f:
+            recorded = [json.loads(line) for line in f if line.strip() != ""]
+    else:
+        recorded = [generateUpdate(i, chat_id) for i in range(updates)]
+    bodies = [json.dumps(recorded[i % len(recorded)]).encode() for i in range(updates)]
+
+    handled = 0
+    done = Event()
+    async def handleBench(update, caller, argument):
+        nonlocal handled
+        handled += 1
+        if handled == updates:
+            done.set()
+
+    server = WebhookServer("127.0.0.1", 0)
+    owner = SimpleNamespace(chat_ids=[str(chat_id)])
+    tasks = []
+    for i in range(bots):
+        app = TinyApplication(Bot(f"{i + 1}:bench"), owner, webhook_url=f"https://example.com/bot{i}", secret_token=f"secret{i}")
+        app.addCommandHandlers([CommandHandler("bench", "bench", handleBench)])
+        server.addApplication(app, f"/bot{i}")
+        tasks.append(create_task(app.processUpdates()))
+    await server.start()
+
+    # 客戶端直接用keep-alive的socket連接發送，避免測到的是HTTP client本身的開銷
+    async def postRequests(indices: range) -> list[float]:
+        reader, writer = await open_connection(server.server.host, server.server.port)
+        latencies = []
+        for i in indices:
+            bot = i % bots
+            head = (f"POST /bot{bot} HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n"
+                    f"{SECRET_TOKEN_HEADER}: secret{bot}\r\nContent-Length: {len(bodies[i])}\r\n\r\n")
+            begin = perf_counter()
+            writer.write(head.encode() + bodies[i])
+            response = await reader.readuntil(b"\r\n\r\n")
+            status = int(response.split(b" ", 2)[1])
+            length = int(response.lower().split(b"content-length:")[1].split(b"\r\n")[0])
+            await reader.readexactly(length)
+            latencies.append(perf_counter() - begin)
+            assert status == 200, status
+        writer.close()
+        return latencies
+
+    start = perf_counter()
+    results = await gather(*[postRequests(range(c, updates, concurrency)) for c in range(concurrency)])
+    await done.wait()
+    elapsed = perf_counter() - start
+    latencies = [latency for result in results for latency in result]
+
+    # 錯誤的secret token應該被拒絕
+    async with httpx.AsyncClient(base_url=server.server.url) as client:
+        response = await client.post("/bot0", content=bodies[0], headers={SECRET_TOKEN_HEADER: "wrong"})
+        assert response.status_code == 403
+
+    latencies.sort()
+    print(f"updates={updates} concurrency={concurrency} bots={bots}")
+    print(f"{elapsed:.2f}s, {updates / elapsed:.0f} updates/s, "
+          f"request p50={latencies[len(latencies) // 2] * 1000:.2f}ms p95={latencies[int(len(latencies) * 0.95)] * 1000:.2f}ms")
+    for task in tasks:
+        task.cancel()
+    await server.stop()
+
+async def benchFileId(sends: int, images: int, capacity: int, cdn_latency: float) -> None:
+
+    """
+        通過假的bot api發送圖片，比較直接發送url和通過FileIdCache發送的延遲
+        images張不同的圖片輪流發送，capacity小於images時可以看到LRU淘汰的影響
+    """
+
+    print(f"sends={sends} images={images} capacity={capacity} cdn_latency={cdn_latency * 1000:.0f}ms")
+    print(f"{'mode':>8} {'cdn':>6} {'mean(ms)':>9} {'p95(ms)':>8} {'total(s)':>9}")
+    for mode in ["url", "file_id"]:
+        stub = StubTelegramServer(cdn_latency=cdn_latency)
+        await stub.start()
+        bot = Bot("1:bench", base_url=stub.base_url)
+        cache = FileIdCache(capacity)
+        latencies = []
+        start = perf_counter()
+        for i in range(sends):
+            url = f"https://i0.hdslb.com/bfs/live-key-frame/bench{i % images}.jpg"
+            begin = perf_counter()
+            if mode == "url":
+                await bot.send_photo(114514, photo=url)
+            else:
+                await cache.sendPhoto(url, lambda photo: bot.send_photo(114514, photo=photo))
+            latencies.append(perf_counter() - begin)
+        elapsed = perf_counter() - start
+        latencies.sort()
+        print(f"{mode:>8} {stub.cdn_fetches:>6} {sum(latencies) / sends * 1000:>9.2f} {latencies[int(sends * 0.95)] * 1000:>8.2f} {elapsed:>9.2f}")
+        await bot.shutdown()
+        await stub.stop()
+
+class NullTelegramBot():
+    """
+        只計數的假telegram Bot，發送和編輯都立即成功
+    """
+
+    def __init__(self) -> None:
+        self.message_id: int = 0
+        self.calls: int = 0
+
+    async def send_message(self, chat_id, **kwargs):
+        self.calls += 1
+        self.message_id += 1
+        return SimpleNamespace(message_id=self.message_id)
+
+    async def edit_message_text(self, chat_id, message_id, **kwargs):
+        self.calls += 1
+        return True
+
+async def benchCycle(rooms: int, change_rate: float, rounds: int, chunk_size: int) -> None:
+
+    """
+        測量一輪輪詢（解析快照+狀態判斷）的CPU時間，比較是否按指紋跳過沒有變化的直播間
+        api響應由httpx.MockTransport在進程內生成，生成響應的CPU時間會被扣除
+    """
+
+    # 避免循環import
+    from .bilibililivenotificationbot import BilibiliLiveNotificationBot
+
+    print(f"rooms={rooms} change_rate={change_rate} rounds={rounds} chunk_size={chunk_size}")
+    print(f"{'fingerprint':>11} {'cpu(ms)':>8} {'wall(ms)':>9} {'parsed':>7} {'skipped':>8} {'tg calls':>9}")
+    for fingerprint in [False, True]:
+        stub = StubBilibiliServer(rooms)
+        stub_cpu = 0
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            nonlocal stub_cpu
+            begin = process_time()
+            by_room_ids = {room_id: stub.generateRoom(int(room_id)) for room_id in request.url.params.get_list("room_ids")}
+            content = json.dumps({"code": 0, "message": "0", "ttl": 1, "data": {"by_uids": {}, "by_room_ids": by_room_ids}}).encode()
+            stub_cpu += process_time() - begin
+            return httpx.Response(200, content=content)
+
+        bot = BilibiliLiveNotificationBot("1:bench", "114514", "Asia/Shanghai", 60, fetch_chunk_size=chunk_size)
+        bot.liveroom = LiveRoom(chunk_size=chunk_size, fingerprint=fingerprint)
+        bot.liveroom.httpx_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        null_bot = NullTelegramBot()
+        bot.dispatcher = MessageDispatcher(null_bot, global_rate=1e9, chat_rate=1e9, chat_burst=1e9, concurrency=64)
+        dispatcher_task = create_task(bot.dispatchStart())
+        await bot.subscribeRooms([str(room_id) for room_id in range(1, rooms + 1)])
+
+        async def cycle() -> tuple[float, float]:
+            nonlocal stub_cpu
+            for room_id in bot.scheduler.next_due.keys():
+                bot.scheduler.next_due[room_id] = 0
+            stub_cpu = 0
+            cpu_start, wall_start = process_time(), perf_counter()
+            await bot.pollOnce()
+            return (process_time() - cpu_start - stub_cpu, perf_counter() - wall_start)
+
+        # 第一輪會發出全部開播提醒，不計入
+        await cycle()
+        while bot.pending_starts != {}:
+            await sleep(0.01)
+
+        parse_count = bot.liveroom.parse_skipped
+        skipped = bot.unchanged_skipped
+        cpu_total, wall_total = 0, 0
+        for _ in range(rounds):
+            stub.mutateRooms(int(rooms * change_rate))
+            cpu, wall = await cycle()
+            cpu_total += cpu
+            wall_total += wall
+        parsed = rooms * rounds - (bot.liveroom.parse_skipped - parse_count)
+        print(f"{str(fingerprint):>11} {cpu_total / rounds * 1000:>8.1f} {wall_total / rounds * 1000:>9.1f} "
+              f"{parsed // rounds:>7} {(bot.unchanged_skipped - skipped) // rounds:>8} {null_bot.calls:>9}")
+        dispatcher_task.cancel()
+        await bot.liveroom.httpx_client.aclose()
+
+def benchRecords(count: int, rounds: int) -> None:
+
+    """
+        大量RoomRecord的內存佔用和更新速度
+        每輪每個記錄都按新標題嘗試更新一次，一半提交，另一半在下一輪開始時回滾
+    """
+
+    stub = StubBilibiliServer(count)
+    liveroom = LiveRoom()
+    infos = [liveroom.parseRoomInfo(str(room_id), extractRoomFields(stub.generateRoom(room_id))) for room_id in range(1, count + 1)]
+    stub.mutateRooms(count)
+    new_infos = [liveroom.parseRoomInfo(str(room_id), extractRoomFields(stub.generateRoom(room_id))) for room_id in range(1, count + 1)]
+
+    # 只統計記錄本身，api返回的字串不計入
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = []
+    for room_id, info in enumerate(infos, 1):
+        record = RoomRecord(str(room_id))
+        record.parseResult(info)
+        records.append(record)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    start = perf_counter()
+    for round in range(rounds):
+        round_infos = new_infos if round % 2 == 0 else infos
+        for i, record in enumerate(records):
+            record.restoreSnapshot()
+            fetched = RoomRecord(record.room_id)
+            fetched.parseResult(round_infos[i])
+            if record.hasUpdate(fetched):
+                record.tryUpdateRecord(fetched, update_title_history=True)
+                if i % 2 == 0:
+                    record.commitUpdateRecord()
+    elapsed = perf_counter() - start
+
+    print(f"records={count} rounds={rounds}")
+    print(f"{(after - before) / count:.0f} bytes/room, {count * rounds / elapsed:.0f} updates/s")
+
+def benchRender(count: int, rounds: int, edits: int) -> None:
+
+    """
+        生成消息的耗時：count個記錄的 `/list`，以及直播中的記錄改標題後重新生成開播提醒
+    """
+
+    stub = StubBilibiliServer(count)
+    liveroom = LiveRoom()
+    timezone = pytz.timezone("Asia/Shanghai")
+    records = []
+    for room_id in range(1, count + 1):
+        record = RoomRecord(str(room_id))
+        record.parseResult(liveroom.parseRoomInfo(str(room_id), extractRoomFields(stub.generateRoom(room_id))))
+        if room_id % 2 == 0:
+            record.liveEnd()
+            record.stop_time = record.start_time
+        records.append(record)
+
+    start = perf_counter()
+    for _ in range(rounds):
+        "\n".join(text for text in (record.generateInfoText(timezone) for record in records) if text != "")
+    list_elapsed = (perf_counter() - start) / rounds
+
+    # 直播中改標題，每次改標題後重新生成一次，和編輯已發送的消息一致
+    record = records[0]
+    record.is_living = True
+    fetched = RoomRecord(record.room_id)
+    fetched.parseResult(liveroom.parseRoomInfo(record.room_id, extractRoomFields(stub.generateRoom(1))))
+    start = perf_counter()
+    for i in range(edits):
+        fetched.current_room_title = f"{record.current_room_title[:20]} #{i}"
+        record.tryUpdateRecord(fetched, update_title_history=True)
+        record.commitUpdateRecord()
+        record.generateMessageText(timezone)
+    edit_elapsed = (perf_counter() - start) / edits
+
+    # 沒有變化時重新生成，比如合併提醒中其他直播間的段落發生變化
+    start = perf_counter()
+    for i in range(edits):
+        record.generateMessageText(timezone)
+    unchanged_elapsed = (perf_counter() - start) / edits
+
+    print(f"records={count} rounds={rounds} edits={edits}")
+    print(f"/list: {list_elapsed * 1000:.1f} ms for {count} records")
+    print(f"title change + render: {edit_elapsed * 1e6:.1f} us, unchanged render: {unchanged_elapsed * 1e6:.1f} us")
+
+# 隨機標題用到的字符：markdown需要轉義的字符、中文、UTF-16佔兩個單位的emoji
+TITLE_CHARS = "_*[]()~`>#+-=|{}.!\\ abc123直播間標題🎮🔴"
+
+def benchTruncate(cases: int, seed: int) -> None:
+
+    """
+        開播提醒按長度上限截斷的正確性：隨機的標題、歷史標題和被丟棄的標題數量下，
+        從最短可能的長度到不截斷的長度逐個嘗試上限，生成的消息都不能超過上限，有超過的以1退出
+    """
+
+    stub = StubBilibiliServer(1)
+    liveroom = LiveRoom()
+    timezone = pytz.timezone("Asia/Shanghai")
+    rng = random.Random(seed)
+    info = liveroom.parseRoomInfo("1", extractRoomFields(stub.generateRoom(1)))
+
+    def randomTitle() -> str:
+        return "".join(rng.choice(TITLE_CHARS) for _ in range(rng.randint(1, 40)))
+
+    checked = 0
+    failures = 0
+    start = perf_counter()
+    for _ in range(cases):
+        record = RoomRecord("1")
+        record.parseResult(info)
+        if rng.random() < 0.5:
+            record.liveEnd()
+            record.stop_time = record.start_time
+        record.current_room_title = randomTitle()
+        record.history_room_titles = tuple(randomTitle() for _ in range(rng.randint(0, MAX_TITLE_HISTORY)))
+        record.dropped_titles = rng.choice((0, 0, 1, 9, 99))
+
+        # 上限為0時得到最短可能的消息，比它更小的上限無法滿足
+        shortest = utf16Length(record.generateMessageText(timezone, 0))
+        full = utf16Length(record.generateMessageText(timezone))
+        for max_length in range(shortest, full + 1):
+            text = record.generateMessageText(timezone, max_length)
+            checked += 1
+            if utf16Length(text) > max_length:
+                failures += 1
+                if failures <= 5:
+                    print(f"max_length={max_length} got {utf16Length(text)}: {text!r}")
+    elapsed = perf_counter() - start
+
+    print(f"cases={cases} seed={seed}")
+    print(f"{checked} limits checked in {elapsed:.2f}s, {failures} over the limit")
+    if failures > 0:
+        raise SystemExit(1)
+
+def benchMetrics(count: int, observations: int) -> None:
+
+    """
+        記錄指標的開銷：Histogram.observe的耗時和內存分配，以及count個直播間時導出一次的耗時
+    """
+
+    # 避免循環import
+    from .bilibililivenotificationbot import BilibiliLiveNotificationBot
+
+    histogram = Histogram()
+    values = [(i % 1000) / 100 for i in range(1000)]
+    start = perf_counter()
+    for i in range(observations):
+        histogram.observe(values[i % 1000])
+    observe_elapsed = (perf_counter() - start) / observations
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(observations):
+        histogram.observe(values[i % 1000])
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    bot = BilibiliLiveNotificationBot("1:bench", ["114514"], "Asia/Shanghai", 60)
+    stub = StubBilibiliServer(count)
+    for room_id in range(1, count + 1):
+        record = RoomRecord(str(room_id))
+        record.parseResult(bot.liveroom.parseRoomInfo(str(room_id), extractRoomFields(stub.generateRoom(room_id))))
+        bot.room_records[record.room_id] = record
+    for i in range(observations // 10):
+        bot.cycle_duration.observe(values[i % 1000])
+        bot.dispatcher.request_latency["send"].observe(values[i % 1000] / 10)
+    start = perf_counter()
+    exported = bot.metrics.render()
+    render_elapsed = perf_counter() - start
+
+    print(f"observations={observations} rooms={count}")
+    print(f"observe: {observe_elapsed * 1e9:.0f} ns, {after - before} bytes retained after {observations} observations")
+    print(f"render: {render_elapsed * 1000:.2f} ms, {len(exported)} bytes")
+
+def blockWithJson(payload: str) -> None:
+    json.loads(payload)
+
+def blockWithRender(records: list[RoomRecord], timezone) -> None:
+    for record in records:
+        record.fragments = None
+        record.generateInfoText(timezone)
+
+async def benchWatchdog(stalls: int, stall_ms: float, threshold: float, work: int) -> None:
+
+    """
+        卡頓採樣的效果和開銷：
+        按固定間隔製造同步的卡頓（大的json.loads、重新生成大量記錄的 `/list` 文本），看watchdog能否定位
+        再比較採樣線程開啟前後，事件循環中大量小任務的吞吐量
+    """
+
+    stub = StubBilibiliServer(20000)
+    liveroom = LiveRoom()
+    timezone = pytz.timezone("Asia/Shanghai")
+    records = []
+    for room_id in range(1, 20001):
+        record = RoomRecord(str(room_id))
+        record.parseResult(liveroom.parseRoomInfo(str(room_id), extractRoomFields(stub.generateRoom(room_id))))
+        records.append(record)
+    rooms = {str(room_id): stub.generateRoom(room_id) for room_id in range(1, 20001)}
+    payload = json.dumps({"data": {"by_room_ids": rooms}})
+
+    # 按目標卡頓時長截取工作量
+    start = perf_counter()
+    blockWithJson(payload)
+    count = max(int(len(rooms) * stall_ms / 1000 / (perf_counter() - start)), 1)
+    json_payload = json.dumps({"data": {"by_room_ids": dict(list(rooms.items())[:count])}})
+    start = perf_counter()
+    blockWithRender(records, timezone)
+    render_records = records[:max(int(len(records) * stall_ms / 1000 / (perf_counter() - start)), 1)]
+
+    watchdog = LoopWatchdog(interval=0.05, profile_threshold=threshold)
+    task = create_task(watchdog.run())
+    for i in range(stalls):
+        await sleep(0.2)
+        if i % 2 == 0:
+            blockWithJson(json_payload)
+        else:
+            blockWithRender(render_records, timezone)
+    await sleep(0.2)
+    stats = watchdog.getStats()
+    print(f"stalls={stalls} stall_ms={stall_ms:g} threshold={threshold:g}s")
+    print(f"detected {stats['stalls']} stalls, lag p50 {stats['lag_p50']:.3f}s max {stats['lag_max']:.3f}s, "
+          f"worst {stats['worst_stall'][0]:.3f}s in {stats['worst_stall'][1]}")
+    for location, seconds in stats["offenders"]:
+        print(f"  {seconds:.2f}s  {location}")
+    task.cancel()
+    await gather(task, return_exceptions=True)
+
+    # 開銷：大量sleep(0)來回切換的吞吐量
+    async def spin() -> float:
+        start = perf_counter()
+        for _ in range(work):
+            await sleep(0)
+        return perf_counter() - start
+
+    baseline = await spin()
+    watchdog = LoopWatchdog(profile_threshold=threshold)
+    task = create_task(watchdog.run())
+    await sleep(0)
+    profiled = await spin()
+    task.cancel()
+    await gather(task, return_exceptions=True)
+    print(f"{work} loop iterations: {baseline * 1000:.0f}ms without watchdog, {profiled * 1000:.0f}ms with sampling thread "
+          f"({(profiled / baseline - 1) * 100:+.1f}%)")
+
+def benchDecode(rooms: int, rounds: int, live_ratio: float) -> None:
+
+    """
+        解析一個rooms個直播間的getRoomBaseInfo響應並取出用到的字段的耗時，比較已安裝的各個decoder
+        baseline是原來的做法：先把響應解碼成str，json.loads得到完整的dict，再逐個直播間取字段
+    """
+
+    stub = StubBilibiliServer(rooms, live_ratio=live_ratio)
+    by_room_ids = {str(room_id): stub.generateRoom(room_id) for room_id in range(1, rooms + 1)}
+    content = json.dumps({"code": 0, "message": "0", "ttl": 1, "data": {"by_uids": {}, "by_room_ids": by_room_ids}},
+                         ensure_ascii=False).encode()
+
+    def baseline(content: bytes) -> tuple:
+        document = json.loads(content.decode())
+        return (document["code"], document["message"], {room_id: extractRoomFields(info) for room_id, info in document["data"]["by_room_ids"].items()})
+
+    candidates = [("str + json", baseline)] + [(name, decoder().decodeBaseInfo) for name, decoder in DECODERS.items()]
+    expected = baseline(content)
+
+    print(f"rooms={rooms} rounds={rounds} payload={len(content) / 1024 / 1024:.2f}MiB")
+    print(f"{'decoder':>10} {'ms/decode':>10} {'MiB/s':>8} {'speedup':>8} {'peak alloc(MiB)':>16}")
+    baseline_elapsed = None
+    for name, decode in candidates:
+        if decode(content) != expected:
+            print(f"{name:>10} result differs from baseline")
+            continue
+        start = perf_counter()
+        for _ in range(rounds):
+            decode(content)
+        elapsed = (perf_counter() - start) / rounds
+        if baseline_elapsed == None:
+            baseline_elapsed = elapsed
+
+        tracemalloc.start()
+        decode(content)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f"{name:>10} {elapsed * 1000:>10.2f} {len(content) / 1024 / 1024 / elapsed:>8.0f} {baseline_elapsed / elapsed:>7.2f}x {peak / 1024 / 1024:>16.1f}")
+
+def percentile(values: list[float], q: float) -> float:
+    if values == []:
+        return 0
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+async def benchEndToEnd(rooms: int, live_ratio: float, duration: float, poll_interval: int, transition_rate: float, chunk_size: int,
+                        latency: float, tg_latency: float, error_rate: float, tg_error_rate: float, digest_window: float,
+                        record_dir: str) -> None:
+
+    """
+        完整的bot對本地的假bilibili api和假bot api運行，走真實的HTTP請求、json解析和消息發送
+        每秒按transition_rate切換直播間的開播狀態，統計輪詢耗時、從開播到開播提醒到達bot api的延遲、
+        兩邊的請求速率和進程的RSS
+        dispatcher保持默認的限速（每個chat每秒1條），開播提醒的延遲主要受它影響，可以用digest_window比較合併提醒的效果
+        record_dir不為空時錄製兩邊的流量，可以用 `replay` 回放
+    """
+
+    # 避免循環import
+    from .bilibililivenotificationbot import BilibiliLiveNotificationBot
+
+    bilibili = StubBilibiliServer(rooms, live_ratio=live_ratio, latency=latency, error_rate=error_rate)
+    telegram = StubTelegramServer(api_latency=tg_latency, error_rate=tg_error_rate)
+    await bilibili.start()
+    await telegram.start()
+
+    bot = BilibiliLiveNotificationBot("1:bench", ["114514"], "Asia/Shanghai", poll_interval,
+                                        fetch_chunk_size=chunk_size, digest_window=digest_window)
+    bilibili_transport = None
+    telegram_kwargs = None
+    if record_dir != "":
+        os.makedirs(record_dir, exist_ok=True)
+        bilibili_transport = RecordingTransport(os.path.join(record_dir, "bilibili.jsonl.gz"))
+        telegram_kwargs = {"transport": RecordingTransport(os.path.join(record_dir, "telegram.jsonl.gz"),
+                                                            httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=20)), redact=["1:bench"])}
+    bot.tg_bot = Bot("1:bench", base_url=telegram.base_url, request=HTTPXRequest(connection_pool_size=20, httpx_kwargs=telegram_kwargs))
+    bot.dispatcher.bot = bot.tg_bot
+    bot.liveroom = LiveRoom(chunk_size=chunk_size, baseinfo_api=bilibili.baseinfo_api, keyframe_api=bilibili.keyframe_api,
+                            transport=bilibili_transport)
+
+    # 輪詢耗時
+    cycle_times = []
+    poll_once = bot.pollOnce
+    async def timedPollOnce() -> None:
+        begin = perf_counter()
+        await poll_once()
+        cycle_times.append(perf_counter() - begin)
+    bot.pollOnce = timedPollOnce
+
+    # 開播時刻 -> 開播提醒到達bot api
+    started_at: dict[str, float] = {}
+    latencies = []
+    room_id_pattern = re.compile(r"live\.bilibili\.com/(\d+)")
+    def observe(method: str, params: dict) -> None:
+        if method != "sendMessage":
+            return
+        now = perf_counter()
+        for room_id in room_id_pattern.findall(params.get("text", "")):
+            begin = started_at.pop(room_id, None)
+            if begin != None:
+                latencies.append(now - begin)
+    telegram.observer = observe
+
+    await bot.subscribeRooms([str(room_id) for room_id in range(1, rooms + 1)])
+    tasks = [create_task(bot.dispatchStart()), create_task(bot.subscribeStart())]
+
+    # 預熱：等全部直播間都查詢過一次，並且初始的開播提醒都已發完
+    while any(record.is_living == None for record in bot.room_records.values()) \
+            or bot.pending_starts != {} or bot.dispatcher.getStats()["queue_depth"] > 0:
+        await sleep(0.1)
+    cycle_times.clear()
+    requests = (bilibili.batch_requests, sum(telegram.calls.values()), bilibili.rooms_served)
+    cpu_start = process_time()
+
+    print(f"rooms={rooms} live_ratio={live_ratio} duration={duration:g}s poll_interval={poll_interval}s transition_rate={transition_rate}/s chunk_size={chunk_size} "
+          f"latency={latency * 1000:.0f}ms tg_latency={tg_latency * 1000:.0f}ms error_rate={error_rate} tg_error_rate={tg_error_rate} digest_window={digest_window:g}s")
+    start = perf_counter()
+    transitions = 0
+    carry = 0.0
+    while perf_counter() - start < duration:
+        carry += rooms * transition_rate
+        count = int(carry)
+        carry -= count
+        for room_id, is_living in bilibili.transitionRooms(count).items():
+            transitions += 1
+            if is_living:
+                started_at[str(room_id)] = perf_counter()
+            else:
+                started_at.pop(str(room_id), None)
+        await sleep(1)
+    elapsed = perf_counter() - start
+    cpu = process_time() - cpu_start
+
+    # 等待還在路上的開播提醒，超過一個輪詢間隔仍未送達的算作丟失
+    deadline = perf_counter() + poll_interval * 2
+    while started_at != {} and perf_counter() < deadline:
+        await sleep(0.1)
+
+    for task in tasks:
+        task.cancel()
+    await gather(*tasks, return_exceptions=True)
+
+    stats = bot.dispatcher.getStats()
+    print(f"transitions: {transitions}, start notifications: {len(latencies)}, missing: {len(started_at)}")
+    print(f"cycle: {len(cycle_times)} cycles, mean {sum(cycle_times) / max(len(cycle_times), 1) * 1000:.1f}ms, "
+          f"p95 {percentile(cycle_times, 0.95) * 1000:.1f}ms, max {max(cycle_times, default=0) * 1000:.1f}ms")
+    print(f"notification latency: p50 {percentile(latencies, 0.5):.2f}s, p95 {percentile(latencies, 0.95):.2f}s, "
+          f"p99 {percentile(latencies, 0.99):.2f}s, max {max(latencies, default=0):.2f}s")
+    print(f"bilibili: {(bilibili.batch_requests - requests[0]) / elapsed:.1f} req/s "
+          f"({(bilibili.batch_requests - requests[0]) / elapsed * poll_interval:.1f} per poll_interval), "
+          f"{(bilibili.rooms_served - requests[2]) / elapsed:.1f} rooms/s, {bilibili.errors_injected} errors injected")
+    print(f"telegram: {(sum(telegram.calls.values()) - requests[1]) / elapsed:.1f} req/s, {telegram.errors_injected} errors injected, "
+          f"{stats['sent']} sent, {stats['failed']} failed, {stats['coalesced']} coalesced")
+    print(f"cpu: {cpu / elapsed * 100:.1f}%, max rss: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MiB")
+    render_start = perf_counter()
+    exported = bot.metrics.render()
+    print(f"metrics: {len(exported)} bytes rendered in {(perf_counter() - render_start) * 1000:.2f}ms, "
+          f"notification_lag p50 <= {bot.notification_lag.quantile(0.5):g}s, poll_cycle p95 <= {bot.cycle_duration.quantile(0.95):g}s")
+
+    await bot.tg_bot.shutdown()
+    await bot.liveroom.httpx_client.aclose()
+    await telegram.stop()
+    await bilibili.stop()
+
+async def benchReplay(cassette: str, telegram_cassette: str, speed: float, save: str, expect: str) -> None:
+
+    """
+        回放錄製的bilibili api流量：按錄製的順序逐個重放批量查詢，每個查詢都經過 `pollRooms`，不經過scheduler
+        每一步都等開播提醒和消息編輯處理完再繼續，所以直播間的狀態變化和回放速度無關，
+        可以保存下來，和之後的回放結果比較
+        telegram_cassette為空時bot api總是立即成功，否則按錄製的響應（包括錯誤）依次返回
+    """
+
+    # 避免循環import
+    from .bilibililivenotificationbot import BilibiliLiveNotificationBot
+
+    entries = loadCassette(cassette)
+    requests = [entry for entry in entries if urlsplit(entry["url"]).path.endswith("/getRoomBaseInfo")]
+    if requests == []:
+        print(f"no getRoomBaseInfo requests in {cassette}")
+        return
+    steps = [parse_qs(urlsplit(entry["url"]).query).get("room_ids", []) for entry in requests]
+    room_ids = list(dict.fromkeys(room_id for step in steps for room_id in step))
+
+    bot = BilibiliLiveNotificationBot("1:replay", ["114514"], "Asia/Shanghai", 60)
+    transport = ReplayTransport(entries, speed)
+    baseinfo_api = urlsplit(requests[0]["url"])._replace(query="").geturl()
+    bot.liveroom = LiveRoom(chunk_size=max(len(step) for step in steps), concurrency=1, baseinfo_api=baseinfo_api, transport=transport)
+    if telegram_cassette != "":
+        telegram_entries = loadCassette(telegram_cassette)
+        telegram_transport = ReplayTransport(telegram_entries, speed, redact=["1:replay"], cycle=True)
+        # 錄製的url中token已經被替換掉，base_url取它前面的部分
+        base_url = telegram_entries[0]["url"].split(REDACTED)[0] if telegram_entries != [] else "https://api.telegram.org/bot"
+        telegram_bot = Bot("1:replay", base_url=base_url, request=HTTPXRequest(httpx_kwargs={"transport": telegram_transport}))
+    else:
+        telegram_bot = NullTelegramBot()
+    bot.dispatcher = MessageDispatcher(telegram_bot, global_rate=1e9, chat_rate=1e9, chat_burst=1e9, concurrency=64)
+    dispatcher_task = create_task(bot.dispatchStart())
+    await bot.subscribeRooms(room_ids)
+
+    # 每一步中狀態發生變化的直播間：[步驟, room_id, 狀態]，結束時間取自本地時鐘，不計入
+    transitions = []
+    states = {}
+    start = perf_counter()
+    for i, (entry, step) in enumerate(zip(requests, steps)):
+        if speed > 0:
+            delay = (entry["t"] - requests[0]["t"]) / speed - (perf_counter() - start)
+            if delay > 0:
+                await sleep(delay)
+        await bot.pollRooms(step)
+        while bot.pending_starts != {} or len(bot.dispatcher.queue) > 0 or bot.dispatcher.inflight > 0:
+            await sleep(0)
+
+        for room_id in step:
+            record = bot.room_records.get(room_id)
+            state = None
+            if record != None:
+                state = [record.is_valid, record.is_living, record.current_room_title, record.area_name_pair,
+                         list(record.history_room_titles), record.dropped_titles,
+                         record.start_time.timestamp() if record.start_time != None else None, sorted(record.messages_sent)]
+            if states.get(room_id, []) != state:
+                states[room_id] = state
+                transitions.append([i, room_id, state])
+    elapsed = perf_counter() - start
+    dispatcher_task.cancel()
+
+    span = requests[-1]["t"] - requests[0]["t"]
+    processed = sum(len(step) for step in steps) - bot.unchanged_skipped
+    print(f"replayed {len(requests)} requests for {len(room_ids)} rooms, {transport.misses} without recorded response")
+    print(f"recorded span {span:.1f}s, replayed in {elapsed:.2f}s ({span / elapsed:.0f}x)")
+    print(f"updateRoomInformation: {processed} rooms ({processed / elapsed:.0f}/s), {bot.unchanged_skipped} skipped as unchanged")
+    print(f"state transitions: {len(transitions)}, telegram: {bot.dispatcher.sent} sent, {bot.dispatcher.failed} failed")
+
+    if save != "":
+        with gzip.open(save, "wt", encoding="utf-8") as file:
+            for transition in transitions:
+                file.write(json.dumps(transition, ensure_ascii=False) + "\n")
+        print(f"saved transitions to {save}")
+
+    if expect != "":
+        expected = loadCassette(expect)
+        for i, (got, want) in enumerate(zip(transitions, expected)):
+            if got != want:
+                print(f"transition {i} differs:\n  expected {want}\n  got      {got}")
+                raise SystemExit(1)
+        if len(transitions) != len(expected):
+            print(f"expected {len(expected)} transitions, got {len(transitions)}")
+            raise SystemExit(1)
+        print(f"transitions identical to {expect}")
+
+def main() -> None:
+    parser = ArgumentParser(prog="python -m bili_live_noti_bot.bench")
+    subparsers = parser.add_subparsers(dest="subcommand", required=True)
+
+    fetch = subparsers.add_parser("fetch", help="LiveRoom.fetchSnapshot 分塊批量查詢的吞吐量")
+    fetch.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    fetch.add_argument("--chunk-size", type=int, default=100)
+    fetch.add_argument("--concurrency", type=int, default=4)
+    fetch.add_argument("--rounds", type=int, default=5)
+    fetch.add_argument("--latency", type=float, default=0.05, help="stub server每個請求的延遲，單位：秒")
+    fetch.add_argument("--error-rate", type=float, default=0, help="stub server返回錯誤的概率")
+    fetch.add_argument("--error-kind", choices=["http", "code", "drop"], default="http")
+
+    breaker = subparsers.add_parser("breaker", help="bilibili api熔斷器的狀態轉換，對返回錯誤的stub server運行，不符合時以1退出")
+    breaker.add_argument("--rooms", type=int, default=100)
+    breaker.add_argument("--chunk-size", type=int, default=100)
+    breaker.add_argument("--threshold", type=int, default=3, help="熔斷前連續失敗的輪數")
+    breaker.add_argument("--base-delay", type=float, default=0.2, help="第一次熔斷的時長，單位：秒")
+    breaker.add_argument("--jitter", type=float, default=0.5)
+    breaker.add_argument("--opens", type=int, default=3, help="逐輪檢查的熔斷次數，最後一次探測時stub恢復")
+    breaker.add_argument("--duration", type=float, default=6, help="完整輪詢循環熔斷後繼續運行的時長，單位：秒")
+    breaker.add_argument("--latency", type=float, default=0.05, help="stub server每個請求的延遲，單位：秒")
+
+    webhook = subparsers.add_parser("webhook", help="WebhookServer 接收並處理update的吞吐量")
+    webhook.add_argument("--updates", type=int, default=10000)
+    webhook.add_argument("--concurrency", type=int, default=32, help="同時進行的POST請求數量")
+    webhook.add_argument("--bots", type=int, default=1, help="共用一個server的bot數量")
+    webhook.add_argument("--updates-file", default="", help="錄製的Update JSON，每行一個，不指定時生成 `/bench` 命令")
+
+    fileid = subparsers.add_parser("fileid", help="圖片用url發送和用緩存的file_id發送的延遲對比")
+    fileid.add_argument("--sends", type=int, default=500)
+    fileid.add_argument("--images", type=int, default=20, help="不同圖片的數量")
+    fileid.add_argument("--capacity", type=int, default=1024, help="FileIdCache的容量")
+    fileid.add_argument("--cdn-latency", type=float, default=0.2, help="假的bot api從cdn下載圖片的延遲，單位：秒")
+
+    cycle = subparsers.add_parser("cycle", help="一輪輪詢的CPU時間，比較按指紋跳過沒有變化的直播間的效果")
+    cycle.add_argument("--rooms", type=int, default=10000)
+    cycle.add_argument("--change-rate", type=float, default=0.01, help="每輪標題發生變化的直播間比例")
+    cycle.add_argument("--rounds", type=int, default=10)
+    cycle.add_argument("--chunk-size", type=int, default=100)
+
+    records = subparsers.add_parser("records", help="RoomRecord的內存佔用和更新速度")
+    records.add_argument("--count", type=int, default=100000)
+    records.add_argument("--rounds", type=int, default=10)
+
+    render = subparsers.add_parser("render", help="生成 `/list` 和開播提醒消息的耗時")
+    render.add_argument("--count", type=int, default=5000)
+    render.add_argument("--rounds", type=int, default=20)
+    render.add_argument("--edits", type=int, default=10000, help="直播中修改標題的次數")
+
+    truncate = subparsers.add_parser("truncate", help="開播提醒按長度上限截斷的正確性，隨機標題下逐個嘗試較小的上限")
+    truncate.add_argument("--cases", type=int, default=500)
+    truncate.add_argument("--seed", type=int, default=0)
+
+    metrics = subparsers.add_parser("metrics", help="記錄和導出指標的開銷")
+    metrics.add_argument("--count", type=int, default=10000, help="直播間數量，影響導出時的統計")
+    metrics.add_argument("--observations", type=int, default=1000000)
+
+    watchdog = subparsers.add_parser("watchdog", help="事件循環卡頓採樣的效果和開銷")
+    watchdog.add_argument("--stalls", type=int, default=10, help="製造的卡頓次數")
+    watchdog.add_argument("--stall-ms", type=float, default=300, help="每次卡頓的大約時長，單位：毫秒")
+    watchdog.add_argument("--threshold", type=float, default=0.1, help="採樣的閾值，單位：秒")
+    watchdog.add_argument("--work", type=int, default=500000, help="測量開銷時事件循環的切換次數")
+
+    decode = subparsers.add_parser("decode", help="各個json decoder解析批量查詢響應的耗時")
+    decode.add_argument("--rooms", type=int, default=10000)
+    decode.add_argument("--rounds", type=int, default=20)
+    decode.add_argument("--live-ratio", type=float, default=0.1)
+
+    e2e = subparsers.add_parser("e2e", help="完整的bot對本地的假bilibili api和假bot api運行")
+    e2e.add_argument("--rooms", type=int, default=2000)
+    e2e.add_argument("--live-ratio", type=float, default=0.01, help="一開始在直播的直播間比例")
+    e2e.add_argument("--duration", type=float, default=30, help="測量的時長，單位：秒")
+    e2e.add_argument("--poll-interval", type=int, default=6)
+    e2e.add_argument("--transition-rate", type=float, default=0.0002, help="每秒切換開播狀態的直播間比例")
+    e2e.add_argument("--chunk-size", type=int, default=100)
+    e2e.add_argument("--latency", type=float, default=0.05, help="假bilibili api每個請求的延遲，單位：秒")
+    e2e.add_argument("--tg-latency", type=float, default=0.05, help="假bot api每個請求的延遲，單位：秒")
+    e2e.add_argument("--error-rate", type=float, default=0, help="假bilibili api返回錯誤的概率")
+    e2e.add_argument("--tg-error-rate", type=float, default=0, help="假bot api返回502的概率")
+    e2e.add_argument("--digest-window", type=float, default=0)
+    e2e.add_argument("--record-dir", default="", help="錄製兩邊的流量到這個目錄")
+
+    replay = subparsers.add_parser("replay", help="回放錄製的bilibili api流量，比較直播間的狀態變化")
+    replay.add_argument("cassette", help="錄製的bilibili api流量，見 `record_dir` 配置")
+    replay.add_argument("--telegram", default="", help="錄製的bot api流量，不指定時bot api總是立即成功")
+    replay.add_argument("--speed", type=float, default=0, help="相對錄製時的速度倍數，為0時盡快回放")
+    replay.add_argument("--save", default="", help="把狀態變化保存到這個文件")
+    replay.add_argument("--expect", default="", help="和之前保存的狀態變化比較，不同時以1退出")
+
+    args = parser.parse_args()
+    if args.subcommand == "fetch":
+        run(benchFetch(args.sizes, args.chunk_size, args.concurrency, args.rounds, args.latency, args.error_rate, args.error_kind))
+    elif args.subcommand == "breaker":
+        run(benchBreaker(args.rooms, args.chunk_size, args.threshold, args.base_delay, args.jitter, args.opens,
+                            args.duration, args.latency))
+    elif args.subcommand == "webhook":
+        run(benchWebhook(args.updates, args.concurrency, args.bots, args.updates_file))
+    elif args.subcommand == "fileid":
+        run(benchFileId(args.sends, args.images, args.capacity, args.cdn_latency))
+    elif args.subcommand == "cycle":
+        run(benchCycle(args.rooms, args.change_rate, args.rounds, args.chunk_size))
+    elif args.subcommand == "records":
+        benchRecords(args.count, args.rounds)
+    elif args.subcommand == "render":
+        benchRender(args.count, args.rounds, args.edits)
+    elif args.subcommand == "truncate":
+        benchTruncate(args.cases, args.seed)
+    elif args.subcommand == "metrics":
+        benchMetrics(args.count, args.observations)
+    elif args.subcommand == "watchdog":
+        run(benchWatchdog(args.stalls, args.stall_ms, args.threshold, args.work))
+    elif args.subcommand == "decode":
+        benchDecode(args.rooms, args.rounds, args.live_ratio)
+    elif args.subcommand == "e2e":
+        run(benchEndToEnd(args.rooms, args.live_ratio, args.duration, args.poll_interval, args.transition_rate, args.chunk_size,
+                            args.latency, args.tg_latency, args.error_rate, args.tg_error_rate, args.digest_window,
+                            args.record_dir))
+    elif args.subcommand == "replay":
+        run(benchReplay(args.cassette, args.telegram, args.speed, args.save, args.expect))
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,18 @@ from __future__ import annotations
 from telegram import Bot, Message, LinkPreviewOptions, InlineKeyboardMarkup, InlineKeyboardButton
 import telegram.request
 import telegram.error
-from asyncio.locks import Lock
-from asyncio import sleep
+from asyncio.locks import Lock, Semaphore
+from asyncio import Event, Future, Task, TimeoutError, sleep, gather, create_task, wait_for
 from datetime import datetime
+from time import monotonic, time
 from pytz import timezone, utc
 from typing import NoReturn
+import httpx
 import logging
 import os
 import traceback
 
-from .liveroom import HTTPStatusError, NetworkError, CodeFieldException, RoomNotExistException
+from .liveroom import HTTPStatusError, NetworkError, CodeFieldException, RoomNotExistException, RoomInfoStaleException, RoomInfoSnapshot
 
 # test flag: use DummyLiveRoom to examine the functionality
 if os.getenv("BILILIVENOTIBOT_TEST") != None:
@@ -21,6 +23,18 @@ else:
 
 from .tinyapplication import TinyApplication, CommandHandler
 from .roomrecord import RoomRecord
+from .statestore import StateStore
+from .dispatcher import MessageDispatcher, PRIORITY_START, PRIORITY_EDIT
+from .circuitbreaker import CircuitBreaker, CLOSED
+from .scheduler import PollScheduler
+from .subscriptionindex import SubscriptionIndex
+from .roomlistindex import RoomListIndex
+from .keyframecache import KeyFrameCache
+from .fileidcache import FileIdCache
+from .digest import DigestMessage
+from .cassette import RecordingTransport
+from .metrics import MetricsRegistry, Histogram, LAG_BUCKETS
+from .watchdog import LoopWatchdog
 from .commandhandler import *
 from .util import isValidPositiveInt
 
@@ -38,34 +52,161 @@ class BilibiliLiveNotificationBot():
             很是懷疑Lock()有沒有用。
     """
 
-    def __init__(self, tg_bot_token: str, tg_chat_id: str, 
-                    timezone_str: str, poll_interval: str) -> None:
+    START_RETRY_ROUNDS = 3      # 開播提醒部分發送失敗時，對失敗的chat重試的輪數
+
+    def __init__(self, tg_bot_token: str, tg_chat_ids: list[str], 
+                    timezone_str: str, poll_interval: str, poll_concurrency: int=16,
+                    fetch_chunk_size: int=100, fetch_concurrency: int=4, state_file: str="",
+                    webhook_url: str="", webhook_secret: str="", keyframe_prefetch_interval: float=0,
+                    digest_window: float=0, record_dir: str="", loop_profile_threshold: float=0,
+                    json_decoder: str="auto") -> None:
+
+        # 錄製和bilibili api、telegram bot api之間的流量，用於回放，record_dir為空時不錄製
+        bilibili_transport = None
+        telegram_kwargs = None
+        if record_dir != "":
+            os.makedirs(record_dir, exist_ok=True)
+            started = datetime.now().strftime("%Y%m%d-%H%M%S")
+            bilibili_transport = RecordingTransport(os.path.join(record_dir, f"bilibili-{started}.jsonl.gz"))
+            # 自己提供transport時httpx不再使用client的limits，連接池大小要在transport上指定
+            telegram_kwargs = {"transport": RecordingTransport(os.path.join(record_dir, f"telegram-{started}.jsonl.gz"),
+                                                                httpx.AsyncHTTPTransport(limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)),
+                                                                redact=[tg_bot_token, webhook_secret])}
 
         # bot-related
+        # chat_ids中的chat都可以使用bot，第一個chat同時接收錯誤信息
         self.token: str = tg_bot_token
-        self.chat_id: str = tg_chat_id
+        if isinstance(tg_chat_ids, str):
+            tg_chat_ids = [tg_chat_ids]
+        self.chat_ids: list[str] = [str(chat_id) for chat_id in tg_chat_ids]
+        self.chat_id: str = self.chat_ids[0]
         self.tg_bot = Bot(tg_bot_token, 
-                            request=telegram.request.HTTPXRequest(connection_pool_size=20, read_timeout=30, write_timeout=30))
-        self.app = TinyApplication(self.tg_bot, self)
+                            request=telegram.request.HTTPXRequest(connection_pool_size=20, read_timeout=30, write_timeout=30,
+                                                                    httpx_kwargs=telegram_kwargs))
+        self.app = TinyApplication(self.tg_bot, self, webhook_url=webhook_url, secret_token=webhook_secret)
+        self.telegram_breaker = CircuitBreaker("Telegram")
+        self.dispatcher = MessageDispatcher(self.tg_bot, breaker=self.telegram_breaker)
 
         # subscribe configs
+        # 每個直播間只有一條記錄，不管有多少個chat訂閱
         self.room_records: dict[str, RoomRecord] = {}
-        self.liveroom: LiveRoom = LiveRoom()
+        self.subscriptions = SubscriptionIndex()
+        self.room_list = RoomListIndex()                    # /list 的顯示順序，記錄提交時更新
+        # room_id -> 已經處理並提交的快照指紋，指紋相同的直播間跳過解析和狀態判斷
+        self.fingerprints: dict[str, tuple] = {}
+        self.unchanged_skipped: int = 0
+        self.liveroom: LiveRoom = LiveRoom(chunk_size=fetch_chunk_size, concurrency=fetch_concurrency, transport=bilibili_transport,
+                                            decoder=json_decoder)
+        self.bilibili_breaker = CircuitBreaker("Bilibili API")
+        self.keyframe_cache = KeyFrameCache(self.fetchKeyFrameUrl)
+        self.keyframe_prefetch_interval: float = keyframe_prefetch_interval      # 為0時不預取
+        self.keyframe_prefetched: int = 0
+        self.file_id_cache = FileIdCache()
+
+        # 合併開播提醒：digest_window秒內的開播合併為一條消息，為0時逐個發送
+        self.digest_window: float = digest_window
+        self.digest_queue: list[RoomRecord] = []
+        self.digest_task: Task = None
+        self.digests: dict[tuple[str, int], DigestMessage] = {}     # (chat_id, message_id) -> 合併的提醒
+
+        # 持久化存儲，state_file為空時不啟用
+        self.state_store: StateStore = StateStore(state_file) if state_file != "" else None
+
+        # 正在發送開播提醒的直播間
+        self.pending_starts: dict[str, Task] = {}
 
         # locks
         self.config_lock = Lock()
         self.poll_interval: int = poll_interval
+        self.scheduler = PollScheduler(poll_interval)
+        self.poll_concurrency: int = poll_concurrency       # 一次輪詢中同時處理的直播間數量上限
+        self.last_cycle_time: float = 0                     # 上一次完整輪詢耗費的時間，單位：秒
+        self.last_cycle_lateness: float = 0                 # 上一輪實際開始的時間比deadline晚了多少，單位：秒
+        self.skipped_ticks: int = 0                         # 因為上一輪超時而跳過的輪次
+        self.interval_changed = Event()
 
         # specify the display timezone of live_start_time 
         self.timezone = timezone(timezone_str)
 
-    async def subscribeRooms(self, room_ids: list[str]) -> None:
+        # 統計，見 `registerMetrics`
+        self.cycle_duration: Histogram = Histogram()
+        self.cycle_lateness: Histogram = Histogram()
+        self.transitions: dict[str, int] = {"start": 0, "modify": 0, "end": 0}     # 提交的狀態變化
+        self.notification_lag: Histogram = Histogram(LAG_BUCKETS)                  # 開播時間到開播提醒送達
+        # 第一次查詢時已經在直播的直播間，開播時間遠早於bot發現它的時間，提醒的延遲不計入notification_lag
+        self.first_seen_live: set[str] = set()
+        # 事件循環的卡頓檢測，loop_profile_threshold大於0時卡頓超過它就採樣調用棧
+        self.watchdog = LoopWatchdog(profile_threshold=loop_profile_threshold)
+        self.metrics = MetricsRegistry()
+        self.registerMetrics()
+
+    def registerMetrics(self) -> None:
+
+        """
+            註冊 /metrics 導出的指標，collect都在導出時才讀取，liveroom等組件被替換後讀到的也是新的組件
+        """
+
+        m = self.metrics
+        m.histogram("poll_cycle_seconds", "Duration of a poll cycle", lambda: self.cycle_duration)
+        m.histogram("poll_lateness_seconds", "How late a poll cycle started after its deadline", lambda: self.cycle_lateness)
+        m.counter("poll_skipped_ticks_total", "Poll ticks skipped because the previous cycle overran", lambda: self.skipped_ticks)
+        m.gauge("poll_interval_seconds", "Base poll interval", lambda: self.poll_interval)
+        m.histogram("fetch_chunk_seconds", "Latency of a batch getRoomBaseInfo request", lambda: self.liveroom.chunk_latency)
+        m.counter("fetch_chunk_errors_total", "Failed batch requests by exception type", lambda: self.liveroom.chunk_errors, ("type",))
+        m.counter("fetch_unchanged_skipped_total", "Rooms skipped because their snapshot fingerprint did not change", lambda: self.unchanged_skipped)
+        m.gauge("rooms", "Subscribed rooms by state", self.countRoomStates, ("state",))
+        m.counter("transitions_total", "Committed room state transitions", lambda: self.transitions, ("kind",))
+        m.histogram("notification_lag_seconds", "Time from live_start_time to delivery of the live start notification, excluding rooms already live when first polled", lambda: self.notification_lag)
+        m.histogram("telegram_request_seconds", "Latency of Telegram bot api requests, excluding queueing",
+                    lambda: self.dispatcher.request_latency, ("method",))
+        m.counter("telegram_errors_total", "Failed Telegram bot api requests by exception type",
+                    lambda: self.dispatcher.errors, ("method", "type"))
+        m.counter("telegram_sent_total", "Telegram messages sent or edited", lambda: self.dispatcher.sent)
+        m.counter("telegram_failed_total", "Telegram requests given up", lambda: self.dispatcher.failed)
+        m.counter("telegram_coalesced_total", "Edits merged into a newer edit of the same message", lambda: self.dispatcher.coalesced)
+        m.gauge("queue_depth", "Queued work by queue", lambda: {
+            "telegram": len(self.dispatcher.queue),
+            "telegram_inflight": self.dispatcher.inflight,
+            "digest": len(self.digest_queue),
+            "pending_starts": len(self.pending_starts),
+            "updates": self.app.update_queue.qsize(),
+            "state_store": len(self.state_store.dirty_rooms) if self.state_store != None else 0
+        }, ("queue",))
+        m.gauge("circuit_open", "Whether a circuit breaker is not closed", lambda: {
+            self.bilibili_breaker.name: int(self.bilibili_breaker.state != CLOSED),
+            self.telegram_breaker.name: int(self.telegram_breaker.state != CLOSED)
+        }, ("breaker",))
+        m.histogram("command_seconds", "Latency of command handlers", lambda: self.app.command_latency, ("command",))
+        m.histogram("loop_lag_seconds", "How late the event loop watchdog woke up", lambda: self.watchdog.lag)
+        m.counter("loop_stalls_total", "Event loop stalls longer than the watchdog threshold", lambda: self.watchdog.stalls)
+
+    def countRoomStates(self) -> dict[str, int]:
+
+        """
+            按狀態統計直播間，導出時調用
+        """
+
+        states = {"living": 0, "not_living": 0, "unknown": 0, "invalid": 0}
+        for record in self.room_records.values():
+            if not record.is_valid:
+                states["invalid"] += 1
+            elif record.is_living == None:
+                states["unknown"] += 1
+            elif record.is_living:
+                states["living"] += 1
+            else:
+                states["not_living"] += 1
+        return states
+
+    async def subscribeRooms(self, room_ids: list[str], chat_id: str=None) -> None:
 
         """
             添加關注的直播間
+            chat_id為None時，為配置中的所有chat添加
         """
 
         await sleep(0)
+        chat_ids = self.chat_ids if chat_id == None else [chat_id]
         await self.config_lock.acquire()
         room_ids = [room_id for room_id in room_ids if isValidPositiveInt(room_id)]
         room_ids = list(set(room_ids))
@@ -73,35 +214,149 @@ class BilibiliLiveNotificationBot():
             if self.room_records.get(room_id) == None:
                 self.room_records[room_id] = RoomRecord(room_id)
                 self.liveroom.addRoom(room_id)
+                self.scheduler.addRoom(room_id)
+                self.saveRecord(self.room_records[room_id])
+            for chat in chat_ids:
+                if self.subscriptions.subscribe(chat, room_id) and self.state_store != None:
+                    self.state_store.saveSubscription(chat, room_id, True)
         self.config_lock.release()
 
         if room_ids != []:
-            logger.info(f"Subscribe rooms: {room_ids}")
+            logger.info(f"Subscribe rooms for {chat_ids}: {room_ids}")
 
-    async def unsubscribeRooms(self, room_ids: list[str]) -> None:
+    async def unsubscribeRooms(self, room_ids: list[str], chat_id: str=None) -> None:
         
         """
             刪除關注的直播間
+            chat_id為None時，直接刪除直播間，否則只取消該chat的訂閱，沒有訂閱者的直播間才會被刪除
         """
 
         await sleep(0)
         await self.config_lock.acquire()
         for room_id in room_ids:
-            if self.room_records.get(room_id) != None:
-                del self.room_records[room_id]
-                self.liveroom.removeRoom(room_id)
+            if self.room_records.get(room_id) == None:
+                continue
+            if chat_id != None:
+                if not self.subscriptions.unsubscribe(chat_id, room_id):
+                    if self.state_store != None:
+                        self.state_store.saveSubscription(chat_id, room_id, False)
+                    continue
+            self.removeRoom(room_id)
         self.config_lock.release()
         
-        logger.info(f"Unsubscribe rooms: {room_ids}")
+        logger.info(f"Unsubscribe rooms for {chat_id}: {room_ids}")
+
+    def removeRoom(self, room_id: str) -> None:
+
+        """
+            刪除直播間的記錄和全部訂閱，調用時需持有config_lock
+        """
+
+        del self.room_records[room_id]
+        self.room_list.remove(room_id)
+        self.fingerprints.pop(room_id, None)
+        self.subscriptions.removeRoom(room_id)
+        for digest in list(self.digests.values()):
+            if room_id in digest.room_ids and room_id not in digest.frozen:
+                digest.room_ids.remove(room_id)
+                self.saveDigest(digest)
+        self.liveroom.removeRoom(room_id)
+        self.scheduler.removeRoom(room_id)
+        if self.state_store != None:
+            self.state_store.deleteRoom(room_id)
+
+    async def restoreState(self) -> None:
+
+        """
+            從state_store恢復直播間記錄和已發送的消息，啟動時調用一次
+            存儲中的直播間也會加入訂閱列表
+            已經從配置中移除的chat不能再使用bot（也就無法取消訂閱），它們的訂閱、消息和合併提醒從存儲中刪除
+        """
+
+        await sleep(0)
+        if self.state_store == None:
+            return
+
+        rooms, messages, subscriptions, digests = self.state_store.load()
+        await self.config_lock.acquire()
+        stale_chats = set()
+        for room_id, state in rooms.items():
+            # 沒有訂閱記錄的直播間來自單chat版本的存儲，歸給第一個chat
+            chat_ids = subscriptions.get(room_id, {self.chat_id})
+            for chat_id in chat_ids - set(self.chat_ids):
+                stale_chats.add(chat_id)
+                self.state_store.saveSubscription(chat_id, room_id, False)
+            chat_ids = chat_ids & set(self.chat_ids)
+            if chat_ids == set() and self.room_records.get(room_id) == None:
+                self.state_store.deleteRoom(room_id)
+                continue
+
+            if self.room_records.get(room_id) == None:
+                self.room_records[room_id] = RoomRecord(room_id)
+                self.liveroom.addRoom(room_id)
+                self.scheduler.addRoom(room_id)
+            record = self.room_records[room_id]
+            record.loadState(state)
+            self.room_list.update(record)
+            self.scheduler.recordLiveStart(room_id, record.start_time)
+            record.messages_sent = {chat_id: message_id for chat_id, message_id in messages.get(room_id, {}).items() if chat_id in chat_ids}
+            if record.messages_sent != messages.get(room_id, {}):
+                self.state_store.saveMessages(room_id, record.messages_sent)
+            for chat_id in chat_ids:
+                self.subscriptions.subscribe(chat_id, room_id)
+                self.state_store.saveSubscription(chat_id, room_id, True)
+        for (chat_id, message_id), state in digests.items():
+            if chat_id not in self.chat_ids:
+                self.state_store.saveDigest(chat_id, message_id, None)
+                continue
+            self.digests[(chat_id, message_id)] = DigestMessage.loadState(chat_id, message_id, state)
+        self.config_lock.release()
+
+        if rooms != {}:
+            logger.info(f"Restored {len(self.room_records)} rooms from state store")
+        if stale_chats != set():
+            logger.warning(f"Removed subscriptions of chats no longer in config: {sorted(stale_chats)}")
+
+    def saveRecord(self, record: RoomRecord) -> None:
 
-    async def getSubscribedRooms(self, room_ids: list[str]=None) -> dict[str, RoomRecord]:
+        """
+            記錄已提交的狀態，在本輪輪詢結束時寫入state_store
+            同時更新 /list 的排序
+        """
+
+        self.room_list.update(record)
+        if self.state_store == None:
+            return
+        self.state_store.saveRoom(record.room_id, record.dumpState())
+        self.state_store.saveMessages(record.room_id, record.messages_sent)
+
+    def saveDigest(self, digest: DigestMessage) -> None:
+
+        """
+            記錄合併的提醒，全部段落都結束後不再需要編輯，從記錄中刪除
+        """
+
+        if digest.isFinished():
+            self.digests.pop((digest.chat_id, digest.message_id), None)
+        if self.state_store == None:
+            return
+        self.state_store.saveDigest(digest.chat_id, digest.message_id, None if digest.isFinished() else digest.dumpState())
+
+    async def getSubscribedRooms(self, room_ids: list[str]=None, chat_id: str=None) -> dict[str, RoomRecord]:
 
         """
             獲取關注的直播間的列表
+            chat_id不為None時，只返回該chat訂閱的直播間
         """
 
         await sleep(0)
         await self.config_lock.acquire()
+        if chat_id != None:
+            if room_ids == None:
+                room_ids = self.subscriptions.getRooms(chat_id)
+            else:
+                room_ids = [room_id for room_id in room_ids if self.subscriptions.isSubscribed(chat_id, room_id)]
+
         if room_ids == None:
             ret = self.room_records.copy()
         else:
@@ -112,6 +367,25 @@ class BilibiliLiveNotificationBot():
         self.config_lock.release()
         return ret
 
+    def getRoomListPage(self, chat_id: str, page: int, page_size: int, living_only: bool=False, area: str="") -> tuple[list[RoomRecord], int, int]:
+
+        """
+            /list 的一頁，返回 (直播間記錄, 頁碼, 符合條件的直播間總數)，頁碼從0開始，超出範圍時返回最後一頁
+            area不為空時只返回分區名稱包含area的直播間
+            只在排好序的索引上過濾和切片，不複製記錄；期間沒有await，不需要config_lock
+        """
+
+        rooms = self.subscriptions.getRooms(chat_id)
+        accept = None
+        # 訂閱了全部直播間（只有一個chat時總是如此）且不按分區過濾時，直接切片
+        if area != "" or len(rooms) != len(self.room_list):
+            accept = lambda room_id: room_id in rooms and area in (self.room_records[room_id].area_name_pair or "")
+        room_ids, count = self.room_list.getPage(page, page_size, living_only, accept)
+        if room_ids == [] and count > 0:
+            page = (count - 1) // page_size
+            room_ids, count = self.room_list.getPage(page, page_size, living_only, accept)
+        return [self.room_records[room_id] for room_id in room_ids], page, count
+
     async def deleteInvalidRooms(self) -> None:
         
         """
@@ -122,13 +396,12 @@ class BilibiliLiveNotificationBot():
         await self.config_lock.acquire()
         mark_delete = [room_id for room_id, record in self.room_records.items() if not record.is_valid]
         for room_id in mark_delete:
-            self.liveroom.removeRoom(room_id)
-            del self.room_records[room_id]
+            self.removeRoom(room_id)
         self.config_lock.release()
         if mark_delete != []:
             logger.info(f"Delete invalid rooms: {mark_delete}")
 
-    async def updateRoomInformation(self, room_id: str) -> None:
+    async def updateRoomInformation(self, room_id: str, snapshot: RoomInfoSnapshot) -> None:
 
         """
             更新直播間信息
@@ -141,12 +414,18 @@ class BilibiliLiveNotificationBot():
         if self.room_records.get(room_id) == None:
             return
 
+        # 開播提醒還在發送中
+        if room_id in self.pending_starts:
+            return
+
         # skip invalid room
         if not self.room_records[room_id].is_valid:
             return
 
+        fingerprint = snapshot.fingerprints.get(room_id) if snapshot.fingerprints != None else None
+
         try:
-            result = await self.getRoomInfo(room_id)
+            result = snapshot.getRoomInfo(room_id)
 
             fetched_record = RoomRecord(room_id)
             fetched_record.parseResult(result)
@@ -159,54 +438,306 @@ class BilibiliLiveNotificationBot():
             # F/None      | F               | T,send msg  |
             # send msg: 發送開播提醒
             # check diff: 檢查信息變動
-            current_record = self.room_records[room_id]
+            # 鎖只覆蓋記錄的修改，發送/編輯消息的網路請求在鎖外進行
+            action = None
+            await self.config_lock.acquire()
+            current_record = self.room_records.get(room_id)
+            if current_record == None:
+                self.config_lock.release()
+                return
             current_record.restoreSnapshot()
 
             if current_record.is_living != True:        # 一開始沒在直播：啟動bot後的第一個狀態/not living
                 if fetched_record.is_living:                    # not living --> living, 發消息
                     logger.info(f"Room {room_id}: send live start message")
+                    if current_record.is_living == None:
+                        self.first_seen_live.add(room_id)
                     current_record.tryUpdateRecord(fetched_record)
-                    current_record.message_sent = await self.sendLiveStartMessage(current_record)
-                    current_record.commitUpdateRecord()
+                    action = "start"
                 else:                                       # not living --> not living，更新記錄
+                    changed = current_record.is_living == None or current_record.hasUpdate(fetched_record)
                     current_record.tryUpdateRecord(fetched_record)
                     current_record.commitUpdateRecord()
+                    if changed:
+                        self.saveRecord(current_record)
             else:                                       # 一開始在直播，檢查下一狀態：
                 if fetched_record.is_living:                    # 還在直播，檢查狀態更新
                     if current_record.hasUpdate(fetched_record):
                         logger.info(f"Room {room_id}: update sent message")
                         current_record.tryUpdateRecord(fetched_record, update_title_history=True)  # 記錄標題變動
-                        current_record.message_sent = await self.modifySentLiveMessage(current_record)
-                        current_record.commitUpdateRecord()
+                        action = "modify"
                 else:                                       # 沒在播了，清理信息和歷史標題
                     logger.info(f"Room {room_id}: live end, update sent message")
                     current_record.tryUpdateRecord(fetched_record, update_start_time=False)    # 此時開始時間為0，避免覆蓋記錄的開始時間
-                    await self.markSentLiveMessageAsEnd(current_record)
-                    current_record.commitUpdateRecord()
-                    current_record.liveEnd()
-                    
-        except RoomNotExistException:
+                    action = "end"
+            if action == None:
+                self.recordFingerprint(room_id, fingerprint)
+            self.config_lock.release()
+
+            if action == None:
+                return
+
+            # 開播提醒要等到拿到message_id才提交記錄，在後台完成，期間跳過該直播間
+            if action == "start":
+                self.scheduler.recordLiveStart(room_id, current_record.start_time)
+                current_record.pending_fingerprint = fingerprint
+                if self.digest_window > 0:
+                    self.queueLiveStart(current_record)
+                else:
+                    futures = self.sendLiveStartMessage(current_record)
+                    self.pending_starts[room_id] = create_task(self.finishLiveStart(current_record, futures))
+                return
+
+            # 編輯消息不需要等待結果，記錄直接提交，尚未發出的編輯會在dispatcher中合併為最新的內容
+            if action == "modify":
+                futures = self.modifySentLiveMessage(current_record)
+            else:
+                futures = self.markSentLiveMessageAsEnd(current_record)
+
+            await self.config_lock.acquire()
+            # 等鎖期間被取消訂閱了，不能再寫回索引和存儲
+            if self.room_records.get(room_id) is not current_record:
+                self.config_lock.release()
+                return
+            current_record.commitUpdateRecord()
+            if action == "end":
+                current_record.liveEnd()
+                self.keyframe_cache.invalidate(current_record.uid)
+            self.saveRecord(current_record)
+            self.recordFingerprint(room_id, fingerprint)
+            self.transitions[action] += 1
+            self.config_lock.release()
+
+            if futures != {}:
+                create_task(self.waitMessageEdit(room_id, futures))
+
+        except Exception as e:
+            await self.handleUpdateException(e, room_id)
+
+    async def finishLiveStart(self, record: RoomRecord, futures: dict[str, Future[Message]]) -> None:
+
+        """
+            等待發往各個chat的開播提醒發送完成後提交記錄
+            全部失敗時記錄保持未提交，下一輪輪詢時回滾並重新發送；
+            部分失敗時先提交成功的部分，暫時性錯誤的chat單獨重試最多START_RETRY_ROUNDS輪，期間直播間仍然跳過輪詢
+            發送期間直播間被取消訂閱時丟棄結果，否則提交會把它重新寫回索引和存儲
+        """
+
+        try:
+            results = await gather(*futures.values(), return_exceptions=True)
+            await self.config_lock.acquire()
+            if self.room_records.get(record.room_id) is not record:
+                self.config_lock.release()
+                logger.info(f"Room {record.room_id}: unsubscribed while sending live start message, drop the result")
+                return
+            committed = any(not isinstance(result, Exception) for result in results) or results == []
+            if committed:
+                record.messages_sent = {chat_id: result.message_id for chat_id, result in zip(futures.keys(), results)
+                                        if not isinstance(result, Exception)}
+                record.commitUpdateRecord()
+                self.saveRecord(record)
+                self.recordFingerprint(record.room_id, record.pending_fingerprint)
+                self.transitions["start"] += 1
+                if record.start_time != None and record.room_id not in self.first_seen_live:
+                    self.notification_lag.observe(max(time() - record.start_time.timestamp(), 0))
+            self.config_lock.release()
+            retry_chats = await self.handleSendErrors(record.room_id, list(futures.keys()), results)
+
+            for _ in range(self.START_RETRY_ROUNDS):
+                if not committed or retry_chats == []:
+                    break
+                await sleep(max(self.telegram_breaker.retryDelay(), self.scheduler.tickInterval()))
+                retry_chats = [chat_id for chat_id in retry_chats if self.subscriptions.isSubscribed(chat_id, record.room_id)]
+                if self.room_records.get(record.room_id) is not record or retry_chats == []:
+                    return
+                logger.info(f"Room {record.room_id}: retry live start message for chats {retry_chats}")
+                futures = self.sendLiveStartMessage(record, retry_chats)
+                results = await gather(*futures.values(), return_exceptions=True)
+                await self.config_lock.acquire()
+                if self.room_records.get(record.room_id) is not record:
+                    self.config_lock.release()
+                    return
+                record.messages_sent.update({chat_id: result.message_id for chat_id, result in zip(futures.keys(), results)
+                                             if not isinstance(result, Exception)})
+                self.saveRecord(record)
+                self.config_lock.release()
+                retry_chats = await self.handleSendErrors(record.room_id, list(futures.keys()), results)
+            if committed and retry_chats != []:
+                logger.warning(f"Room {record.room_id}: give up live start message for chats {retry_chats}")
+        finally:
+            self.pending_starts.pop(record.room_id, None)
+            self.first_seen_live.discard(record.room_id)
+
+    def queueLiveStart(self, record: RoomRecord) -> None:
+
+        """
+            開播提醒先進入隊列，第一個開播之後digest_window秒一起發送
+            期間直播間記在pending_starts中，輪詢時跳過
+        """
+
+        self.digest_queue.append(record)
+        if self.digest_task == None:
+            self.digest_task = create_task(self.flushDigest())
+        self.pending_starts[record.room_id] = self.digest_task
+
+    async def flushDigest(self) -> None:
+
+        """
+            發送隊列中的開播提醒：每個chat中同時開播的直播間合併為一條消息，只有一個直播間時照常發送
+        """
+
+        await sleep(self.digest_window)
+        records, self.digest_queue, self.digest_task = self.digest_queue, [], None
+
+        chat_records: dict[str, list[RoomRecord]] = {}
+        for record in records:
+            for chat_id in self.subscriptions.getSubscribers(record.room_id):
+                chat_records.setdefault(chat_id, []).append(record)
+
+        futures: dict[str, dict[str, Future[Message]]] = {record.room_id: {} for record in records}
+        for chat_id, chat_record_list in chat_records.items():
+            for group in DigestMessage.splitSections(chat_record_list, self.timezone):
+                if len(group) == 1:
+                    future = self.sendLiveStartMessage(group[0], [chat_id])[chat_id]
+                else:
+                    future = create_task(self.sendDigestMessage(chat_id, group))
+                for record in group:
+                    futures[record.room_id][chat_id] = future
+
+        logger.info(f"Send live start messages of {len(records)} rooms to {len(chat_records)} chats")
+        for record in records:
+            self.pending_starts[record.room_id] = create_task(self.finishLiveStart(record, futures[record.room_id]))
+
+    async def sendDigestMessage(self, chat_id: str, records: list[RoomRecord]) -> Message:
+
+        """
+            發送合併的開播提醒，每個直播間一段，一行按鈕
+        """
+
+        digest = DigestMessage(chat_id, None, [record.room_id for record in records])
+        record_dict = {record.room_id: record for record in records}
+        content = (digest.generateMessageText(record_dict, self.timezone), digest.generateKeyboard(record_dict))
+        message = await self.dispatcher.sendMessage(chat_id, priority=PRIORITY_START, text=content[0],
+                                                    parse_mode="MarkdownV2", link_preview_options=LinkPreviewOptions(is_disabled=True),
+                                                    reply_markup=content[1])
+        digest.message_id = message.message_id
+        digest.last_sent = content
+        self.digests[(chat_id, message.message_id)] = digest
+        self.saveDigest(digest)
+        return message
+
+    def recordFingerprint(self, room_id: str, fingerprint: tuple) -> None:
+
+        """
+            記錄已經處理並提交的指紋，調用時需持有config_lock
+        """
+
+        if fingerprint != None and room_id in self.room_records:
+            self.fingerprints[room_id] = fingerprint
+
+    async def waitMessageEdit(self, room_id: str, futures: dict[str, Future[Message]]) -> None:
+
+        """
+            等待各個chat的消息編輯完成，只處理出錯的情況
+        """
+
+        results = await gather(*futures.values(), return_exceptions=True)
+        await self.handleSendErrors(room_id, list(futures.keys()), results)
+
+    @staticmethod
+    def isChatUnavailable(e: Exception) -> bool:
+
+        """
+            chat本身不可用：bot被封鎖、被移出群組/頻道，或chat不存在，重試也不會成功
+        """
+
+        return isinstance(e, telegram.error.Forbidden) or \
+                (isinstance(e, telegram.error.BadRequest) and str(e) == "Chat not found")
+
+    async def handleSendErrors(self, room_id: str, chat_ids: list[str], results: list) -> list[str]:
+
+        """
+            按chat處理發送/編輯的結果，一個chat的錯誤不影響其他chat
+            chat不可用時取消它的訂閱；返回遇到暫時性錯誤（dispatcher重試後仍然失敗）的chat
+        """
+
+        transient = []
+        for chat_id, result in zip(chat_ids, results):
+            if not isinstance(result, Exception):
+                continue
+            if self.isChatUnavailable(result):
+                await self.dropChat(chat_id, result)
+                continue
+            if isinstance(result, telegram.error.NetworkError) and not isinstance(result, telegram.error.BadRequest):
+                transient.append(chat_id)
+            await self.handleUpdateException(result, room_id)
+        return transient
+
+    async def dropChat(self, chat_id: str, e: Exception) -> None:
+
+        """
+            chat不可用時取消它的全部訂閱，並忘記發往它的消息，之後不再向它發送和編輯
+            chat可以在恢復後重新訂閱；配置中的chat重啟後會按配置重新訂閱
+            同一次發送中多個直播間的消息會同時失敗，只有第一次調用會取消訂閱並通知
+        """
+
+        await self.config_lock.acquire()
+        room_ids = list(self.subscriptions.getRooms(chat_id))
+        for room_id in room_ids:
+            if self.subscriptions.unsubscribe(chat_id, room_id):
+                self.removeRoom(room_id)
+            elif self.state_store != None:
+                self.state_store.saveSubscription(chat_id, room_id, False)
+        for record in self.room_records.values():
+            if chat_id in record.messages_sent:
+                del record.messages_sent[chat_id]
+                self.saveRecord(record)
+        for key in [key for key in self.digests.keys() if key[0] == chat_id]:
+            del self.digests[key]
+            if self.state_store != None:
+                self.state_store.saveDigest(key[0], key[1], None)
+        self.config_lock.release()
+
+        if room_ids == []:
+            return
+        logger.warning(f"Chat {chat_id} is unavailable ({type(e).__name__}: {e}), unsubscribed its {len(room_ids)} rooms")
+        if chat_id != self.chat_id:
+            await self.sendErrorMessage(f"無法向 chat {chat_id} 發送消息（{e}），已取消它的全部訂閱")
+
+    async def handleUpdateException(self, e: Exception, room_id: str=None) -> None:
+
+        """
+            處理更新直播間信息時出現的異常
+            room_id為None時，異常來自整個訂閱列表的批量查詢
+            暫時性的錯誤不再sleep，而是記錄到對應的熔斷器，由熔斷器決定推遲哪些操作
+        """
+
+        if isinstance(e, RoomInfoStaleException):
+            # 本輪快照中沒有該直播間的信息（所在分塊查詢失敗，或是查詢後才加入訂閱），下一輪再更新
+            logger.info(f"Room {room_id}: room info is stale, skip")
+        elif isinstance(e, RoomNotExistException):
             logger.warning(f"bilibili api RoomNotExistException")
-            self.room_records[room_id].is_valid = False
-            await self.sendErrorMessage(f"直播間 {room_id} 不存在，已禁用")
-        except HTTPStatusError as e:
+            if room_id != None and self.room_records.get(room_id) != None:
+                self.room_records[room_id].is_valid = False
+                await self.sendErrorMessage(f"直播間 {room_id} 不存在，已禁用")
+        elif isinstance(e, HTTPStatusError):
             # bilibili api weird situation
             # i've encountered 504 before and i don't know why 
             if (e.error_type == "Server error"):
-                logger.warning(f"bilibili api http status {e.status_code}: {e.error_type}, will resume after 10s")
-                await sleep(10)
+                logger.warning(f"bilibili api http status {e.status_code}: {e.error_type}")
+                self.bilibili_breaker.recordFailure()
             else:
                 # 什么情况
                 error_text = f"bilibili api unexpected http status {e.status_code}: {e.error_type}"
                 logger.error(error_text)
                 exit(1)
-        except NetworkError as e:
+        elif isinstance(e, NetworkError):
             # bilibili api network error
-            logger.warning(f"bilibili api NetworkError, will resume after 10s")
+            logger.warning(f"bilibili api NetworkError")
             if e.e != None:
-                logger.warning(f"Maybe unexpected error: {traceback.format_exc()}")
-            await sleep(10)
-        except CodeFieldException as e:
+                logger.warning(f"Maybe unexpected error: {''.join(traceback.format_exception(e.e))}")
+            self.bilibili_breaker.recordFailure()
+        elif isinstance(e, CodeFieldException):
             error_text = f"bilibili api CodeFieldException: {e.code}: {e.message}"
             logger.error(error_text)
             # nooooooooooooooooooooo
@@ -214,36 +745,32 @@ class BilibiliLiveNotificationBot():
                 await self.sendErrorMessage(f"bilibili api 出錯，bot即將退出： {e.code}: {e.message}\n請將以上信息發送給開發者。")
                 exit(1)
             else:
-                logger.warning("bilibili api server error, will resume after 10s")
-                await sleep(10)
-        except telegram.error.BadRequest as e:
+                logger.warning("bilibili api server error")
+                self.bilibili_breaker.recordFailure()
+        elif isinstance(e, telegram.error.BadRequest):
             # telegram bad request
             if str(e) == "Chat not found":
+                # 正常情況下已經在handleSendErrors中按chat處理
                 logger.warning("Cannot find specified chat, maybe you forget to send /start message?")
-                await sleep(10)
+            elif "message is not modified" in str(e).lower():
+                # 編輯的內容和消息現有的內容相同，消息本來就是想要的樣子
+                logger.info(f"Room {room_id}: message is not modified, skip")
             else:
                 logger.error(f"Bad request exception occurred during updating room information: {type(e).__name__}: {str(e)}")
                 exit(1)
-        except telegram.error.NetworkError:
-            # telegram NetworkError error
-            logger.warning("Telegram NetworkError exception, will resume after 10s")
-            await sleep(10)
+        elif isinstance(e, telegram.error.NetworkError):
+            # telegram NetworkError error，dispatcher重試後仍然失敗，熔斷由dispatcher記錄
+            logger.warning(f"Telegram NetworkError exception: {type(e).__name__}: {str(e)}")
+        elif isinstance(e, telegram.error.Forbidden):
+            # bot被封鎖或移出chat，只影響這一個chat，正常情況下已經在handleSendErrors中處理
+            logger.warning(f"Telegram Forbidden exception: {str(e)}")
         # 什麼情況
-        except Exception as e:
-            error_text = f"Unexpected error during updating room information: {traceback.format_exc()}"
+        else:
+            error_text = f"Unexpected error during updating room information: {''.join(traceback.format_exception(e))}"
             logger.error(error_text)
-            await self.sendErrorMessage(f"bot 发生意外错误： {traceback.format_exc()}\n請將以上信息發送給開發者。")
+            await self.sendErrorMessage(f"bot 发生意外错误： {''.join(traceback.format_exception(e))}\n請將以上信息發送給開發者。")
             exit(1)
 
-    async def getRoomInfo(self, room_id: str) -> dict:
-
-        """
-            從api獲取直播間信息
-        """
-
-        await sleep(0)
-        return await self.liveroom.getRoomInfo(room_id)
-    
     async def getKeyFrameUrl(self, room_id: str) -> tuple[str, str]:
 
         """
@@ -265,7 +792,15 @@ class BilibiliLiveNotificationBot():
         if not self.room_records[room_id].is_living:
             logger.info(f"Room {room_id}: not living")
             return (None, "未開播")
-        
+
+        return await self.keyframe_cache.get(uid)
+
+    async def fetchKeyFrameUrl(self, uid: str) -> tuple[str, str]:
+
+        """
+            請求api獲取關鍵幀，網絡錯誤時重試3次，返回值同getKeyFrameUrl
+        """
+
         count = 3
         while count > 0:
             try:
@@ -302,50 +837,90 @@ class BilibiliLiveNotificationBot():
                 count -= 1
         logger.warning("failed to send error message after retrying 3 times")
 
-    async def sendLiveStartMessage(self, record: RoomRecord) -> Message:
+    def sendLiveStartMessage(self, record: RoomRecord, chat_ids: list[str]=None) -> dict[str, Future[Message]]:
 
         """
             直播開始力
-            返回發送的消息，用於後續更新/標記結束
+            消息只生成一次，發往每個訂閱了該直播間的chat，由dispatcher併發發送
+            chat_ids為None時發往所有訂閱者
+            返回 chat_id -> future，future得到發送的消息，用於後續更新/標記結束
         """
 
-        await sleep(0)
         text = record.generateMessageText(self.timezone)
         option = LinkPreviewOptions(prefer_large_media=True, show_above_text=True, url=record.cover_url)
 
-        m = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="獲取關鍵幀", callback_data=f"frame {record.room_id}")]])
+        m = self.generateKeyboard(record)
 
-        return await self.tg_bot.sendMessage(self.chat_id, text=text, parse_mode="MarkdownV2", link_preview_options=option, reply_markup=m)
+        return {chat_id: self.dispatcher.sendMessage(chat_id, priority=PRIORITY_START, text=text, parse_mode="MarkdownV2", link_preview_options=option, reply_markup=m)
+                for chat_id in (chat_ids if chat_ids != None else self.subscriptions.getSubscribers(record.room_id))}
 
-    async def modifySentLiveMessage(self, record: RoomRecord) -> Message:
+    def generateKeyboard(self, record: RoomRecord) -> InlineKeyboardMarkup:
 
         """
-            更新發送的消息
+            直播中的消息下方的按鈕
         """
 
-        await sleep(0)
-        if record.message_sent != None:
+        return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="獲取關鍵幀", callback_data=f"frame {record.room_id}")]])
+
+    def modifySentLiveMessage(self, record: RoomRecord, final: bool=False) -> dict[str, Future[Message]]:
+
+        """
+            更新各個chat中發送的消息，消息內容在調用時生成，交給dispatcher排隊發送
+            只依賴記錄的message_id，所以重啟後恢復的記錄也能繼續編輯之前發送的消息
+            合併的提醒重新生成整條消息，同一條消息的多次編輯會在dispatcher中合併
+            final為True時是最後一次編輯（直播結束），記錄提交後message_id就被清理，dispatcher會一直重試到成功
+        """
 
-            text = record.generateMessageText(self.timezone)
-            option = LinkPreviewOptions(prefer_large_media=True, show_above_text=True, url=record.cover_url)
+        if record.messages_sent == {}:
+            return {}
+
+        text = record.generateMessageText(self.timezone)
+        option = LinkPreviewOptions(prefer_large_media=True, show_above_text=True, url=record.cover_url)
+        if not record.is_living:
+            m = InlineKeyboardMarkup([[]])
+        else:
+            m = self.generateKeyboard(record)
+
+        futures = {}
+        for chat_id, message_id in record.messages_sent.items():
+            digest = self.digests.get((chat_id, message_id))
+            if digest == None:
+                futures[chat_id] = self.dispatcher.editMessageText(chat_id, message_id, priority=PRIORITY_EDIT, persistent=final, text=text,
+                                                                    parse_mode="MarkdownV2", link_preview_options=option, reply_markup=m)
+                continue
             if not record.is_living:
-                m = InlineKeyboardMarkup([[]])
-            else:
-                m = record.message_sent.reply_markup
-            return await record.message_sent.edit_text(text, parse_mode="MarkdownV2", link_preview_options=option, reply_markup=m)
-        
-        return None
+                digest.freeze(record, self.timezone)
+                self.saveDigest(digest)
+            # 段落不包含封面等字段，這些字段的變化不會改變消息，相同的內容再編輯一次telegram會返回 "message is not modified"
+            content = (digest.generateMessageText(self.room_records, self.timezone), digest.generateKeyboard(self.room_records))
+            if content == digest.last_sent:
+                continue
+            digest.last_sent = content
+            futures[chat_id] = self.dispatcher.editMessageText(chat_id, message_id, priority=PRIORITY_EDIT, persistent=final, text=content[0],
+                                                                parse_mode="MarkdownV2", link_preview_options=LinkPreviewOptions(is_disabled=True),
+                                                                reply_markup=content[1])
+            futures[chat_id].add_done_callback(digest.checkEditResult)
+        return futures
 
-    async def markSentLiveMessageAsEnd(self, record: RoomRecord) -> None:
+    def markSentLiveMessageAsEnd(self, record: RoomRecord) -> dict[str, Future[Message]]:
 
         """
             標記結束，記錄結束時間
         """
 
-        await sleep(0)
         record.stop_time = datetime.now().astimezone(utc)
-        await self.modifySentLiveMessage(record)
+        return self.modifySentLiveMessage(record, final=True)
  
+    def setPollInterval(self, poll_interval: int) -> None:
+
+        """
+            修改輪詢的基礎間隔，各等級的間隔隨之變化
+        """
+
+        self.poll_interval = poll_interval
+        self.scheduler.base_interval = poll_interval
+        self.interval_changed.set()
+
     async def appStart(self) -> NoReturn:
 
         """
@@ -359,13 +934,70 @@ class BilibiliLiveNotificationBot():
             CommandHandler("unsubscribe", "移出訂閱列表", handleUnsubscribe),
             CommandHandler("interval", "顯示，或修改對完整的訂閱列表的輪詢的間隔", handleInterval),
             CommandHandler("echo", "還活著嗎", handleEcho),
-            CommandHandler("frame", "獲取直播間的關鍵幀", handleFrame)
+            CommandHandler("frame", "獲取直播間的關鍵幀", handleFrame),
+            CommandHandler("stats", "事件循環的卡頓統計，以及輪詢和發送的耗時", handleStats)
         ]
 
         self.app.addCommandHandlers(command_handlers)
 
         await self.app.start()
 
+    async def dispatchStart(self) -> NoReturn:
+
+        """
+            發送排隊的出站消息
+        """
+
+        await self.dispatcher.run()
+
+    async def watchdogStart(self) -> NoReturn:
+
+        """
+            檢測事件循環的卡頓
+        """
+
+        await self.watchdog.run()
+
+    async def keyframeStart(self) -> None:
+
+        """
+            按自己的間隔為所有直播中的直播間批量預取關鍵幀，/frame 直接從緩存返回
+            keyframe_prefetch_interval為0時直接返回
+        """
+
+        await sleep(0)
+        if self.keyframe_prefetch_interval <= 0:
+            return
+        while True:
+            await self.prefetchKeyFrames()
+            await sleep(self.keyframe_prefetch_interval)
+
+    async def prefetchKeyFrames(self) -> None:
+
+        """
+            批量查詢直播中的直播間的關鍵幀並寫入緩存
+            緩存的有效期為兩個預取間隔，一次預取失敗時 /frame 仍然能用上一次的結果
+        """
+
+        await sleep(0)
+        await self.config_lock.acquire()
+        uids = list({record.uid for record in self.room_records.values() if record.is_living and record.uid != None})
+        self.config_lock.release()
+
+        # 預取不是必須的，Bilibili api不可用時直接跳過
+        if uids == [] or self.bilibili_breaker.state != CLOSED:
+            return
+
+        urls, errors = await self.liveroom.fetchKeyFrameUrls(uids)
+        for uid, url in urls.items():
+            # 剛開播時還沒有關鍵幀，不緩存
+            if url != "":
+                self.keyframe_cache.put(uid, (url, None), ttl=self.keyframe_prefetch_interval * 2)
+                self.keyframe_prefetched += 1
+        if errors != []:
+            logger.warning(f"Key frame prefetch: {len(errors)} chunks failed, first error: {type(errors[0]).__name__}: {errors[0]}")
+        logger.info(f"Prefetched {len(urls)}/{len(uids)} key frames")
+
     async def subscribeStart(self) -> NoReturn:
 
         """
@@ -374,12 +1006,129 @@ class BilibiliLiveNotificationBot():
 
         await sleep(0)
         logger.info("Start subscribing live rooms")
-        while True:
-            for room_id in self.room_records.keys():
-                await self.config_lock.acquire()
-                await self.updateRoomInformation(room_id)
-                self.config_lock.release()
-            await self.deleteInvalidRooms()
-            await sleep(self.poll_interval)
+
+        try:
+            # 按固定的monotonic時間表啟動每一輪，而不是在處理完之後再sleep一個間隔
+            next_deadline = monotonic()
+            while True:
+                tick_start = monotonic()
+                self.last_cycle_lateness = tick_start - next_deadline
+                self.cycle_lateness.observe(max(self.last_cycle_lateness, 0))
+                if self.last_cycle_lateness > self.scheduler.tickInterval() / 2:
+                    logger.warning(f"Poll cycle started {self.last_cycle_lateness:.3f}s late")
+
+                await self.pollOnce()
+                # 每輪都寫入，沒有到期的直播間或熔斷時也不例外，期間的訂閱變化和發送的消息不會一直留在內存裡
+                await self.flushState()
+
+                # 超時的輪次直接跳過，下一輪對齊到時間表上的下一個deadline
+                next_deadline = tick_start + self.scheduler.tickInterval()
+                now = monotonic()
+                if now > next_deadline:
+                    skipped = int((now - next_deadline) // self.scheduler.tickInterval()) + 1
+                    next_deadline += skipped * self.scheduler.tickInterval()
+                    self.skipped_ticks += skipped
+                    logger.warning(f"Poll cycle overran, skipped {skipped} ticks")
+
+                # 等待到deadline，期間修改了輪詢間隔時按新的間隔重新計算deadline
+                while True:
+                    timeout = next_deadline - monotonic()
+                    if timeout <= 0:
+                        break
+                    self.interval_changed.clear()
+                    try:
+                        await wait_for(self.interval_changed.wait(), timeout)
+                    except TimeoutError:
+                        break
+                    next_deadline = tick_start + self.scheduler.tickInterval()
+        finally:
+            # 退出（包括被取消）時寫入最後的修改
+            await self.flushState()
+
+    async def flushState(self) -> None:
+
+        """
+            把記錄的修改寫入state_store
+        """
+
+        if self.state_store != None:
+            await self.state_store.flush()
+
+    async def pollRooms(self, room_ids: list[str]) -> RoomInfoSnapshot:
+
+        """
+            批量查詢room_ids的狀態，處理各個直播間的狀態變化，返回這一輪的快照，整個查詢失敗時返回None
+            不經過scheduler和熔斷器，回放錄製的流量時直接調用
+        """
+
+        try:
+            snapshot = await self.liveroom.fetchSnapshot(room_ids)
+        except Exception as e:
+            await self.handleUpdateException(e)
+            return None
+
+        # 原始字段和上次處理時相同的直播間，記錄已經是最新的，不需要處理
+        # 開播提醒失敗時不會記錄指紋，下一輪照常重試
+        if snapshot.fingerprints != None:
+            changed = [room_id for room_id in room_ids
+                        if snapshot.fingerprints.get(room_id) == None or self.fingerprints.get(room_id) != snapshot.fingerprints[room_id]]
+            self.unchanged_skipped += len(room_ids) - len(changed)
+        else:
+            changed = room_ids
+
+        semaphore = Semaphore(self.poll_concurrency)
+
+        async def worker(room_id: str) -> None:
+            async with semaphore:
+                await self.updateRoomInformation(room_id, snapshot)
+
+        await gather(*[worker(room_id) for room_id in changed])
+        await self.deleteInvalidRooms()
+        return snapshot
+
+    async def pollOnce(self) -> None:
+
+        """
+            輪詢一次：
+            由scheduler選出到期的直播間，批量查詢它們的狀態，再以有上限的併發數處理各個直播間的狀態變化
+        """
+
+        await sleep(0)
+        cycle_start = monotonic()
+
+        await self.config_lock.acquire()
+        due, fill_ins = self.scheduler.selectRooms(self.liveroom.chunk_size)
+        self.config_lock.release()
+
+        if due == []:
+            return
+        room_ids = due + fill_ins
+
+        # bilibili api熔斷中，本輪的查詢推遲，其他功能不受影響
+        if not self.bilibili_breaker.allowRequest():
+            logger.info(f"bilibili api circuit open, skip poll cycle, retry in {self.bilibili_breaker.retryDelay():.1f}s")
+            return
+
+        snapshot = await self.pollRooms(room_ids)
+        if snapshot == None:
+            return
+
+        # 所在分塊查詢失敗的直播間並沒有查詢到，保持到期，下一次tick重新查詢
+        for room_id in due:
+            if self.room_records.get(room_id) != None and not snapshot.isStale(room_id):
+                self.scheduler.reschedule(self.room_records[room_id])
+        for room_id in fill_ins:
+            if self.room_records.get(room_id) != None and not snapshot.isStale(room_id):
+                self.scheduler.reschedule(self.room_records[room_id], fill_in=True)
+
+        # 失敗分塊的異常只處理一次，只要有分塊查詢成功就認為api可用
+        if snapshot.errors != ():
+            await self.handleUpdateException(snapshot.errors[0])
+        if len(snapshot.errors) < snapshot.batch_requests or snapshot.batch_requests == 0:
+            self.bilibili_breaker.recordSuccess()
+
+        self.last_cycle_time = monotonic() - cycle_start
+        self.cycle_duration.observe(self.last_cycle_time)
+        logger.info(f"Poll cycle {snapshot.generation} finished: {len(room_ids)} rooms, {snapshot.batch_requests} batch requests in {self.last_cycle_time:.3f}s")
 
 
@@ -0,0 +1,177 @@
+from __future__ import annotations
+from asyncio import sleep, to_thread
+from collections import deque
+from queue import SimpleQueue
+from threading import Thread
+from time import monotonic, time
+import atexit
+import gzip
+import httpx
+import json
+import logging
+
+logger = logging.getLogger("RecordingTransport")
+
+"""
+    cassette.py: 錄製和回放HTTP流量
+    cassette是gzip壓縮的json lines，每行一個請求：
+    {"t": 距離開始錄製的秒數, "time": unix時間, "duration": 耗時, "method", "url", "request": 請求body,
+     "status", "content_type", "response": 響應body}，請求失敗時沒有響應相關的字段，而是 "error" 和 "message"
+"""
+
+REDACTED = "<redacted>"
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """
+                    RecordingTransport Class
+            包裝一個httpx transport，把經過的請求和響應寫入cassette
+            redact中的字串（bot token、webhook secret）在url和body中替換為 "<redacted>"
+            替換、json編碼和gzip壓縮都在單獨的寫入線程中進行，事件循環只把原始的bytes放進隊列
+            每flush_every個請求flush一次，進程被殺掉時最多丟失這麼多條記錄，以及隊列中還沒寫入的記錄；
+            沒有調用 `aclose` 時，進程正常退出前寫完隊列中的記錄
+    """
+
+    def __init__(self, path: str, inner: httpx.AsyncBaseTransport=None, redact: list[str]=(), flush_every: int=100) -> None:
+        self.inner: httpx.AsyncBaseTransport = inner if inner != None else httpx.AsyncHTTPTransport()
+        self.redact: list[str] = [text for text in redact if text != ""]
+        self.file = gzip.open(path, "at", encoding="utf-8")
+        self.flush_every: int = flush_every
+        self.started: float = monotonic()
+        self.recorded: int = 0                          # 寫入線程更新
+
+        self.pending: SimpleQueue[dict] = SimpleQueue()  # None表示停止
+        self.writer = Thread(target=self.writeLoop, name="RecordingTransport", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def redactText(self, text: str) -> str:
+        for secret in self.redact:
+            text = text.replace(secret, REDACTED)
+        return text
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        begin = monotonic()
+        entry = {
+            "t": round(begin - self.started, 6),
+            "time": time(),
+            "method": request.method,
+            "url": str(request.url),
+            "request": await request.aread()
+        }
+        try:
+            response = await self.inner.handle_async_request(request)
+            content = await response.aread()
+        except Exception as e:
+            entry["duration"] = round(monotonic() - begin, 6)
+            entry["error"] = type(e).__name__
+            entry["message"] = str(e)
+            self.pending.put(entry)
+            raise
+
+        entry["duration"] = round(monotonic() - begin, 6)
+        entry["status"] = response.status_code
+        entry["content_type"] = response.headers.get("content-type", "")
+        entry["response"] = content
+        self.pending.put(entry)
+        return response
+
+    def write(self, entry: dict) -> None:
+        entry["url"] = self.redactText(entry["url"])
+        entry["request"] = self.redactText(entry["request"].decode(errors="replace"))
+        if "response" in entry:
+            entry["response"] = self.redactText(entry["response"].decode(errors="replace"))
+        self.file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self.recorded += 1
+        if self.recorded % self.flush_every == 0:
+            self.file.flush()
+
+    def writeLoop(self) -> None:
+
+        """
+            寫入線程：按請求完成的順序寫入，收到None後關閉文件
+            寫入失敗（比如磁盤已滿）只丟棄這一條，錄製不影響bot本身
+        """
+
+        while True:
+            entry = self.pending.get()
+            if entry == None:
+                break
+            try:
+                self.write(entry)
+            except Exception as e:
+                logger.error(f"Failed to record {entry['method']} request: {type(e).__name__}: {e}")
+        self.file.close()
+
+    def close(self) -> None:
+
+        """
+            停止寫入線程，等隊列中的記錄寫完
+        """
+
+        if self.writer.is_alive():
+            self.pending.put(None)
+            self.writer.join()
+
+    async def aclose(self) -> None:
+        await self.inner.aclose()
+        await to_thread(self.close)
+        atexit.unregister(self.close)
+
+def loadCassette(path: str) -> list[dict]:
+
+    """
+        讀取cassette，錄製中途被殺掉的文件結尾不完整，讀到哪裡算哪裡
+    """
+
+    entries = []
+    with gzip.open(path, "rt", encoding="utf-8") as file:
+        try:
+            for line in file:
+                entries.append(json.loads(line))
+        except (EOFError, json.JSONDecodeError):
+            pass
+    return entries
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """
+                    ReplayTransport Class
+            按 (method, url) 返回cassette中錄製的響應，同一個url的多個響應按錄製的順序依次返回
+            speed大於0時按錄製的耗時除以speed延遲返回，為0時立即返回
+            沒有對應的錄製時拋出ConnectError，和連不上服務器一樣處理
+            cycle時錄製的響應用完後從頭循環使用，用於回放的請求比錄製時多的情況（比如bot api）
+    """
+
+    def __init__(self, entries: list[dict], speed: float=0, redact: list[str]=(), cycle: bool=False) -> None:
+        self.speed: float = speed
+        self.cycle: bool = cycle
+        self.redact: list[str] = [text for text in redact if text != ""]
+        self.responses: dict[tuple[str, str], deque[dict]] = {}
+        for entry in entries:
+            self.responses.setdefault((entry["method"], entry["url"]), deque()).append(entry)
+
+        self.replayed: int = 0
+        self.misses: int = 0
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        for secret in self.redact:
+            url = url.replace(secret, REDACTED)
+        responses = self.responses.get((request.method, url))
+        if not responses:
+            self.misses += 1
+            raise httpx.ConnectError(f"no recorded response for {request.method} {url}", request=request)
+
+        entry = responses.popleft()
+        if self.cycle:
+            responses.append(entry)
+        self.replayed += 1
+        if self.speed > 0:
+            await sleep(entry["duration"] / self.speed)
+
+        if "error" in entry:
+            error = getattr(httpx, entry["error"], None)
+            if not (isinstance(error, type) and issubclass(error, httpx.TransportError)):
+                error = httpx.TransportError
+            raise error(entry["message"], request=request)
+        return httpx.Response(entry["status"], headers={"content-type": entry["content_type"]},
+                                content=entry["response"].encode(), request=request)
@@ -0,0 +1,106 @@
+from __future__ import annotations
+from time import monotonic
+import logging
+import random
+
+logger = logging.getLogger("CircuitBreaker")
+
+"""
+    circuitbreaker.py: 外部依賴（bilibili api、telegram）的熔斷器
+"""
+
+CLOSED = "closed"           # 正常
+OPEN = "open"               # 熔斷中，請求被推遲
+HALF_OPEN = "half-open"     # 熔斷到期，放行一個探測請求
+
+class CircuitBreaker():
+    """
+                    CircuitBreaker Class
+            連續失敗failure_threshold次後熔斷，熔斷時長按指數退避並帶隨機抖動，
+            到期後放行一個探測請求：成功則恢復，失敗則以更長的時長再次熔斷
+    """
+
+    def __init__(self, name: str, failure_threshold: int=3, base_delay: float=5, max_delay: float=300, jitter: float=0.5) -> None:
+        self.name: str = name
+        self.failure_threshold: int = failure_threshold
+        self.base_delay: float = base_delay
+        self.max_delay: float = max_delay
+        self.jitter: float = jitter                 # 熔斷時長在 [1 - jitter, 1] 倍之間隨機
+
+        self.state: str = CLOSED
+        self.consecutive_failures: int = 0
+        self.open_count: int = 0                    # 連續熔斷的次數，決定下一次熔斷的時長
+        self.open_until: float = 0
+        self.probe_inflight: bool = False
+
+        # 統計
+        self.total_failures: int = 0
+        self.total_opens: int = 0
+
+    def retryDelay(self) -> float:
+
+        """
+            距離允許下一個請求還要等待的秒數，0表示現在就可以
+        """
+
+        if self.state == CLOSED:
+            return 0
+        if self.state == OPEN:
+            return max(0, self.open_until - monotonic())
+        # half-open: 探測請求還沒有結果時繼續等待
+        return self.base_delay if self.probe_inflight else 0
+
+    def allowRequest(self) -> bool:
+
+        """
+            是否允許發出請求，熔斷到期時轉為half-open並放行一個探測請求
+        """
+
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            if monotonic() < self.open_until:
+                return False
+            self.state = HALF_OPEN
+            self.probe_inflight = False
+            logger.info(f"{self.name}: half-open, probing")
+        if self.probe_inflight:
+            return False
+        self.probe_inflight = True
+        return True
+
+    def recordSuccess(self) -> None:
+        if self.state != CLOSED:
+            logger.warning(f"{self.name}: recovered, circuit closed")
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_count = 0
+        self.probe_inflight = False
+
+    def recordFailure(self) -> None:
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            self.trip()
+
+    def trip(self) -> None:
+
+        """
+            熔斷，時長為 base_delay * 2^open_count，上限max_delay，再乘以隨機抖動
+        """
+
+        delay = min(self.max_delay, self.base_delay * 2 ** self.open_count)
+        delay *= random.uniform(1 - self.jitter, 1)
+        self.open_count += 1
+        self.total_opens += 1
+        self.state = OPEN
+        self.open_until = monotonic() + delay
+        self.probe_inflight = False
+        logger.warning(f"{self.name}: circuit open for {delay:.1f}s after {self.consecutive_failures} consecutive failures")
+
+    def getStatus(self) -> str:
+        text = f"{self.name}: {self.state}"
+        if self.state == OPEN:
+            text += f"，{self.retryDelay():.0f}s後重試"
+        text += f"（連續失敗 {self.consecutive_failures}，累計失敗 {self.total_failures}，累計熔斷 {self.total_opens}）"
+        return text
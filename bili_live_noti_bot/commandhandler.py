@@ -1,5 +1,6 @@
 from .tinyapplication import TinyApplication
-from telegram import Update
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.helpers import escape_markdown
 from .util import isValidPositiveInt
 
 """
@@ -10,39 +11,80 @@ async def handleStart(update: Update, caller: TinyApplication, argument: str):
 
     message = """Bilibili live notification bot 已啟動。
 輸入 /subscribe room_id 以添加訂閱的直播間；
-輸入 /list 以列出加入訂閱列表的直播間；
+輸入 /list 以列出加入訂閱列表的直播間，
+輸入 /list live 以只列出直播中的直播間，
+輸入 /list area 分區名稱 以只列出分區名稱包含它的直播間；
 輸入 /unsubscribe room_id 以將直播間移出訂閱列表；
 輸入 /interval 以顯示輪詢完整訂閱列表的間隔，
+輸入 /interval tiers 以顯示各等級直播間的輪詢間隔，
 輸入 /interval number_int 以修改這一間隔；
 輸入 /echo 以查看bot是否在運行；
-輸入 /frame room_id 以獲取直播間的關鍵幀
+輸入 /frame room_id 以獲取直播間的關鍵幀；
+輸入 /stats 以查看事件循環的卡頓統計（僅限第一個chat）
 """
     await update.message.reply_text(message)
 
+LIST_PAGE_SIZE = 10
+MAX_CALLBACK_DATA = 64      # callback data的長度上限，單位：字節
+
+def getListCallbackData(page: int, argument: str) -> str:
+    data = f"list {page} {argument}".strip()
+    # 過長的分區名稱被截短，按前綴過濾，結果只會更多不會更少
+    return data.encode()[:MAX_CALLBACK_DATA].decode(errors="ignore")
+
 async def handleList(update: Update, caller: TinyApplication, argument: str):
 
-    text = ""
-    rooms = await caller.owner.getSubscribedRooms()
-    for room in rooms.values():
-        text += room.generateInfoText(caller.owner.timezone)
-        if text != "":
-            text += "\n"
-    if text == "":
-        text = "無關注的直播間"
+    # argument: [頁碼] [live | area 分區名稱]，頁碼從1開始，翻頁按鈕的callback data也是這個格式
+    page = 1
+    split = argument.split(" ", 1)
+    if isValidPositiveInt(split[0]):
+        page = int(split[0])
+        argument = split[1].strip() if len(split) > 1 else ""
+
+    living_only = False
+    area = ""
+    if argument == "live":
+        living_only = True
+    elif argument.startswith("area ") and argument[5:].strip() != "":
+        area = argument[5:].strip()
+    elif argument != "":
+        await update.effective_message.reply_text("用法： /list [頁碼] [live | area 分區名稱]")
+        return
 
-    await update.message.reply_text(text, parse_mode="MarkdownV2", disable_web_page_preview=True)
+    # 只生成當前頁的直播間
+    rooms, page, count = caller.owner.getRoomListPage(str(update.effective_chat.id), page - 1, LIST_PAGE_SIZE, living_only, area)
+    if count == 0:
+        text = "無關注的直播間" if argument == "" else "沒有符合條件的直播間"
+        keyboard = None
+    else:
+        pages = (count + LIST_PAGE_SIZE - 1) // LIST_PAGE_SIZE
+        texts = [room.generateInfoText(caller.owner.timezone) for room in rooms]
+        texts.append(escape_markdown(f"第 {page + 1}/{pages} 頁，共 {count} 個直播間", 2))
+        text = "\n".join(text for text in texts if text != "")
+        buttons = []
+        if page > 0:
+            buttons.append(InlineKeyboardButton(text="⬅️ 上一頁", callback_data=getListCallbackData(page, argument)))
+        if page + 1 < pages:
+            buttons.append(InlineKeyboardButton(text="下一頁 ➡️", callback_data=getListCallbackData(page + 2, argument)))
+        keyboard = InlineKeyboardMarkup([buttons])
+
+    if update.callback_query != None:
+        await update.callback_query.answer()
+        await update.callback_query.edit_message_text(text, parse_mode="MarkdownV2", disable_web_page_preview=True, reply_markup=keyboard)
+    else:
+        await update.message.reply_text(text, parse_mode="MarkdownV2", disable_web_page_preview=True, reply_markup=keyboard)
 
 async def handleSubscribe(update: Update, caller: TinyApplication, argument: str):
 
     if not isValidPositiveInt(argument):
         await update.message.reply_text("請給出有效的直播間號")
     else:
-        rooms = await caller.owner.getSubscribedRooms()
+        rooms = await caller.owner.getSubscribedRooms(chat_id=str(update.effective_chat.id))
 
         if argument in rooms.keys():
             await update.message.reply_text(f"直播間 {argument} 已在訂閱列表中")
         else:
-            await caller.owner.subscribeRooms([argument])
+            await caller.owner.subscribeRooms([argument], str(update.effective_chat.id))
             await update.message.reply_text(f"已添加直播間 {argument}")
 
 async def handleUnsubscribe(update: Update, caller: TinyApplication, argument: str):
@@ -50,19 +92,33 @@ async def handleUnsubscribe(update: Update, caller: TinyApplication, argument: s
     if not isValidPositiveInt(argument):
         await update.message.reply_text("請給出有效的直播間號")
     else:
-        rooms = await caller.owner.getSubscribedRooms()
+        rooms = await caller.owner.getSubscribedRooms(chat_id=str(update.effective_chat.id))
 
         if argument not in rooms.keys():
             await update.message.reply_text(f"直播間 {argument} 不在訂閱列表中")
         else:
-            await caller.owner.unsubscribeRooms([argument])
+            await caller.owner.unsubscribeRooms([argument], str(update.effective_chat.id))
             await update.message.reply_text(f"已移除直播間 {argument}")
 
 async def handleEcho(update: Update, caller: TinyApplication, argument: str):
 
     text = argument
     if argument == "":
-        text = "Bot is running"
+        stats = caller.owner.dispatcher.getStats()
+        text = "Bot is running\n"
+        text += f"上一輪輪詢： 耗時 {caller.owner.last_cycle_time:.3f}s，延遲 {caller.owner.last_cycle_lateness:.3f}s，累計跳過 {caller.owner.skipped_ticks} 輪\n"
+        text += f"消息隊列： {stats['queue_depth']} 排隊中，{stats['inflight']} 發送中\n"
+        text += f"已發送： {stats['sent']}，失敗： {stats['failed']}，合併的編輯： {stats['coalesced']}，RetryAfter： {stats['retry_after']}\n"
+        text += f"發送延遲： p50 {stats['latency_p50']:.2f}s，p95 {stats['latency_p95']:.2f}s，max {stats['latency_max']:.2f}s\n"
+        text += caller.owner.bilibili_breaker.getStatus() + "\n"
+        text += caller.owner.telegram_breaker.getStatus() + "\n"
+        cache = caller.owner.keyframe_cache.getStats()
+        text += f"關鍵幀緩存： 命中 {cache['hits']}，未命中 {cache['misses']}，共用請求 {cache['shared']}，緩存 {cache['size']} 條，預取 {caller.owner.keyframe_prefetched} 次\n"
+        file_ids = caller.owner.file_id_cache.getStats()
+        text += f"圖片file_id緩存： 命中 {file_ids['hits']}，未命中 {file_ids['misses']}，淘汰 {file_ids['evictions']}，失效 {file_ids['invalidated']}，緩存 {file_ids['size']} 條\n"
+        text += f"命令處理： {caller.getPendingCount()} 待處理，累計超時 {caller.timeouts} 次"
+        for command, histogram in sorted(caller.command_latency.items()):
+            text += f"\n/{command}： {histogram.count} 次，p50 {histogram.quantile(0.5):.3f}s，p95 {histogram.quantile(0.95):.3f}s，max {histogram.max:.3f}s"
     await update.message.reply_text(text)
 
 async def handleInterval(update: Update, caller: TinyApplication, argument: str):
@@ -70,7 +126,20 @@ async def handleInterval(update: Update, caller: TinyApplication, argument: str)
     old_interval = caller.owner.poll_interval
 
     if argument == "":  
-        await update.message.reply_text(f"當前的輪詢間隔為 {old_interval}s")
+        await update.message.reply_text(f"當前的輪詢間隔為 {old_interval}s\n輸入 /interval tiers 以查看各等級直播間的輪詢間隔")
+    elif argument == "tiers":
+        scheduler = caller.owner.scheduler
+        intervals = scheduler.getTierIntervals()
+        counts = scheduler.getTierCounts()
+        descriptions = {
+            "hot": "尚未查詢、直播中，或接近歷史開播時刻",
+            "warm": "最近有過直播",
+            "cold": "超過7天沒有直播"
+        }
+        text = f"基礎輪詢間隔為 {old_interval}s\n"
+        for tier, interval in intervals.items():
+            text += f"{tier}： 每 {interval:g}s，{counts[tier]} 個直播間（{descriptions[tier]}）\n"
+        await update.message.reply_text(text)
     elif not isValidPositiveInt(argument):
         await update.message.reply_text("請給出有效的輪詢間隔")
     else:
@@ -78,7 +147,7 @@ async def handleInterval(update: Update, caller: TinyApplication, argument: str)
         if old_interval == new_interval:
             await update.message.reply_text("輪詢間隔未發生變化")
         else:
-            caller.owner.poll_interval = new_interval
+            caller.owner.setPollInterval(new_interval)
             await update.message.reply_text(f"已修改輪詢間隔： {old_interval}s ==> {new_interval}s")
 
 async def handleFrame(update: Update, caller: TinyApplication, argument: str):
@@ -95,7 +164,33 @@ async def handleFrame(update: Update, caller: TinyApplication, argument: str):
         await reply_target.reply_text(f"獲取關鍵幀失敗： {msg}")
         return
 
-    await reply_target.reply_photo(photo=url, do_quote=True)
+    # 發送過的圖片用file_id發送
+    await caller.owner.file_id_cache.sendPhoto(url, lambda photo: reply_target.reply_photo(photo=photo, do_quote=True))
         
 
     
+
+async def handleStats(update: Update, caller: TinyApplication, argument: str):
+
+    # 調用棧的位置包含代碼路徑，只給第一個chat（同時接收錯誤信息的chat）看
+    if str(update.message.chat_id) != caller.owner.chat_id:
+        await update.message.reply_text("只有第一個chat可以查看 /stats")
+        return
+
+    owner = caller.owner
+    stats = owner.watchdog.getStats()
+    text = f"事件循環延遲： p50 {stats['lag_p50']:.3f}s，p95 {stats['lag_p95']:.3f}s，max {stats['lag_max']:.3f}s，卡頓 {stats['stalls']} 次\n"
+    text += f"輪詢耗時： p50 {owner.cycle_duration.quantile(0.5):.3f}s，p95 {owner.cycle_duration.quantile(0.95):.3f}s，max {owner.cycle_duration.max:.3f}s\n"
+    text += f"批量查詢： p95 {owner.liveroom.chunk_latency.quantile(0.95):.3f}s，失敗 {sum(owner.liveroom.chunk_errors.values())} 次\n"
+    for method, histogram in owner.dispatcher.request_latency.items():
+        text += f"telegram {method}： {histogram.count} 次，p95 {histogram.quantile(0.95):.3f}s，max {histogram.max:.3f}s\n"
+    if not stats["profiling"]:
+        text += "未啟用卡頓採樣，設置 loop_profile_threshold 後可以看到卡頓的位置"
+    elif stats["offenders"] == []:
+        text += "尚未採樣到卡頓"
+    else:
+        text += f"最長的卡頓： {stats['worst_stall'][0]:.3f}s，在 {stats['worst_stall'][1]}\n"
+        text += "卡頓最多的位置："
+        for location, seconds in stats["offenders"]:
+            text += f"\n{seconds:.2f}s  {location}"
+    await update.message.reply_text(text)
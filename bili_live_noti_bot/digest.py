@@ -0,0 +1,101 @@
+from __future__ import annotations
+from asyncio import Future
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from pytz import BaseTzInfo
+
+from .roomrecord import RoomRecord, MAX_MESSAGE_LENGTH, utf16Length
+
+"""
+    digest.py: 合併的開播提醒
+"""
+
+SECTION_SEPARATOR = "\n"
+
+class DigestMessage():
+    """
+                    DigestMessage Class
+            一條包含多個直播間的開播提醒，每個直播間佔一段，各自有一行按鈕
+            直播中的段落按記錄實時生成；直播結束的段落生成最後一次後固定下來，
+            因為記錄在結束後會被清理，之後再開播時會發送新的提醒
+    """
+
+    def __init__(self, chat_id: str, message_id: int, room_ids: list[str], frozen: dict[str, str]=None) -> None:
+        self.chat_id: str = chat_id
+        self.message_id: int = message_id
+        self.room_ids: list[str] = room_ids
+        self.frozen: dict[str, str] = frozen if frozen != None else {}      # room_id -> 已結束的段落
+        # 上一次發出的內容，沒有變化時不再編輯，不持久化，重啟後第一次編輯照常發出
+        self.last_sent: tuple[str, InlineKeyboardMarkup] = None
+
+    @staticmethod
+    def splitSections(records: list[RoomRecord], timezone: BaseTzInfo) -> list[list[RoomRecord]]:
+
+        """
+            按消息長度上限把直播間分成若干條合併提醒，每條的長度留出結束時多出的兩行
+        """
+
+        groups: list[list[RoomRecord]] = []
+        length = 0
+        for record in records:
+            section_length = utf16Length(record.generateMessageText(timezone)) + len(SECTION_SEPARATOR) + 128
+            if groups == [] or length + section_length > MAX_MESSAGE_LENGTH:
+                groups.append([])
+                length = 0
+            groups[-1].append(record)
+            length += section_length
+        return groups
+
+    def getSectionLength(self) -> int:
+
+        """
+            每段的長度上限，開播後標題繼續變化時整條消息也不會超過上限
+        """
+
+        return (MAX_MESSAGE_LENGTH - len(SECTION_SEPARATOR) * (len(self.room_ids) - 1)) // len(self.room_ids)
+
+    def generateMessageText(self, records: dict[str, RoomRecord], timezone: BaseTzInfo) -> str:
+        sections = []
+        for room_id in self.room_ids:
+            if room_id in self.frozen:
+                sections.append(self.frozen[room_id])
+            elif room_id in records:
+                sections.append(records[room_id].generateMessageText(timezone, self.getSectionLength()))
+        return SECTION_SEPARATOR.join(sections)
+
+    def generateKeyboard(self, records: dict[str, RoomRecord]) -> InlineKeyboardMarkup:
+
+        """
+            每個直播中的直播間一行按鈕
+        """
+
+        keyboard = []
+        for room_id in self.room_ids:
+            record = records.get(room_id)
+            if room_id not in self.frozen and record != None:
+                keyboard.append([InlineKeyboardButton(text=f"獲取關鍵幀： {record.uname}", callback_data=f"frame {room_id}")])
+        return InlineKeyboardMarkup(keyboard)
+
+    def freeze(self, record: RoomRecord, timezone: BaseTzInfo) -> None:
+        self.frozen[record.room_id] = record.generateMessageText(timezone, self.getSectionLength())
+
+    def checkEditResult(self, future: Future) -> None:
+
+        """
+            編輯失敗時消息還是之前的內容，下次即使生成相同的內容也要重新編輯
+        """
+
+        if future.cancelled() or future.exception() != None:
+            self.last_sent = None
+
+    def isFinished(self) -> bool:
+        return all(room_id in self.frozen for room_id in self.room_ids)
+
+    def dumpState(self) -> dict:
+        return {
+            "room_ids": self.room_ids,
+            "frozen": self.frozen
+        }
+
+    @staticmethod
+    def loadState(chat_id: str, message_id: int, state: dict) -> DigestMessage:
+        return DigestMessage(chat_id, message_id, state["room_ids"], state["frozen"])
@@ -0,0 +1,331 @@
+from __future__ import annotations
+from asyncio import Event, Future, Semaphore, Task, TimeoutError, create_task, get_running_loop, sleep, wait_for
+from bisect import insort
+from collections import deque
+from datetime import timedelta
+from time import monotonic
+from telegram import Bot, Message
+from typing import NoReturn
+import telegram.error
+import logging
+
+from .circuitbreaker import CircuitBreaker
+from .metrics import Histogram
+
+logger = logging.getLogger("MessageDispatcher")
+
+"""
+    dispatcher.py: Telegram出站消息的統一發送隊列
+"""
+
+# 數字越小越優先
+PRIORITY_START = 0      # 開播提醒
+PRIORITY_EDIT = 1       # 編輯已發送的消息
+
+class TokenBucket():
+    """
+        令牌桶，rate: 每秒補充的令牌數，capacity: 桶的容量
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated: float = monotonic()
+        self.blocked_until: float = 0           # RetryAfter指定的解除時間
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+
+        """
+            距離可以取出一個令牌還要等待的秒數
+        """
+
+        self.refill(now)
+        wait = max(0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def consume(self, now: float) -> None:
+        self.refill(now)
+        self.tokens -= 1
+
+    def block(self, now: float, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0
+
+class OutboundRequest():
+    """
+        一個待發送的Bot API請求
+        method為"send"時發送新消息，為"edit"時編輯message_id對應的消息
+    """
+
+    def __init__(self, seq: int, priority: int, method: str, chat_id: str, message_id: int, kwargs: dict) -> None:
+        self.seq: int = seq
+        self.priority: int = priority
+        self.method: str = method
+        self.chat_id: str = chat_id
+        self.message_id: int = message_id
+        self.kwargs: dict = kwargs
+        self.futures: list[Future] = [get_running_loop().create_future()]
+        self.enqueued_at: float = monotonic()
+        self.retries: int = 0
+        self.persistent: bool = False                   # 為True時NetworkError不限重試次數，直到發送成功
+
+    @property
+    def key(self) -> tuple[str, int]:
+        return (self.chat_id, self.message_id)
+
+    def __lt__(self, other: OutboundRequest) -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+    def setResult(self, result) -> None:
+        for future in self.futures:
+            if not future.done():
+                future.set_result(result)
+
+    def setException(self, e: Exception) -> None:
+        for future in self.futures:
+            if not future.done():
+                future.set_exception(e)
+
+class MessageDispatcher():
+    """
+                    MessageDispatcher Class
+            所有開播提醒/編輯消息都經過這裡發送：
+            全局和每個chat各有一個令牌桶限速，開播提醒排在編輯前面，
+            同一條消息還在排隊的編輯會被合併，只發送最新的內容，
+            收到RetryAfter時只暫停對應的chat，不會阻塞輪詢，
+            網路錯誤記錄到熔斷器，熔斷期間消息留在隊列中
+    """
+
+    def __init__(self, bot: Bot, global_rate: float=25, chat_rate: float=1, chat_burst: float=3,
+                    concurrency: int=8, max_retries: int=3, breaker: CircuitBreaker=None) -> None:
+        self.bot: Bot = bot
+        self.breaker: CircuitBreaker = breaker if breaker != None else CircuitBreaker("Telegram")
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate: float = chat_rate
+        self.chat_burst: float = chat_burst
+        self.chat_buckets: dict[str, TokenBucket] = {}
+        self.slots = Semaphore(concurrency)
+        self.max_retries: int = max_retries             # NetworkError的重試次數
+
+        self.queue: list[OutboundRequest] = []          # 按(priority, seq)排序
+        self.pending_edits: dict[tuple[str, int], OutboundRequest] = {}
+        self.inflight_keys: set[tuple[str, int]] = set()
+        self.inflight: int = 0
+        self.tasks: set[Task] = set()                   # 事件循環只保留弱引用，發送中的task要自己持有
+        self.seq: int = 0
+        self.wakeup = Event()
+
+        # 統計
+        self.sent: int = 0
+        self.failed: int = 0
+        self.coalesced: int = 0
+        self.retry_after: int = 0
+        self.latencies: deque[float] = deque(maxlen=1024)
+        # bot api請求本身的耗時（不含排隊），按send/edit分開；出錯的請求按 (send/edit, 異常類型) 計數
+        self.request_latency: dict[str, Histogram] = {"send": Histogram(), "edit": Histogram()}
+        self.errors: dict[tuple[str, str], int] = {}
+
+    def getChatBucket(self, chat_id: str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket == None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def enqueue(self, request: OutboundRequest) -> None:
+        insort(self.queue, request)
+        if request.method == "edit":
+            self.pending_edits[request.key] = request
+        self.wakeup.set()
+
+    def sendMessage(self, chat_id: str, priority: int=PRIORITY_START, **kwargs) -> Future[Message]:
+
+        """
+            排隊發送新消息，返回的future在發送完成後得到Message
+        """
+
+        self.seq += 1
+        request = OutboundRequest(self.seq, priority, "send", chat_id, None, kwargs)
+        self.enqueue(request)
+        return request.futures[0]
+
+    def editMessageText(self, chat_id: str, message_id: int, priority: int=PRIORITY_EDIT, persistent: bool=False, **kwargs) -> Future[Message]:
+
+        """
+            排隊編輯消息，若同一消息已有尚未發出的編輯，則用新內容替換它並共用同一個future
+            persistent為True時遇到NetworkError一直重試，用於之後不會再有新的編輯來覆蓋的內容（比如標記直播結束）
+        """
+
+        pending = self.pending_edits.get((chat_id, message_id))
+        if pending != None:
+            pending.kwargs = kwargs
+            pending.persistent = pending.persistent or persistent
+            self.coalesced += 1
+            return pending.futures[0]
+
+        self.seq += 1
+        request = OutboundRequest(self.seq, priority, "edit", chat_id, message_id, kwargs)
+        request.persistent = persistent
+        self.enqueue(request)
+        return request.futures[0]
+
+    def pickRequest(self) -> tuple[OutboundRequest, float]:
+
+        """
+            取出下一個可以發送的請求，沒有時返回需要等待的秒數（None表示等待新請求）
+        """
+
+        if self.queue == []:
+            return (None, None)
+
+        # 熔斷中
+        breaker_delay = self.breaker.retryDelay()
+        if breaker_delay > 0:
+            return (None, breaker_delay)
+
+        now = monotonic()
+        global_delay = self.global_bucket.delay(now)
+        if global_delay > 0:
+            return (None, global_delay)
+
+        min_delay = None
+        for idx, request in enumerate(self.queue):
+            # 同一條消息的編輯不能同時進行
+            if request.method == "edit" and request.key in self.inflight_keys:
+                continue
+            bucket = self.getChatBucket(request.chat_id)
+            delay = bucket.delay(now)
+            if delay == 0:
+                if not self.breaker.allowRequest():
+                    return (None, self.breaker.retryDelay())
+                del self.queue[idx]
+                if request.method == "edit":
+                    del self.pending_edits[request.key]
+                    self.inflight_keys.add(request.key)
+                bucket.consume(now)
+                self.global_bucket.consume(now)
+                return (request, 0)
+            if min_delay == None or delay < min_delay:
+                min_delay = delay
+        return (None, min_delay)
+
+    async def execute(self, request: OutboundRequest) -> None:
+        self.inflight += 1
+        start = monotonic()
+        try:
+            try:
+                if request.method == "send":
+                    result = await self.bot.send_message(request.chat_id, **request.kwargs)
+                else:
+                    result = await self.bot.edit_message_text(chat_id=request.chat_id, message_id=request.message_id, **request.kwargs)
+            finally:
+                self.request_latency[request.method].observe(monotonic() - start)
+            self.breaker.recordSuccess()
+            self.sent += 1
+            self.latencies.append(monotonic() - request.enqueued_at)
+            request.setResult(result)
+        except telegram.error.RetryAfter as e:
+            self.countError(request, e)
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+            logger.warning(f"RetryAfter {retry_after}s for chat {request.chat_id}, requeue")
+            self.breaker.recordSuccess()
+            self.retry_after += 1
+            self.getChatBucket(request.chat_id).block(monotonic(), retry_after)
+            self.requeue(request)
+        except telegram.error.NetworkError as e:
+            self.countError(request, e)
+            if not isinstance(e, telegram.error.BadRequest):
+                self.breaker.recordFailure()
+            else:
+                # telegram有響應，說明連接本身沒有問題
+                self.breaker.recordSuccess()
+            if isinstance(e, telegram.error.BadRequest) or (request.retries >= self.max_retries and not request.persistent):
+                self.failed += 1
+                request.setException(e)
+            else:
+                request.retries += 1
+                limit = "" if request.persistent else f"/{self.max_retries}"
+                logger.warning(f"{type(e).__name__} when sending to chat {request.chat_id}, retry {request.retries}{limit}")
+                self.requeue(request)
+        except Exception as e:
+            self.countError(request, e)
+            self.breaker.recordSuccess()
+            self.failed += 1
+            request.setException(e)
+        finally:
+            self.inflight -= 1
+            if request.method == "edit":
+                self.inflight_keys.discard(request.key)
+            self.slots.release()
+            self.wakeup.set()
+
+    def countError(self, request: OutboundRequest, e: Exception) -> None:
+        key = (request.method, type(e).__name__)
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def requeue(self, request: OutboundRequest) -> None:
+
+        """
+            重新排隊，若排隊期間同一消息有了更新的編輯，則合併到新的請求中
+        """
+
+        if request.method == "edit":
+            newer = self.pending_edits.get(request.key)
+            if newer != None:
+                newer.futures.extend(request.futures)
+                newer.persistent = newer.persistent or request.persistent
+                self.coalesced += 1
+                return
+        self.enqueue(request)
+
+    async def run(self) -> NoReturn:
+
+        """
+            發送循環
+        """
+
+        await sleep(0)
+        while True:
+            request, delay = self.pickRequest()
+            if request == None:
+                self.wakeup.clear()
+                try:
+                    await wait_for(self.wakeup.wait(), delay)
+                except TimeoutError:
+                    pass
+                continue
+            await self.slots.acquire()
+            task = create_task(self.execute(request))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def getStats(self) -> dict:
+
+        """
+            隊列深度和發送延遲（從排隊到發送完成）的統計
+        """
+
+        latencies = sorted(self.latencies)
+        def percentile(p: float) -> float:
+            if latencies == []:
+                return 0
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return {
+            "queue_depth": len(self.queue),
+            "inflight": self.inflight,
+            "sent": self.sent,
+            "failed": self.failed,
+            "coalesced": self.coalesced,
+            "retry_after": self.retry_after,
+            "latency_p50": percentile(0.5),
+            "latency_p95": percentile(0.95),
+            "latency_max": latencies[-1] if latencies != [] else 0
+        }
@@ -1,27 +1,47 @@
 from datetime import datetime
+from .liveroom import RoomInfoSnapshot
+from .metrics import Histogram
 '''
                     Dummy LiveRoom Class
     測試用
 
-    get_room_info(): 
+    generateRoomInfo(): 
         先取當前時間，然後將其中的秒從0~59映射到0~29，然後根據秒數決定返回： 
         [0, 10): 未開播, 
         [10, 20): 直播中, 標題隨時間變動
         [20, 30): 直播中, 標題隨時間變動, 修改分區名稱 
 '''
 class LiveRoom():
-    def __init__(self) -> None:
+    def __init__(self, chunk_size: int=100, **kwargs) -> None:
+        self.chunk_size: int = chunk_size
+        self.rooms: dict[str, None] = {}
+        self.snapshot: RoomInfoSnapshot = RoomInfoSnapshot(0, {}, [], 0)
+        self.generation: int = 0
+        self.chunk_latency: Histogram = Histogram()
+        self.chunk_errors: dict[str, int] = {}
         self.start_time: float = 0
         self.last_sent_title: str = ""
         self.last_sent_area: tuple[str, str] = ("", "")
 
     def addRoom(self, room_id: str) -> None:
-        pass
+        self.rooms[room_id] = None
 
     def removeRoom(self, room_id: str) -> None:
-        pass
+        if room_id in self.rooms:
+            del self.rooms[room_id]
 
-    async def getRoomInfo(self, room_id: str) -> dict:
+    async def fetchSnapshot(self, room_ids: list[str]=None) -> RoomInfoSnapshot:
+        self.generation += 1
+        if room_ids == None:
+            room_ids = list(self.rooms.keys())
+        rooms = {room_id: self.generateRoomInfo(room_id) for room_id in room_ids if room_id in self.rooms}
+        self.snapshot = RoomInfoSnapshot(self.generation, rooms, [], 1 if rooms != {} else 0)
+        return self.snapshot
+
+    def getRoomInfo(self, room_id: str) -> dict:
+        return self.snapshot.getRoomInfo(room_id)
+
+    def generateRoomInfo(self, room_id: str) -> dict:
         second_now = datetime.now().second % 30
         if second_now >= 0 and second_now < 10:
             live_status = 0
@@ -45,6 +65,7 @@ class LiveRoom():
                 self.start_time = datetime.now().timestamp() - 10
 
         data = {
+            "valid": True,
             "room_info": {
                 "live_status": live_status,
                 "title": title,
@@ -66,4 +87,7 @@ class LiveRoom():
         return data
     
     async def getKeyFrameUrl(self, room_id: str) -> str:
-        return "https://pbs.twimg.com/media/GZmju6EaIAAT1C0?format=jpg&name=medium"
\ No newline at end of file
+        return "https://pbs.twimg.com/media/GZmju6EaIAAT1C0?format=jpg&name=medium"
+
+    async def fetchKeyFrameUrls(self, uids: list[str]) -> tuple[dict[str, str], list[Exception]]:
+        return ({uid: "https://pbs.twimg.com/media/GZmju6EaIAAT1C0?format=jpg&name=medium" for uid in uids}, [])
\ No newline at end of file
@@ -25,11 +25,16 @@ def _get_json_value(key: str):
         _file_not_found = True
         return None
 
-def _get_config(key: str):
+_no_default = object()
+
+def _get_config(key: str, default=_no_default):
     env_key = "BILILIVENOTIBOT_" + key.upper()
     value = os.getenv(env_key)
     if value == None:
         value = _get_json_value(key)
+        if value is None and default is not _no_default:
+            print(f"Use default {key}: {default}")
+            return default
         assert value is not None, f"Error: {key} is not specified\n"
         print(f"Read {key} from json")
     else:
@@ -39,8 +44,11 @@ def _get_config(key: str):
 def getTGBotToken() -> str:
     return str(_get_config("tgbot_token"))
 
-def getTGChatID() -> str:
-    return str(_get_config("tg_chat_id"))
+def getTGChatIDs() -> list[str]:
+    lst = _get_config("tg_chat_id")
+    if not isinstance(lst, list):
+        return [i.strip() for i in str(lst).split(",")]
+    return [str(i) for i in lst]
 
 def getSubscribedRooms() -> list:
     lst = _get_config("subscribed_rooms")
@@ -53,3 +61,44 @@ def getTimezone() -> str:
 
 def getPollInterval() -> int:
     return int(_get_config("poll_interval"))
+
+def getFetchChunkSize() -> int:
+    return int(_get_config("fetch_chunk_size", 100))
+
+def getFetchConcurrency() -> int:
+    return int(_get_config("fetch_concurrency", 4))
+
+def getStateFile() -> str:
+    return str(_get_config("state_file", "bot_state.sqlite3"))
+
+def getKeyFramePrefetchInterval() -> float:
+    return float(_get_config("keyframe_prefetch_interval", 0))
+
+def getDigestWindow() -> float:
+    return float(_get_config("digest_window", 0))
+
+def getWebhookURL() -> str:
+    return str(_get_config("webhook_url", ""))
+
+def getWebhookListen() -> tuple[str, int]:
+    host, _, port = str(_get_config("webhook_listen", "0.0.0.0:8443")).rpartition(":")
+    return (host, int(port))
+
+def getWebhookSecret() -> str:
+    return str(_get_config("webhook_secret", ""))
+
+def getRecordDir() -> str:
+    return str(_get_config("record_dir", ""))
+
+def getLoopProfileThreshold() -> float:
+    return float(_get_config("loop_profile_threshold", 0))
+
+def getJsonDecoder() -> str:
+    return str(_get_config("json_decoder", "auto"))
+
+def getMetricsListen() -> tuple[str, int]:
+    value = str(_get_config("metrics_listen", ""))
+    if value == "":
+        return None
+    host, _, port = value.rpartition(":")
+    return (host, int(port))
@@ -0,0 +1,76 @@
+from __future__ import annotations
+from collections import OrderedDict
+from telegram import Message
+from typing import Awaitable, Callable
+import telegram.error
+import logging
+
+logger = logging.getLogger("FileIdCache")
+
+"""
+    fileidcache.py: 圖片url到telegram file_id的映射
+"""
+
+class FileIdCache():
+    """
+                    FileIdCache Class
+            同一個圖片url第一次發送後記下telegram返回的file_id，之後直接用file_id發送，
+            telegram不用再從bilibili的cdn下載一次
+            容量有限，按LRU淘汰
+    """
+
+    def __init__(self, capacity: int=1024) -> None:
+        self.capacity: int = capacity
+        self.file_ids: OrderedDict[str, str] = OrderedDict()       # url -> file_id
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self.invalidated: int = 0
+
+    def get(self, url: str) -> str:
+        file_id = self.file_ids.get(url)
+        if file_id != None:
+            self.file_ids.move_to_end(url)
+        return file_id
+
+    def put(self, url: str, file_id: str) -> None:
+        self.file_ids[url] = file_id
+        self.file_ids.move_to_end(url)
+        while len(self.file_ids) > self.capacity:
+            self.file_ids.popitem(last=False)
+            self.evictions += 1
+
+    async def sendPhoto(self, url: str, send: Callable[[str], Awaitable[Message]]) -> Message:
+
+        """
+            發送圖片，send接收photo參數（url或file_id）並完成實際的發送
+            file_id失效時刪除記錄，改用url重新發送一次
+        """
+
+        file_id = self.get(url)
+        if file_id != None:
+            try:
+                message = await send(file_id)
+                self.hits += 1
+                return message
+            except telegram.error.BadRequest as e:
+                logger.warning(f"Cached file_id of {url} rejected: {e}")
+                self.file_ids.pop(url, None)
+                self.invalidated += 1
+
+        self.misses += 1
+        message = await send(url)
+        if message.photo != ():
+            # 同一張圖有多個尺寸，取最大的
+            self.put(url, message.photo[-1].file_id)
+        return message
+
+    def getStats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidated": self.invalidated,
+            "size": len(self.file_ids)
+        }
@@ -0,0 +1,228 @@
+from __future__ import annotations
+from asyncio import CancelledError, StreamReader, StreamWriter, Task, TimeoutError, start_server, wait_for, gather, current_task, IncompleteReadError, LimitOverrunError
+from urllib.parse import urlsplit, parse_qs
+from typing import Awaitable, Callable
+import asyncio
+import json
+import logging
+
+logger = logging.getLogger("TinyHTTPServer")
+
+"""
+    httpserver.py: 基於asyncio stream的極簡HTTP/1.1 server
+    只用於本地的stub server等場景，不打算處理完整的HTTP語義
+"""
+
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+    502: "Bad Gateway",
+    503: "Service Unavailable",
+    504: "Gateway Timeout",
+}
+
+class HTTPRequest():
+    """
+        解析後的HTTP請求
+    """
+
+    def __init__(self, method: str, target: str, headers: dict[str, str], body: bytes) -> None:
+        split = urlsplit(target)
+        self.method: str = method
+        self.path: str = split.path
+        self.query: dict[str, list[str]] = parse_qs(split.query)
+        self.headers: dict[str, str] = headers      # key為小寫
+        self.body: bytes = body
+
+    def json(self):
+        return json.loads(self.body)
+
+class HTTPResponse():
+    """
+        handler返回的HTTP響應
+    """
+
+    def __init__(self, status: int=200, body: bytes | str=b"", content_type: str="application/json", headers: dict[str, str]=None) -> None:
+        self.status: int = status
+        self.body: bytes = body.encode() if isinstance(body, str) else body
+        self.content_type: str = content_type
+        self.headers: dict[str, str] = headers if headers != None else {}
+
+    @staticmethod
+    def fromJson(data, status: int=200) -> HTTPResponse:
+        return HTTPResponse(status, json.dumps(data, ensure_ascii=False))
+
+    def encode(self) -> bytes:
+        lines = [f"HTTP/1.1 {self.status} {STATUS_TEXT.get(self.status, 'Unknown')}",
+                 f"Content-Type: {self.content_type}",
+                 f"Content-Length: {len(self.body)}"]
+        for key, value in self.headers.items():
+            lines.append(f"{key}: {value}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode() + self.body
+
+class BadRequestException(Exception):
+    """
+        請求無法解析，回覆status之後關閉連接
+    """
+
+    def __init__(self, status: int, reason: str) -> None:
+        super().__init__(reason)
+        self.status: int = status
+
+Handler = Callable[[HTTPRequest], Awaitable[HTTPResponse]]
+
+class TinyHTTPServer():
+    """
+                    TinyHTTPServer Class
+            按path分發請求的極簡HTTP server，支持keep-alive
+            請求頭和請求體的讀取各有超時，慢速發送的連接會被關閉，不會一直佔著
+    """
+
+    MAX_BODY_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, host: str="127.0.0.1", port: int=0, max_body_size: int=MAX_BODY_SIZE,
+                    header_timeout: float=10, body_timeout: float=30) -> None:
+        self.host: str = host
+        self.port: int = port
+        self.max_body_size: int = max_body_size
+        self.header_timeout: float = header_timeout     # 也是keep-alive連接的空閒超時，單位：秒
+        self.body_timeout: float = body_timeout
+        self.routes: dict[str, Handler] = {}
+        self.prefix_routes: list[tuple[str, Handler]] = []
+        self.server: asyncio.Server = None
+        self.request_count: int = 0
+        self.connections: set[StreamWriter] = set()
+        self.tasks: set[Task] = set()               # 處理各個連接的task，stop時取消並等待結束
+
+    def addRoute(self, path: str, handler: Handler, prefix: bool=False) -> None:
+
+        """
+            添加路由，prefix為True時按前綴匹配
+        """
+
+        if prefix:
+            self.prefix_routes.append((path, handler))
+        else:
+            self.routes[path] = handler
+
+    def findHandler(self, path: str) -> Handler:
+        handler = self.routes.get(path)
+        if handler != None:
+            return handler
+        for prefix, handler in self.prefix_routes:
+            if path.startswith(prefix):
+                return handler
+        return None
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        self.server = await start_server(self.handleConnection, self.host, self.port)
+        # port為0時由系統分配
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"Listening on {self.url}")
+
+    async def stop(self) -> None:
+        if self.server != None:
+            self.server.close()
+            for writer in list(self.connections):
+                writer.close()
+            tasks = list(self.tasks)
+            for task in tasks:
+                task.cancel()
+            await gather(*tasks, return_exceptions=True)
+            await self.server.wait_closed()
+            self.server = None
+
+    async def readRequest(self, reader: StreamReader) -> HTTPRequest:
+
+        """
+            讀取一個請求，連接關閉或超時時返回None，請求無法解析時拋出BadRequestException
+        """
+
+        try:
+            head = await wait_for(reader.readuntil(b"\r\n\r\n"), self.header_timeout)
+        except (IncompleteReadError, LimitOverrunError, ConnectionError, TimeoutError):
+            return None
+
+        lines = head.decode("latin-1").split("\r\n")
+        request_line = lines[0].split(" ")
+        if len(request_line) != 3 or not request_line[2].startswith("HTTP/"):
+            raise BadRequestException(400, "malformed request line")
+        method, target, _ = request_line
+        headers = {}
+        for line in lines[1:]:
+            if line == "":
+                continue
+            key, separator, value = line.partition(":")
+            if separator == "":
+                raise BadRequestException(400, "malformed header")
+            headers[key.strip().lower()] = value.strip()
+
+        # 不支持chunked，帶Transfer-Encoding的請求無法確定請求體的長度
+        if "transfer-encoding" in headers:
+            raise BadRequestException(400, "transfer-encoding is not supported")
+        length = headers.get("content-length", "0")
+        if not length.isdecimal():
+            raise BadRequestException(400, "invalid content-length")
+        length = int(length)
+        if length > self.max_body_size:
+            raise BadRequestException(413, "payload too large")
+        try:
+            body = await wait_for(reader.readexactly(length), self.body_timeout) if length > 0 else b""
+        except TimeoutError:
+            return None
+        return HTTPRequest(method, target, headers, body)
+
+    async def handleConnection(self, reader: StreamReader, writer: StreamWriter) -> None:
+        task = current_task()
+        self.connections.add(writer)
+        self.tasks.add(task)
+        try:
+            while True:
+                try:
+                    request = await self.readRequest(reader)
+                except BadRequestException as e:
+                    logger.debug(f"Bad request from {writer.get_extra_info('peername')}: {e}")
+                    writer.write(HTTPResponse(e.status, str(e), "text/plain", {"Connection": "close"}).encode())
+                    await writer.drain()
+                    break
+                if request == None:
+                    break
+                self.request_count += 1
+
+                handler = self.findHandler(request.path)
+                if handler == None:
+                    response = HTTPResponse(404, b"not found", "text/plain")
+                else:
+                    try:
+                        response = await handler(request)
+                    except ConnectionError:
+                        # handler主動斷開連接
+                        raise
+                    except Exception as e:
+                        logger.warning(f"Handler of {request.path} raised {type(e).__name__}: {e}")
+                        response = HTTPResponse(500, b"internal error", "text/plain")
+
+                writer.write(response.encode())
+                await writer.drain()
+                if request.headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, IncompleteReadError):
+            pass
+        except CancelledError:
+            # 由stop取消，正常結束task，否則asyncio.streams的回調對已取消的task取exception時會打印traceback
+            pass
+        finally:
+            self.connections.discard(writer)
+            self.tasks.discard(task)
+            writer.close()
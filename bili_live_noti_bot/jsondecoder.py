@@ -0,0 +1,130 @@
+from __future__ import annotations
+from operator import itemgetter
+from typing import Any, Optional
+import json
+import logging
+
+logger = logging.getLogger("LiveRoom")
+
+# 可選的依賴，沒有安裝時使用標準庫的json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+"""
+    jsondecoder.py: 解析bilibili api的響應
+    直接從bytes解析，不先解碼成str；安裝了msgspec時按只包含用到字段的struct解析，其餘字段不會生成對象
+"""
+
+# 解析和狀態判斷用到的原始字段，也是快照中的指紋
+ROOM_FIELDS = ("live_status", "title", "cover", "parent_area_name", "area_name", "uname", "live_time", "uid")
+
+# api返回的一個直播間條目 -> 按ROOM_FIELDS排列的tuple
+extractRoomFields = itemgetter(*ROOM_FIELDS)
+
+class JsonDecoder():
+    """
+                    JsonDecoder Class
+            標準庫json，總是可用
+    """
+
+    name = "json"
+
+    def loads(self, content: bytes) -> Any:
+        return json.loads(content)
+
+    def decodeBaseInfo(self, content: bytes) -> tuple[Any, Any, dict[str, tuple]]:
+
+        """
+            解析getRoomBaseInfo的響應，返回 (code, message, room_id -> 字段)
+            code不為0時沒有直播間信息，返回None
+        """
+
+        document = self.loads(content)
+        code = document.get("code")
+        if code != 0:
+            return (code, document.get("message"), None)
+        return (code, document.get("message"), {room_id: extractRoomFields(info) for room_id, info in document["data"]["by_room_ids"].items()})
+
+class OrjsonDecoder(JsonDecoder):
+    """
+                    OrjsonDecoder Class
+            orjson，仍然生成完整的dict，只是解析更快
+    """
+
+    name = "orjson"
+
+    def loads(self, content: bytes) -> Any:
+        return orjson.loads(content)
+
+if msgspec != None:
+    # 字段的順序和ROOM_FIELDS一致，astuple之後就是指紋
+    class RoomBaseInfo(msgspec.Struct, gc=False):
+        live_status: int
+        title: str
+        cover: str
+        parent_area_name: str
+        area_name: str
+        uname: str
+        live_time: str
+        uid: int
+
+    class BaseInfoData(msgspec.Struct, gc=False):
+        by_room_ids: dict[str, RoomBaseInfo]
+
+    class BaseInfoResponse(msgspec.Struct, gc=False):
+        code: Optional[int] = None
+        message: Any = None
+        data: Optional[BaseInfoData] = None
+
+class MsgspecDecoder(JsonDecoder):
+    """
+                    MsgspecDecoder Class
+            msgspec，getRoomBaseInfo的響應按struct解析，只有用到的字段會生成對象
+            響應和struct對不上時（出錯的響應、字段類型變化），改用不帶類型的解析，結果和JsonDecoder一致
+    """
+
+    name = "msgspec"
+
+    def __init__(self) -> None:
+        self.decoder = msgspec.json.Decoder()
+        self.baseinfo_decoder = msgspec.json.Decoder(BaseInfoResponse)
+
+    def loads(self, content: bytes) -> Any:
+        return self.decoder.decode(content)
+
+    def decodeBaseInfo(self, content: bytes) -> tuple[Any, Any, dict[str, tuple]]:
+        try:
+            response = self.baseinfo_decoder.decode(content)
+        except msgspec.ValidationError:
+            return super().decodeBaseInfo(content)
+        if response.code != 0 or response.data == None:
+            return super().decodeBaseInfo(content)
+        astuple = msgspec.structs.astuple
+        return (response.code, response.message, {room_id: astuple(info) for room_id, info in response.data.by_room_ids.items()})
+
+DECODERS: dict[str, type[JsonDecoder]] = {"json": JsonDecoder}
+if orjson != None:
+    DECODERS["orjson"] = OrjsonDecoder
+if msgspec != None:
+    DECODERS["msgspec"] = MsgspecDecoder
+
+def getDecoder(name: str="auto") -> JsonDecoder:
+
+    """
+        name為auto時按msgspec、orjson、json的順序選擇已安裝的
+        指定的decoder沒有安裝時同樣自動選擇
+    """
+
+    if name != "auto" and name not in DECODERS:
+        logger.warning(f"JSON decoder {name} is not available, choose automatically")
+        name = "auto"
+    if name == "auto":
+        name = next(name for name in ("msgspec", "orjson", "json") if name in DECODERS)
+    return DECODERS[name]()
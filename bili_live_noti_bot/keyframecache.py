@@ -0,0 +1,76 @@
+from __future__ import annotations
+from asyncio import Task, create_task, shield
+from time import monotonic
+from typing import Awaitable, Callable
+
+"""
+    keyframecache.py: 關鍵幀鏈接的短時緩存
+"""
+
+class KeyFrameCache():
+    """
+                    KeyFrameCache Class
+            按uid緩存fetch的結果，ttl內的重複查詢直接返回緩存
+            同一個uid同時只有一個進行中的fetch，其餘調用者等待同一個結果（single-flight）
+            fetch返回 (url, message)，只緩存成功（message為None）的結果
+    """
+
+    def __init__(self, fetch: Callable[[str], Awaitable[tuple[str, str]]], ttl: float=30) -> None:
+        self.fetch: Callable[[str], Awaitable[tuple[str, str]]] = fetch
+        self.ttl: float = ttl
+        self.entries: dict[str, tuple[float, tuple[str, str]]] = {}     # uid -> (過期時間, 結果)
+        self.inflight: dict[str, Task] = {}
+
+        self.hits: int = 0
+        self.misses: int = 0
+        self.shared: int = 0            # 等待了其他調用者發起的fetch的次數
+
+    async def get(self, uid: str) -> tuple[str, str]:
+        entry = self.entries.get(uid)
+        if entry != None:
+            if entry[0] > monotonic():
+                self.hits += 1
+                return entry[1]
+            del self.entries[uid]
+
+        task = self.inflight.get(uid)
+        if task != None:
+            self.shared += 1
+        else:
+            self.misses += 1
+            task = create_task(self.fetchAndStore(uid))
+            self.inflight[uid] = task
+        # 某個調用者被取消（比如handler超時）時不影響其他調用者
+        return await shield(task)
+
+    async def fetchAndStore(self, uid: str) -> tuple[str, str]:
+        try:
+            result = await self.fetch(uid)
+            if result[1] == None:
+                self.entries[uid] = (monotonic() + self.ttl, result)
+            return result
+        finally:
+            del self.inflight[uid]
+
+    def put(self, uid: str, result: tuple[str, str], ttl: float=None) -> None:
+
+        """
+            寫入預取的結果，ttl為None時使用默認的ttl
+        """
+
+        self.entries[uid] = (monotonic() + (ttl if ttl != None else self.ttl), result)
+
+    def invalidate(self, uid: str) -> None:
+        self.entries.pop(uid, None)
+
+    def getStats(self) -> dict:
+        # 順便清理過期的記錄
+        now = monotonic()
+        for uid in [uid for uid, entry in self.entries.items() if entry[0] <= now]:
+            del self.entries[uid]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "shared": self.shared,
+            "size": len(self.entries)
+        }
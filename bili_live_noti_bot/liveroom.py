@@ -1,8 +1,13 @@
+from __future__ import annotations
 import httpx
-import json
 from datetime import datetime, timezone, timedelta
+from asyncio import Semaphore, gather
+from time import monotonic
+from types import MappingProxyType
 import logging
 
+from .metrics import Histogram
+from .jsondecoder import JsonDecoder, getDecoder
 
 logger = logging.getLogger("LiveRoom")
 
@@ -28,32 +33,38 @@ class LiveRoom():
             bilibili api implementation, maintain fetched info 
     """
 
-    def __init__(self) -> None:
-
-        # "room_id": (
-        #   cache_ready: bool,
-        #
-        #   {
-        #     "valid": bool
-        #     "room_info": {
-        #       "live_status": 0/1,
-        #       "title": title,
-        #       "cover": coverurl,
-        #       "parent_area_name": p_area,
-        #       "area_name": area,
-        #       "uid": 114514,
-        #       "live_start_time": 
-        #     },
-        #     "anchor_info": {
-        #       "base_info": {
-        #         "uname": "username"
-        #       }
-        #     }
-        #   }
-        #
-        # )
-        self.rooms: dict[str, tuple[bool, dict]] = {}
-        self.httpx_client: httpx.AsyncClient = httpx.AsyncClient()
+    def __init__(self, chunk_size: int=100, concurrency: int=4,
+                    baseinfo_api: str=BASEINFOAPI, keyframe_api: str=KEYFRAMEAPI, fingerprint: bool=True,
+                    transport: httpx.AsyncBaseTransport=None, decoder: str="auto") -> None:
+
+        # 訂閱列表，只記錄room_id（dict當作有序的set使用）
+        self.rooms: dict[str, None] = {}
+
+        # 最近一輪的查詢結果，見 `RoomInfoSnapshot`
+        self.snapshot: RoomInfoSnapshot = RoomInfoSnapshot(0, {}, [], 0)
+        self.generation: int = 0
+        self.batch_requests: int = 0        # 累計的批量查詢請求數
+        self.keyframe_requests: int = 0     # 累計的關鍵幀查詢請求數
+        self.chunk_latency: Histogram = Histogram()     # 每個分塊請求的耗時，包括失敗的請求
+        self.chunk_errors: dict[str, int] = {}          # 失敗的分塊，按異常類型計數
+        # transport用於錄製和回放流量，見 `cassette.py`
+        self.httpx_client: httpx.AsyncClient = httpx.AsyncClient(transport=transport)
+        # 響應的解析，見 `jsondecoder.py`
+        self.decoder: JsonDecoder = getDecoder(decoder)
+
+        # 批量查詢時每個請求包含的直播間數量，以及同時進行的請求數量上限
+        self.chunk_size: int = chunk_size
+        self.concurrency: int = concurrency
+
+        self.baseinfo_api: str = baseinfo_api
+        self.keyframe_api: str = keyframe_api
+
+        # 每個直播間上一次解析的原始字段和解析結果，原始字段沒變時直接沿用解析結果
+        # fingerprint為False時每次都重新解析，快照中也不帶指紋
+        self.fingerprint: bool = fingerprint
+        self.fingerprints: dict[str, tuple] = {}
+        self.parsed: dict[str, dict] = {}
+        self.parse_skipped: int = 0
 
     def addRoom(self, room_id: str) -> None:
 
@@ -61,7 +72,7 @@ class LiveRoom():
             add room to subscribe list, coz new api supports batch fetch
         """
 
-        self.rooms[room_id] = (False, {})
+        self.rooms[room_id] = None
 
     def removeRoom(self, room_id: str) -> None:
 
@@ -69,27 +80,96 @@ class LiveRoom():
             remove from subscribe list
         """
 
-        if self.rooms.get(room_id) != None:
+        if room_id in self.rooms:
             del self.rooms[room_id]
+        self.fingerprints.pop(room_id, None)
+        self.parsed.pop(room_id, None)
 
-    async def updateRoomInfo(self) -> None:
+    async def fetchSnapshot(self, room_ids: list[str]=None) -> RoomInfoSnapshot:
 
         """
             batch fetch room live status using api
+            每輪輪詢只調用一次：訂閱列表按chunk_size切分，各分塊併發請求（上限為concurrency），
+            結果合併為一個帶generation編號的只讀快照，失敗的分塊只會把自己的直播間標記為stale
+            room_ids為None時查詢整個訂閱列表，否則只查詢其中給出的直播間
         """
 
-        if len(self.rooms) == 0:
-            return
+        self.generation += 1
+        rooms: dict[str, dict] = {}
+        fingerprints: dict[str, tuple] = {}
+        batch_requests = self.batch_requests
+
+        if room_ids == None:
+            room_ids = list(self.rooms.keys())
+        else:
+            room_ids = [room_id for room_id in room_ids if room_id in self.rooms]
+        chunks = [room_ids[i:i + self.chunk_size] for i in range(0, len(room_ids), self.chunk_size)]
+        semaphore = Semaphore(self.concurrency)
+
+        results = await gather(*[self.fetchChunk(chunk, rooms, fingerprints, semaphore) for chunk in chunks])
+        errors = [e for e in results if e != None]
+        if errors != []:
+            logger.warning(f"fetchSnapshot: {len(errors)}/{len(chunks)} chunks failed")
+
+        self.snapshot = RoomInfoSnapshot(self.generation, rooms, errors, self.batch_requests - batch_requests,
+                                            fingerprints if self.fingerprint else None)
+        return self.snapshot
+
+    async def fetchChunk(self, room_ids: list[str], rooms: dict[str, dict], fingerprints: dict[str, tuple], semaphore: Semaphore) -> Exception:
+
+        """
+            查詢一個分塊並寫入rooms和fingerprints，出錯時返回異常而不是拋出
+        """
+
+        async with semaphore:
+            start = monotonic()
+            try:
+                results = await self.fetchBaseInfo(room_ids)
+            except Exception as e:
+                self.chunk_latency.observe(monotonic() - start)
+                self.chunk_errors[type(e).__name__] = self.chunk_errors.get(type(e).__name__, 0) + 1
+                for room_id in room_ids:
+                    rooms[room_id] = {"valid": True, "stale": True}
+                return e
+            self.chunk_latency.observe(monotonic() - start)
+
+        for room_id in room_ids:
+            # 解析出的字段本身就是指紋
+            fingerprint = results.get(room_id)
+            if fingerprint == None:
+                rooms[room_id] = {"valid": False}
+                logger.warning(f"{room_id} not found in server response")
+                continue
+
+            if not self.fingerprint:
+                rooms[room_id] = self.parseRoomInfo(room_id, fingerprint)
+                continue
+
+            fingerprints[room_id] = fingerprint
+            if self.fingerprints.get(room_id) == fingerprint:
+                rooms[room_id] = self.parsed[room_id]
+                self.parse_skipped += 1
+            else:
+                rooms[room_id] = self.parsed[room_id] = self.parseRoomInfo(room_id, fingerprint)
+                self.fingerprints[room_id] = fingerprint
+        return None
+
+    async def fetchBaseInfo(self, room_ids: list[str]) -> dict[str, tuple]:
+
+        """
+            請求一個分塊的直播間信息，返回by_room_ids字段中的各個直播間，每個直播間是按ROOM_FIELDS排列的tuple
+        """
 
         params = {
             "req_biz": "web_room_componet",
-            "room_ids": [int(i) for i in self.rooms.keys()]
+            "room_ids": [int(i) for i in room_ids]
         }
+        self.batch_requests += 1
 
         try:
-            response = await self.httpx_client.get(BASEINFOAPI, params=params, headers=HEADERS)
+            response = await self.httpx_client.get(self.baseinfo_api, params=params, headers=HEADERS)
             response.raise_for_status()
-            responseContent = json.loads(response.text)
+            code, message, rooms = self.decoder.decodeBaseInfo(response.content)
         except httpx.HTTPStatusError:
             raise HTTPStatusError(response.status_code)
         except (httpx.NetworkError, httpx.TimeoutException):
@@ -97,81 +177,115 @@ class LiveRoom():
         except Exception as e:
             raise NetworkError(e)
 
-        code = responseContent.get("code")
         if code == None:
             raise CodeFieldException("response data does not contain code field")
         elif code != 0:
-            logger.critical(f"updateRoomInfo: {code}: {responseContent.get('message')}")
-            raise CodeFieldException(code, responseContent.get("message"))
-        
-        results = responseContent["data"]["by_room_ids"]
-        
-        for room_id in self.rooms.keys():
+            logger.critical(f"fetchBaseInfo: {code}: {message}")
+            raise CodeFieldException(code, message)
 
-            info = results.get(room_id)
-            if info == None:
-                self.rooms[room_id] = (True, {"valid": False})
-                logger.warning(f"{room_id} not found in server response")
-                continue
+        return rooms
 
-            if info["live_time"] == "0000-00-00 00:00:00":
-                live_start_time = 0
-            else:
-                live_start_time = datetime.strptime(info["live_time"], "%Y-%m-%d %H:%M:%S") \
-                    .replace(tzinfo=timezone(timedelta(hours=8))) \
-                    .astimezone(timezone.utc) \
-                    .timestamp()
-            c = {
-                "valid": True,
-                "room_info": {
-                    "live_status": info["live_status"],
-                    "title": info["title"],
-                    "cover": info["cover"],
-                    "parent_area_name": info["parent_area_name"],
-                    "area_name": info["area_name"],
-                    "uid": info["uid"],
-                    "live_start_time": live_start_time
-                },
-                "anchor_info": {
-                    "base_info": {
-                        "uname": info["uname"]
-                    }
+    def parseRoomInfo(self, room_id: str, fields: tuple) -> dict:
+
+        """
+            把api返回的字段（按ROOM_FIELDS排列）整理成快照中的格式
+        """
+
+        live_status, title, cover, parent_area_name, area_name, uname, live_time, uid = fields
+        if live_time == "0000-00-00 00:00:00":
+            live_start_time = 0
+        else:
+            live_start_time = datetime.strptime(live_time, "%Y-%m-%d %H:%M:%S") \
+                .replace(tzinfo=timezone(timedelta(hours=8))) \
+                .astimezone(timezone.utc) \
+                .timestamp()
+        c = {
+            "valid": True,
+            "room_info": {
+                "live_status": live_status,
+                "title": title,
+                "cover": cover,
+                "parent_area_name": parent_area_name,
+                "area_name": area_name,
+                "uid": uid,
+                "live_start_time": live_start_time
+            },
+            "anchor_info": {
+                "base_info": {
+                    "uname": uname
                 }
             }
-            logger.info(f"Retrieved room info: room_id={room_id}, uname={info["uname"]}, is_living={info["live_status"]}, live_start_time={live_start_time}")
-            self.rooms[room_id] = (True, c)
+        }
+        logger.info(f"Retrieved room info: room_id={room_id}, uname={uname}, is_living={live_status}, live_start_time={live_start_time}")
+        return c
     
-    async def getRoomInfo(self, room_id: str) -> dict:
+    def getRoomInfo(self, room_id: str) -> dict:
         
         """
-            Interface exposed to other modules, return room info of given room_id from cache.
-            Each method invocation will clear its corresponding cache, if it encountered cache miss,
-            updateRoomInfo() will be invoked for a complete subscribe list info update
+            Interface exposed to other modules, return room info of given room_id from the latest snapshot.
+            不會觸發任何請求
         """
         
         if room_id not in self.rooms.keys():
             raise Exception("room_id does not appear in room_ids")
+        return self.snapshot.getRoomInfo(room_id)
         
-        if not self.rooms[room_id][0]:
-            await self.updateRoomInfo()
+    async def getKeyFrameUrl(self, uid: str) -> str:
 
-        if self.rooms[room_id][1]["valid"]:
-            result = self.rooms[room_id][1]
-            self.rooms[room_id] = (False, {})
-            return result
-        else:
+        data = await self.fetchStatusByUids([uid])
+        if data.get(uid) == None:
             raise RoomNotExistException()
-        
-    async def getKeyFrameUrl(self, uid: str) -> str:
+        else:
+            url = data[uid]["keyframe"]
+            if url != "":
+                logger.info(f"Retrieved key frame url of user {uid}: {url}")
+            else:
+                logger.info(f"Key frame url is empty string")
+            return url
+
+    async def fetchKeyFrameUrls(self, uids: list[str]) -> tuple[dict[str, str], list[Exception]]:
+
+        """
+            批量查詢多個主播的關鍵幀，和fetchSnapshot一樣按chunk_size分塊併發請求
+            返回 (uid -> url, 失敗的分塊的異常)，不存在的uid和失敗的分塊中的uid不會出現在結果中
+        """
+
+        chunks = [uids[i:i + self.chunk_size] for i in range(0, len(uids), self.chunk_size)]
+        semaphore = Semaphore(self.concurrency)
+
+        async def fetchChunk(chunk: list[str]) -> dict:
+            async with semaphore:
+                return await self.fetchStatusByUids(chunk)
+
+        results = await gather(*[fetchChunk(chunk) for chunk in chunks], return_exceptions=True)
+
+        urls: dict[str, str] = {}
+        errors: list[Exception] = []
+        for result in results:
+            if isinstance(result, Exception):
+                errors.append(result)
+                continue
+            for uid, info in result.items():
+                urls[uid] = info["keyframe"]
+        if errors != []:
+            logger.warning(f"fetchKeyFrameUrls: {len(errors)}/{len(chunks)} chunks failed")
+        return (urls, errors)
+
+    async def fetchStatusByUids(self, uids: list[str]) -> dict:
+
+        """
+            請求一個分塊的主播直播狀態，返回data字段（uid -> 狀態）
+        """
 
         params = {
-            "uids[]": [int(uid)]
+            "uids[]": [int(uid) for uid in uids]
         }
+        self.keyframe_requests += 1
 
         try:
-            response = await self.httpx_client.get(KEYFRAMEAPI, params=params, headers=HEADERS)
+            response = await self.httpx_client.get(self.keyframe_api, params=params, headers=HEADERS)
             response.raise_for_status()
-            responseContent = json.loads(response.text)
+            responseContent = self.decoder.loads(response.content)
         except httpx.HTTPStatusError:
             raise HTTPStatusError(response.status_code)
         except (httpx.NetworkError, httpx.TimeoutException):
@@ -183,22 +297,80 @@ class LiveRoom():
         if code == None:
             raise CodeFieldException("response data does not contain code field")
         elif code != 0:
-            logger.critical(f"getKeyFrameUrl: {code}: {responseContent.get('message')}")
+            logger.critical(f"fetchStatusByUids: {code}: {responseContent.get('message')}")
             raise CodeFieldException(code, responseContent.get("message"))
-        
-        if responseContent["data"].get(uid) == None:
-            raise RoomNotExistException()
+
+        # 沒有結果時data是空列表
+        data = responseContent.get("data")
+        if not isinstance(data, dict):
+            return {}
+        return data
+
+class RoomInfoSnapshot():
+    """
+        一輪批量查詢的結果，只讀
+        rooms: room_id -> {
+          "valid": bool
+          "stale": bool (所在分塊查詢失敗時存在)
+          "room_info": {
+            "live_status": 0/1,
+            "title": title,
+            "cover": coverurl,
+            "parent_area_name": p_area,
+            "area_name": area,
+            "uid": 114514,
+            "live_start_time": 
+          },
+          "anchor_info": {
+            "base_info": {
+              "uname": "username"
+            }
+          }
+        }
+    """
+
+    def __init__(self, generation: int, rooms: dict[str, dict], errors: list[Exception], batch_requests: int,
+                    fingerprints: dict[str, tuple]=None) -> None:
+        self.generation: int = generation                   # 第幾輪查詢
+        self.rooms: MappingProxyType[str, dict] = MappingProxyType(rooms)
+        # 查詢成功的直播間的原始字段指紋，為None時不支持按指紋跳過
+        self.fingerprints: MappingProxyType[str, tuple] = MappingProxyType(fingerprints) if fingerprints != None else None
+        self.errors: tuple[Exception] = tuple(errors)       # 失敗分塊的異常
+        self.batch_requests: int = batch_requests           # 這一輪實際發出的批量查詢請求數，正常情況下每個分塊一個
+
+    def isStale(self, room_id: str) -> bool:
+
+        """
+            直播間不在快照中（本輪查詢後才加入訂閱），或所在分塊查詢失敗，即本輪實際上沒有查詢到
+        """
+
+        info = self.rooms.get(room_id)
+        return info == None or info.get("stale", False)
+
+    def getRoomInfo(self, room_id: str) -> dict:
+
+        """
+            返回快照中的直播間信息
+            isStale時拋出RoomInfoStaleException
+        """
+
+        if self.isStale(room_id):
+            raise RoomInfoStaleException()
+        info = self.rooms[room_id]
+        if info["valid"]:
+            return info
         else:
-            url = responseContent["data"][uid]["keyframe"]
-            if url != "":
-                logger.info(f"Retrieved key frame url of user {uid}: {url}")
-            else:
-                logger.info(f"Key frame url is empty string")
-            return url
+            raise RoomNotExistException()
 
 class RoomNotExistException(Exception):
     pass
 
+class RoomInfoStaleException(Exception):
+    """
+        直播間在本輪的快照中沒有可用的信息
+    """
+    pass
+
 class CodeFieldException(Exception):
     """
         exception about `code` field in bilibili api response 
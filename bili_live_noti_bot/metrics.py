@@ -0,0 +1,149 @@
+from __future__ import annotations
+from bisect import bisect_left
+from typing import Callable, Union
+
+from .httpserver import HTTPRequest, HTTPResponse
+
+"""
+    metrics.py: 運行時統計，以及Prometheus格式的導出
+"""
+
+# 單位：秒，覆蓋從幾毫秒的命令到帶重試的網絡請求
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# 開播到提醒送達的延遲，包括輪詢間隔和合併提醒的等待
+LAG_BUCKETS = (1, 2, 5, 10, 15, 20, 30, 45, 60, 90, 120, 300, 600, 1800)
+
+class Histogram():
+    """
+                    Histogram Class
+            固定分桶的直方圖，內存佔用和記錄的數量無關
+            分位數按所在的桶的上界估計
+    """
+
+    def __init__(self, buckets: tuple[float, ...]=DEFAULT_BUCKETS) -> None:
+        self.buckets: tuple[float, ...] = buckets
+        self.counts: list[int] = [0] * (len(buckets) + 1)      # 最後一個桶是 +Inf
+        self.count: int = 0
+        self.sum: float = 0
+        self.max: float = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+
+        """
+            估計分位數，落在 +Inf 桶時返回記錄到的最大值
+        """
+
+        if self.count == 0:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count > 0:
+                if i == len(self.buckets):
+                    return self.max
+                return min(self.buckets[i], self.max)
+        return self.max
+
+    def mean(self) -> float:
+        return self.sum / self.count if self.count > 0 else 0
+
+# 帶label的指標返回 label值 -> 數值，只有一個label時label值可以直接用字串
+Sample = Union[float, Histogram, dict[Union[str, tuple[str, ...]], Union[float, Histogram]]]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+def escapeLabelValue(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def formatValue(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+class MetricsRegistry():
+    """
+                    MetricsRegistry Class
+            只在導出時讀取各個組件已有的統計：計數器是組件上的int，直方圖是組件持有的 `Histogram`
+            記錄的一方不經過registry，熱路徑上只有整數加法和分桶計數，不分配對象
+    """
+
+    def __init__(self, prefix: str="bilibot") -> None:
+        self.prefix: str = prefix
+        self.metrics: list[tuple[str, str, str, tuple[str, ...], Callable[[], Sample]]] = []     # (名稱, 類型, 說明, label, collect)
+
+    def add(self, kind: str, name: str, description: str, collect: Callable[[], Sample], labels: tuple[str, ...]=()) -> None:
+
+        """
+            註冊一個指標，kind為counter、gauge或histogram
+            collect在導出時調用，有labels時返回 label值 -> 數值（或Histogram）的dict
+        """
+
+        self.metrics.append((f"{self.prefix}_{name}", kind, description, labels, collect))
+
+    def counter(self, name: str, description: str, collect: Callable[[], Sample], labels: tuple[str, ...]=()) -> None:
+        self.add("counter", name, description, collect, labels)
+
+    def gauge(self, name: str, description: str, collect: Callable[[], Sample], labels: tuple[str, ...]=()) -> None:
+        self.add("gauge", name, description, collect, labels)
+
+    def histogram(self, name: str, description: str, collect: Callable[[], Sample], labels: tuple[str, ...]=()) -> None:
+        self.add("histogram", name, description, collect, labels)
+
+    @staticmethod
+    def formatLabels(names: tuple[str, ...], values: tuple[str, ...], extra: str="") -> str:
+        pairs = [f'{name}="{escapeLabelValue(value)}"' for name, value in zip(names, values)]
+        if extra != "":
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs != [] else ""
+
+    @staticmethod
+    def renderHistogram(lines: list[str], name: str, label_names: tuple[str, ...], label_values: tuple[str, ...], histogram: Histogram) -> None:
+        # 導出的桶是累計的
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+            cumulative += count
+            labels = MetricsRegistry.formatLabels(label_names, label_values, f'le="{formatValue(float(bound))}"')
+            lines.append(f"{name}_bucket{labels} {cumulative}")
+        labels = MetricsRegistry.formatLabels(label_names, label_values)
+        lines.append(f"{name}_sum{labels} {formatValue(histogram.sum)}")
+        lines.append(f"{name}_count{labels} {histogram.count}")
+
+    def render(self) -> str:
+
+        """
+            生成Prometheus的text exposition format
+        """
+
+        lines = []
+        for name, kind, description, labels, collect in self.metrics:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            sample = collect()
+            samples = sample.items() if labels != () else [((), sample)]
+            for label_values, value in samples:
+                if not isinstance(label_values, tuple):
+                    label_values = (label_values,)
+                if kind == "histogram":
+                    self.renderHistogram(lines, name, labels, label_values, value)
+                else:
+                    lines.append(f"{name}{self.formatLabels(labels, label_values)} {formatValue(value)}")
+        return "\n".join(lines) + "\n"
+
+    async def handleRequest(self, request: HTTPRequest) -> HTTPResponse:
+
+        """
+            `TinyHTTPServer` 的handler
+        """
+
+        if request.method != "GET":
+            return HTTPResponse(405, b"", "text/plain")
+        return HTTPResponse(200, self.render(), CONTENT_TYPE)
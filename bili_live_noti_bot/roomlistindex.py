@@ -0,0 +1,75 @@
+from __future__ import annotations
+from bisect import bisect_left, insort
+from typing import Callable
+
+from .roomrecord import RoomRecord
+
+"""
+    roomlistindex.py: /list 使用的直播間排序索引
+"""
+
+class RoomListIndex():
+    """
+                    RoomListIndex Class
+            按 /list 的顯示順序排好的直播間：直播中的在前（按開播時間從近到遠），
+            然後是未開播的（按上次結束時間從近到遠），沒有結束時間的和狀態未知的在最後
+            記錄提交時更新，/list 翻頁時只需要切出當前頁，不用每次排序和生成全部直播間
+    """
+
+    def __init__(self) -> None:
+        self.keys: list[tuple] = []                 # 排好序的 (分組, 時間, room_id)
+        self.room_keys: dict[str, tuple] = {}       # room_id -> 索引中的key
+
+    @staticmethod
+    def getSortKey(record: RoomRecord) -> tuple:
+        if record.is_living == True:
+            return (0, -record.start_time.timestamp() if record.start_time != None else 0, record.room_id)
+        if record.is_living == False and record.stop_time != None:
+            return (1, -record.stop_time.timestamp(), record.room_id)
+        if record.is_living == False:
+            return (2, 0, record.room_id)
+        return (3, 0, record.room_id)
+
+    def update(self, record: RoomRecord) -> None:
+        key = self.getSortKey(record)
+        old_key = self.room_keys.get(record.room_id)
+        if old_key == key:
+            return
+        if old_key != None:
+            del self.keys[bisect_left(self.keys, old_key)]
+        insort(self.keys, key)
+        self.room_keys[record.room_id] = key
+
+    def remove(self, room_id: str) -> None:
+        old_key = self.room_keys.pop(room_id, None)
+        if old_key != None:
+            del self.keys[bisect_left(self.keys, old_key)]
+
+    def countLiving(self) -> int:
+        return bisect_left(self.keys, (1,))
+
+    def getPage(self, page: int, page_size: int, living_only: bool=False, accept: Callable[[str], bool]=None) -> tuple[list[str], int]:
+
+        """
+            返回第page頁（從0開始）的room_id，以及符合條件的直播間總數
+            living_only時只取直播中的，它們排在最前面，不用逐個檢查
+            accept為None時直接切片；否則逐個檢查room_id，只有當前頁的直播間會被返回
+        """
+
+        end = self.countLiving() if living_only else len(self.keys)
+        if accept == None:
+            return [key[-1] for key in self.keys[page * page_size:min((page + 1) * page_size, end)]], end
+
+        room_ids = []
+        count = 0
+        for i in range(end):
+            room_id = self.keys[i][-1]
+            if not accept(room_id):
+                continue
+            if page * page_size <= count < (page + 1) * page_size:
+                room_ids.append(room_id)
+            count += 1
+        return room_ids, count
+
+    def __len__(self) -> int:
+        return len(self.keys)
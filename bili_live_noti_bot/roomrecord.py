@@ -1,25 +1,46 @@
 from __future__ import annotations
-from telegram import Message, constants
+from telegram import constants
 from telegram.helpers import escape_markdown
 from datetime import datetime
 from pytz import utc, BaseTzInfo
+from sys import intern
+from typing import Any, Callable
 import logging
 
 logger = logging.getLogger("RoomRecord")
 
+MAX_MESSAGE_LENGTH = 4096       # telegram消息的長度上限，按UTF-16計
+MAX_TITLE_HISTORY = 10          # 最多保留的歷史標題數量
+
+LIVING_MARK = escape_markdown("[🟢]", 2)
+NOT_LIVING_MARK = escape_markdown("[🟠]", 2)
+TITLE_ARROW = escape_markdown(" ⬅️ ", 2)
+LIVING_INFO = escape_markdown("[🟢]直播中：", 2)
+NOT_LIVING_INFO = escape_markdown("[🟠]未開播：", 2)
+
+def utf16Length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
 class RoomRecord():
     """
                     RoomRecord Class
             記錄從bilibili api獲取到的信息，以及生成發送的消息
+            訂閱數量很大時記錄會有很多，所以用__slots__，分區名稱用intern過的字串
+            生成消息用到的轉義、時間格式化的結果按字段緩存在fragments中，見 `getFragment`
     """
 
+    __slots__ = ("is_valid", "pending_fingerprint", "messages_sent", "is_living", "room_id", "uid", "uname",
+                 "current_room_title", "cover_url", "area_name_pair", "history_room_titles", "dropped_titles",
+                 "start_time", "stop_time", "undo", "fragments")
+
     def __init__(self, room_id: str) -> None:
 
         # bot-related
         self.is_valid: bool = True                  # 是否為有效直播間
+        self.pending_fingerprint: tuple = None      # 發送中的開播提醒對應的快照指紋
 
         # variables that associated with specific live
-        self.message_sent: Message = None           # 已經發送的通知消息，用於在直播結束時修改
+        self.messages_sent: dict[str, int] = {}     # chat_id -> 已經發送的通知消息的id，用於在直播結束時修改
 
         # variables that can be directly used
         self.is_living: bool = None                 # 是否在直播
@@ -31,13 +52,17 @@ class RoomRecord():
         self.area_name_pair: str = None             # 所在的分區
 
         # variables that need special care among each live
-        self.history_room_titles: list[str] = []    # 直播間用過的標題的列表，不含當前在用的，按時間從早到晚排序
+        self.history_room_titles: tuple[str, ...] = ()  # 直播間用過的標題，不含當前在用的，按時間從早到晚排序，只替換不修改
+        self.dropped_titles: int = 0                # 超出MAX_TITLE_HISTORY被丟棄的最早的標題數量
         self.start_time: datetime = None            # 開始直播的時間
         self.stop_time: datetime = None             # 上一次直播結束時間，只在未開播時有效
 
-        # snapshot
-        self.snapshot: dict = {}
-        
+        # 未提交的更新之前的字段值，見 `tryUpdateRecord`
+        self.undo: tuple = None
+
+        # 片段名稱 -> (生成時的字段值, 片段)，第一次生成消息時才創建
+        self.fragments: dict[str, tuple[tuple, Any]] = None
+
     def parseResult(self, result: dict) -> None:
 
         """
@@ -52,7 +77,7 @@ class RoomRecord():
         self.cover_url = result["room_info"]["cover"]
         parent_area_name = result["room_info"]["parent_area_name"]
         area_name = result["room_info"]["area_name"]
-        self.area_name_pair = f"{parent_area_name}-{area_name}"
+        self.area_name_pair = intern(f"{parent_area_name}-{area_name}")
 
     def hasUpdate(self, new_record: RoomRecord) -> bool:
 
@@ -82,8 +107,13 @@ class RoomRecord():
         self.is_living = new_record.is_living
 
         # room title && history title log
+        # 歷史標題只保留最近的MAX_TITLE_HISTORY個，更早的只計數
         if update_title_history and self.current_room_title != None and self.current_room_title != new_record.current_room_title:
-            self.history_room_titles.append(self.current_room_title)
+            history = self.history_room_titles + (self.current_room_title,)
+            if len(history) > MAX_TITLE_HISTORY:
+                self.dropped_titles += len(history) - MAX_TITLE_HISTORY
+                history = history[-MAX_TITLE_HISTORY:]
+            self.history_room_titles = history
         self.current_room_title = new_record.current_room_title
 
         if update_start_time:
@@ -98,46 +128,70 @@ class RoomRecord():
             commit update
         """
 
-        self.snapshot = {}
+        self.undo = None
 
     def takeSnapshot(self) -> None:
 
         """
             take a snapshot before update coz sendMessage may error
+            只記下舊字段值的引用：字串和datetime不可變，歷史標題是tuple，更新時整個替換，不需要複製
+        """
+
+        self.undo = (self.uid, self.uname, self.is_living, self.history_room_titles, self.dropped_titles, self.current_room_title,
+                     self.start_time, self.cover_url, self.area_name_pair)
+
+    def restoreSnapshot(self) -> None:
+
+        """
+            restore snapshot
         """
 
-        self.snapshot = {
-            "magic": "snapshot",
+        if self.undo != None:
+
+            logger.info(f"restore snapshot for uid {self.uid}")
+
+            (self.uid, self.uname, self.is_living, self.history_room_titles, self.dropped_titles, self.current_room_title,
+             self.start_time, self.cover_url, self.area_name_pair) = self.undo
+
+            self.undo = None
+
+    def dumpState(self) -> dict:
+
+        """
+            導出需要持久化的已提交狀態，可以json序列化
+        """
+
+        return {
+            "is_valid": self.is_valid,
+            "is_living": self.is_living,
             "uid": self.uid,
             "uname": self.uname,
-            "is_living": self.is_living,
-            "history_room_titles": self.history_room_titles.copy(),
             "current_room_title": self.current_room_title,
-            "start_time": self.start_time,
             "cover_url": self.cover_url,
-            "area_name_pair": self.area_name_pair
+            "area_name_pair": self.area_name_pair,
+            "history_room_titles": list(self.history_room_titles),
+            "dropped_titles": self.dropped_titles,
+            "start_time": self.start_time.timestamp() if self.start_time != None else None,
+            "stop_time": self.stop_time.timestamp() if self.stop_time != None else None
         }
 
-    def restoreSnapshot(self) -> None:
+    def loadState(self, state: dict) -> None:
 
         """
-            restore snapshot
+            從dumpState()導出的狀態恢復
         """
 
-        if self.snapshot.get("magic") == "snapshot":
-
-            logger.info(f"restore snapshot for uid {self.uid}")
-            
-            self.uid = self.snapshot["uid"]
-            self.uname = self.snapshot["uname"]
-            self.is_living = self.snapshot["is_living"]
-            self.history_room_titles = self.snapshot["history_room_titles"]
-            self.current_room_title = self.snapshot["current_room_title"]
-            self.start_time = self.snapshot["start_time"]
-            self.cover_url = self.snapshot["cover_url"]
-            self.area_name_pair = self.snapshot["area_name_pair"]
-
-            self.snapshot = {}
+        self.is_valid = state["is_valid"]
+        self.is_living = state["is_living"]
+        self.uid = state["uid"]
+        self.uname = state["uname"]
+        self.current_room_title = state["current_room_title"]
+        self.cover_url = state["cover_url"]
+        self.area_name_pair = intern(state["area_name_pair"]) if state["area_name_pair"] != None else None
+        self.history_room_titles = tuple(state["history_room_titles"])[-MAX_TITLE_HISTORY:]
+        self.dropped_titles = state.get("dropped_titles", 0) + len(state["history_room_titles"]) - len(self.history_room_titles)
+        self.start_time = datetime.fromtimestamp(state["start_time"], tz=utc) if state["start_time"] != None else None
+        self.stop_time = datetime.fromtimestamp(state["stop_time"], tz=utc) if state["stop_time"] != None else None
 
     def liveEnd(self) -> None:    # 清空狀態
 
@@ -145,50 +199,124 @@ class RoomRecord():
             直播結束，清空和一次直播關聯的條目
         """
 
-        self.history_room_titles.clear()
-        self.message_sent = None
+        self.history_room_titles = ()
+        self.dropped_titles = 0
+        self.messages_sent = {}
 
-    def generateMessageText(self, timezone: BaseTzInfo) -> str:
+    def getFragment(self, name: str, key: tuple, render: Callable[[], Any]) -> Any:
 
         """
-            生成發送的消息，包括點擊鏈接，markdown格式
+            取緩存的片段，key是生成片段用到的字段值，和緩存時不同才重新生成
+            字段被更新、回滾、從狀態恢復時都不用手動失效，只有變化了的字段對應的片段會重新生成
         """
 
-        # use provided live status
-        text = ""
-        if self.is_living:
-            text += "[🟢]"
-        else:
-            text += "[🟠]"
-        
-        # username
-        text += f"{self.uname}: "
+        if self.fragments == None:
+            self.fragments = {}
+        cached = self.fragments.get(name)
+        if cached != None and cached[0] == key:
+            return cached[1]
+        fragment = render()
+        self.fragments[name] = (key, fragment)
+        return fragment
 
-        # add current title
-        text += f"{self.current_room_title}"
-        # add title changing history
-        for title in reversed(self.history_room_titles):
-            text += f" ⬅️ {title}"
-        
-        text += "\n"
+    def formatTime(self, name: str, time: datetime, timezone: BaseTzInfo) -> str:
+        return self.getFragment(name, (time, timezone), lambda: f"{time.astimezone(timezone).strftime('%Y/%m/%d %H:%M:%S')} {timezone.zone}")
 
-        # add area
-        text += f"分區: {self.area_name_pair}"
+    def generateMessageText(self, timezone: BaseTzInfo, max_length: int=MAX_MESSAGE_LENGTH) -> str:
 
-        # add url
-        text = escape_markdown(text, 2)
-        text = f"[{text}](https://live.bilibili.com/{self.room_id})\n"
+        """
+            生成發送的消息，包括點擊鏈接，markdown格式
+            長度（轉義後）不超過max_length：放不下的歷史標題從最早的開始省略，換成 "+N"，
+            連當前標題都放不下時截斷當前標題
+            轉義是逐字符的，所以先分段轉義再按段取捨，不會截斷在轉義序列中間
+        """
+
+        # use provided live status, username
+        head = [LIVING_MARK if self.is_living else NOT_LIVING_MARK,
+                self.getFragment("uname", (self.uname,), lambda: escape_markdown(f"{self.uname}: ", 2))]
+        # add area, url
+        area = [self.getFragment("area", (self.area_name_pair,), lambda: escape_markdown(f"\n分區: {self.area_name_pair}", 2)),
+                f"](https://live.bilibili.com/{self.room_id})\n"]
 
         # add time-related
         if self.start_time != None:
-            text += f"開始時間： {self.start_time.astimezone(timezone).strftime('%Y/%m/%d %H:%M:%S')} {timezone.zone}\n"
+            area.append(f"開始時間： {self.formatTime('start_time', self.start_time, timezone)}\n")
 
         if self.stop_time != None and not self.is_living:
-            time_delta_str = str(self.stop_time - self.start_time).split(".")[0]
-            text += f"結束時間： {self.stop_time.astimezone(timezone).strftime('%Y/%m/%d %H:%M:%S')} {timezone.zone}\n"
-            text += f"持續時間： {time_delta_str}\n"
+            area.append(f"結束時間： {self.formatTime('stop_time', self.stop_time, timezone)}\n")
+            area.append(self.getFragment("duration", (self.start_time, self.stop_time),
+                                         lambda: f"持續時間： {str(self.stop_time - self.start_time).split('.')[0]}\n"))
+
+        # 先取歷史標題，這時title片段還是剛變成歷史標題的舊標題，可以直接復用
+        history = self.getFragment("history", (self.history_room_titles,), self.renderHistory)
+        title = self.getFragment("title", (self.current_room_title,), lambda: escape_markdown(f"{self.current_room_title}", 2))
+
+        # 通常放得下全部歷史標題
+        dropped = self.getFragment("dropped", (self.dropped_titles,),
+                                   lambda: escape_markdown(f" ⬅️ +{self.dropped_titles}", 2) if self.dropped_titles > 0 else "")
+        text = "".join(["[", *head, title, *history, dropped, *area])
+        if utf16Length(text) <= max_length:
+            return text
 
-        return text
+        budget = max_length - utf16Length("".join(["[", *head, *area]))
+
+        # 有歷史標題時，最壞情況下全部省略，當前標題後面還要放下 "+N"
+        marker_length = utf16Length(escape_markdown(f" ⬅️ +{len(history) + self.dropped_titles}", 2))
+        reserved = marker_length if len(history) + self.dropped_titles > 0 else 0
+
+        # add current title
+        if utf16Length(title) + reserved > budget:
+            title = self.truncateTitle(f"{self.current_room_title}", budget - reserved)
+        budget -= utf16Length(title)
+
+        # add title changing history，從最新的開始放，留出 "+N" 的位置
+        parts = []
+        omitted = self.dropped_titles
+        for i, part in enumerate(history):
+            remaining = len(history) - i - 1 + self.dropped_titles
+            if utf16Length(part) + (marker_length if remaining > 0 else 0) > budget:
+                omitted = remaining + 1
+                break
+            parts.append(part)
+            budget -= utf16Length(part)
+        if omitted > 0:
+            parts.append(escape_markdown(f" ⬅️ +{omitted}", 2))
+
+        return "".join(["[", *head, title, *parts, *area])
+
+    def renderHistory(self) -> tuple[str, ...]:
+
+        """
+            轉義後的歷史標題，從新到舊
+            標題變化時歷史標題只是多了一個、少了最早的，已經轉義過的標題從上一次的片段中取
+        """
+
+        escaped: dict[str, str] = {}
+        cached = self.fragments.get("history")
+        if cached != None:
+            escaped.update(zip(reversed(cached[0][0]), cached[1]))
+        cached = self.fragments.get("title")
+        if cached != None:
+            escaped[cached[0][0]] = TITLE_ARROW + cached[1]
+        return tuple(escaped[old_title] if old_title in escaped else TITLE_ARROW + escape_markdown(old_title, 2)
+                     for old_title in reversed(self.history_room_titles))
+
+    @staticmethod
+    def truncateTitle(title: str, budget: int) -> str:
+
+        """
+            截斷標題，使轉義並加上 "…" 之後的長度不超過budget
+        """
+
+        escaped = ""
+        length = utf16Length("…")
+        for char in title:
+            part = escape_markdown(char, 2)
+            if length + utf16Length(part) > budget:
+                break
+            escaped += part
+            length += utf16Length(part)
+        return escaped + "…"
     
     def generateInfoText(self, timezone: BaseTzInfo) -> str:
 
@@ -199,30 +327,27 @@ class RoomRecord():
         if not self.is_valid:
             return ""
 
-        text = ""
         if self.is_living != None:
-            if self.is_living:
-                text += "[🟢]直播中："
-            else:
-                text += "[🟠]未開播："
-            text = escape_markdown(text, 2)
-            text += f" `{escape_markdown(self.uname, 2, constants.MessageEntityType.CODE)}`\n"
-            
-            text += f"  ├ [直播間號： {self.room_id}](https://live.bilibili.com/{self.room_id})\n"
-            text += f"  ├ [個人空間： {self.uid}](space.bilibili.com/{self.uid})\n"   # so anyone wants to exploit sth here?
+            lines = [
+                LIVING_INFO if self.is_living else NOT_LIVING_INFO,
+                self.getFragment("uname_code", (self.uname,), lambda: f" `{escape_markdown(self.uname, 2, constants.MessageEntityType.CODE)}`\n"),
+                self.getFragment("links", (self.uid,), lambda: f"  ├ [直播間號： {self.room_id}](https://live.bilibili.com/{self.room_id})\n"
+                                                                f"  ├ [個人空間： {self.uid}](space.bilibili.com/{self.uid})\n")   # so anyone wants to exploit sth here?
+            ]
 
             if not self.is_living:
                 if self.stop_time != None:
-                    text +=  f"  ├ 上次直播結束時間： {self.stop_time.astimezone(timezone).strftime('%Y/%m/%d %H:%M:%S')} {timezone.zone}\n"
+                    lines.append(f"  ├ 上次直播結束時間： {self.formatTime('stop_time', self.stop_time, timezone)}\n")
                 else:
-                    text +=  f"  ├ 上次直播結束時間： 未記錄\n"
+                    lines.append(f"  ├ 上次直播結束時間： 未記錄\n")
 
-            text += f"  └ 當前直播間標題： `{escape_markdown(self.current_room_title, 2, constants.MessageEntityType.CODE)}`\n"
+            lines.append(self.getFragment("title_code", (self.current_room_title,),
+                                          lambda: f"  └ 當前直播間標題： `{escape_markdown(self.current_room_title, 2, constants.MessageEntityType.CODE)}`\n"))
 
         else:
-            text += "[❓]未知：\n"
-            text = escape_markdown(text, 2)
-            text += f"  └ [直播間號： {self.room_id}](https://live.bilibili.com/{self.room_id})\n"
-        
-        return text
+            lines = [
+                escape_markdown("[❓]未知：\n", 2),
+                f"  └ [直播間號： {self.room_id}](https://live.bilibili.com/{self.room_id})\n"
+            ]
 
+        return "".join(lines)
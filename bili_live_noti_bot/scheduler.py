@@ -0,0 +1,139 @@
+from __future__ import annotations
+from collections import deque
+from datetime import datetime
+from heapq import nsmallest
+from time import monotonic, time
+import logging
+
+from .roomrecord import RoomRecord
+
+logger = logging.getLogger("PollScheduler")
+
+"""
+    scheduler.py: 按直播間分級的輪詢調度
+"""
+
+HOT = "hot"         # 尚未查詢過、直播中，或當前時刻接近歷史開播時刻
+WARM = "warm"       # 最近有過直播
+COLD = "cold"       # 長時間沒有直播
+
+TIERS = [HOT, WARM, COLD]
+
+class PollScheduler():
+    """
+                    PollScheduler Class
+            每個直播間有自己的輪詢間隔：
+            hot: 基礎間隔的1/3，warm: 基礎間隔，cold: 基礎間隔的4倍
+            每次tick（間隔為hot的間隔）只查詢到期的直播間，
+            發出的請求如果還有空位，就用下一次tick之前到期的直播間填充，不額外增加請求數；
+            更晚到期的直播間不填充，否則只有一個直播間到期時每次tick都會查詢整個分塊，查詢的直播間數隨之成倍增加；
+            填充的直播間按原來的到期時間計算下一次查詢，週期不會因為提前查詢而縮短
+    """
+
+    HOT_WINDOW = 30 * 60                # 距離歷史開播時刻多近算作hot，單位：秒
+    COLD_AFTER = 7 * 24 * 60 * 60       # 多久沒有直播算作cold
+    HISTORY_SIZE = 8                    # 每個直播間記錄的開播時刻數量
+
+    def __init__(self, base_interval: float) -> None:
+        self.base_interval: float = base_interval
+        self.next_due: dict[str, float] = {}                    # room_id -> monotonic時間
+        self.tiers: dict[str, str] = {}
+        self.start_history: dict[str, deque[float]] = {}        # room_id -> 一天中的開播時刻（UTC，秒）
+
+    def getTierIntervals(self) -> dict[str, float]:
+        return {
+            HOT: max(1, self.base_interval / 3),
+            WARM: self.base_interval,
+            COLD: self.base_interval * 4
+        }
+
+    def tickInterval(self) -> float:
+        return self.getTierIntervals()[HOT]
+
+    def addRoom(self, room_id: str) -> None:
+        if room_id not in self.next_due:
+            self.next_due[room_id] = 0          # 新加入的直播間立即查詢
+            self.tiers[room_id] = HOT
+
+    def removeRoom(self, room_id: str) -> None:
+        self.next_due.pop(room_id, None)
+        self.tiers.pop(room_id, None)
+        self.start_history.pop(room_id, None)
+
+    def recordLiveStart(self, room_id: str, start_time: datetime) -> None:
+
+        """
+            記錄一次開播的時刻，用於預測之後的開播
+        """
+
+        if start_time == None or start_time.timestamp() <= 0:
+            return
+        history = self.start_history.setdefault(room_id, deque(maxlen=self.HISTORY_SIZE))
+        history.append(start_time.timestamp() % 86400)
+
+    def classify(self, record: RoomRecord, now: float) -> str:
+
+        """
+            根據記錄決定直播間的等級，now為unix時間戳
+        """
+
+        if record.is_living == None or record.is_living:
+            return HOT
+
+        time_of_day = now % 86400
+        for start in self.start_history.get(record.room_id, ()):
+            distance = abs(time_of_day - start)
+            if min(distance, 86400 - distance) <= self.HOT_WINDOW:
+                return HOT
+
+        last_active = None
+        if record.stop_time != None:
+            last_active = record.stop_time.timestamp()
+        elif record.start_time != None and record.start_time.timestamp() > 0:
+            last_active = record.start_time.timestamp()
+        if last_active != None and now - last_active > self.COLD_AFTER:
+            return COLD
+        return WARM
+
+    def reschedule(self, record: RoomRecord, fill_in: bool=False) -> None:
+
+        """
+            查詢完成後，按直播間的新等級安排下一次查詢
+            fill_in為True時直播間是提前填充進來的，下一次查詢從原來的到期時間算起
+        """
+
+        if record.room_id not in self.next_due:
+            return
+        tier = self.classify(record, time())
+        self.tiers[record.room_id] = tier
+        if fill_in:
+            self.next_due[record.room_id] += self.getTierIntervals()[tier]
+        else:
+            self.next_due[record.room_id] = monotonic() + self.getTierIntervals()[tier]
+
+    def selectRooms(self, chunk_size: int) -> tuple[list[str], list[str]]:
+
+        """
+            選出本次tick要查詢的直播間，返回 (到期的直播間, 填充的直播間)
+            到期的直播間決定發出多少個請求，最後一個請求的空位用下一次tick之前到期的直播間填充
+            沒有到期的直播間時返回兩個空列表，不發出請求
+        """
+
+        now = monotonic()
+        due = [room_id for room_id, next_due in self.next_due.items() if next_due <= now]
+        if due == []:
+            return ([], [])
+
+        fill_ins = []
+        capacity = -len(due) % chunk_size
+        if capacity > 0:
+            horizon = now + self.tickInterval()
+            not_due = [(next_due, room_id) for room_id, next_due in self.next_due.items() if now < next_due <= horizon]
+            fill_ins = [room_id for _, room_id in nsmallest(capacity, not_due)]
+        return (due, fill_ins)
+
+    def getTierCounts(self) -> dict[str, int]:
+        counts = {tier: 0 for tier in TIERS}
+        for tier in self.tiers.values():
+            counts[tier] += 1
+        return counts
@@ -0,0 +1,168 @@
+from __future__ import annotations
+from asyncio import to_thread, Lock
+import json
+import logging
+import sqlite3
+
+logger = logging.getLogger("StateStore")
+
+"""
+    statestore.py: 持久化直播間記錄、訂閱關係、已發送的消息和合併的開播提醒，重啟後恢復
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rooms (
+    room_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    room_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    PRIMARY KEY (room_id, chat_id)
+);
+CREATE TABLE IF NOT EXISTS subscriptions (
+    chat_id TEXT NOT NULL,
+    room_id TEXT NOT NULL,
+    PRIMARY KEY (chat_id, room_id)
+);
+CREATE TABLE IF NOT EXISTS digests (
+    chat_id TEXT NOT NULL,
+    message_id INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (chat_id, message_id)
+);
+"""
+
+class StateStore():
+    """
+                    StateStore Class
+            基於sqlite的狀態存儲
+            修改先記在內存裡，每輪輪詢結束時調用flush()在一個transaction中寫入
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.connection.commit()
+
+        # 待寫入的修改
+        self.dirty_rooms: dict[str, str] = {}                       # room_id -> state json
+        self.dirty_messages: dict[str, dict[str, int]] = {}         # room_id -> {chat_id: message_id}，整體替換
+        self.dirty_subscriptions: dict[tuple[str, str], bool] = {}  # (chat_id, room_id) -> 是否訂閱
+        self.dirty_digests: dict[tuple[str, int], str] = {}         # (chat_id, message_id) -> state json，None為刪除
+        self.deleted_rooms: set[str] = set()
+
+        self.flush_lock = Lock()
+
+    def load(self) -> tuple[dict[str, dict], dict[str, dict[str, int]], dict[str, set[str]], dict[tuple[str, int], dict]]:
+
+        """
+            啟動時一次性讀取全部記錄
+            返回 (room_id -> state, room_id -> {chat_id: message_id}, room_id -> {chat_id}, (chat_id, message_id) -> digest state)
+        """
+
+        rooms = {room_id: json.loads(state) for room_id, state in self.connection.execute("SELECT room_id, state FROM rooms")}
+        messages: dict[str, dict[str, int]] = {}
+        for room_id, chat_id, message_id in self.connection.execute("SELECT room_id, chat_id, message_id FROM messages"):
+            messages.setdefault(room_id, {})[chat_id] = message_id
+        subscriptions: dict[str, set[str]] = {}
+        for chat_id, room_id in self.connection.execute("SELECT chat_id, room_id FROM subscriptions"):
+            subscriptions.setdefault(room_id, set()).add(chat_id)
+        digests = {(chat_id, message_id): json.loads(state)
+                    for chat_id, message_id, state in self.connection.execute("SELECT chat_id, message_id, state FROM digests")}
+        logger.info(f"Loaded {len(rooms)} rooms, {sum(len(m) for m in messages.values())} messages, "
+                    f"{sum(len(s) for s in subscriptions.values())} subscriptions and {len(digests)} digests from {self.path}")
+        return (rooms, messages, subscriptions, digests)
+
+    def saveRoom(self, room_id: str, state: dict) -> None:
+        self.deleted_rooms.discard(room_id)
+        self.dirty_rooms[room_id] = json.dumps(state, ensure_ascii=False)
+
+    def saveMessages(self, room_id: str, messages: dict[str, int]) -> None:
+
+        """
+            記錄直播間在各個chat發送的消息，替換之前的記錄
+        """
+
+        self.dirty_messages[room_id] = messages.copy()
+
+    def saveSubscription(self, chat_id: str, room_id: str, subscribed: bool) -> None:
+        self.dirty_subscriptions[(chat_id, room_id)] = subscribed
+
+    def saveDigest(self, chat_id: str, message_id: int, state: dict) -> None:
+
+        """
+            記錄合併的開播提醒，state為None時刪除
+        """
+
+        self.dirty_digests[(chat_id, message_id)] = json.dumps(state, ensure_ascii=False) if state != None else None
+
+    def deleteRoom(self, room_id: str) -> None:
+        self.dirty_rooms.pop(room_id, None)
+        self.dirty_messages.pop(room_id, None)
+        for key in [key for key in self.dirty_subscriptions.keys() if key[1] == room_id]:
+            del self.dirty_subscriptions[key]
+        self.deleted_rooms.add(room_id)
+
+    def hasPendingChanges(self) -> bool:
+        return (self.dirty_rooms != {} or self.dirty_messages != {} or self.dirty_subscriptions != {}
+                or self.dirty_digests != {} or self.deleted_rooms != set())
+
+    def writeChanges(self, rooms: dict[str, str], messages: dict[str, dict[str, int]],
+                        subscriptions: dict[tuple[str, str], bool], digests: dict[tuple[str, int], str], deleted: set[str]) -> None:
+        with self.connection:
+            for table in ["rooms", "messages", "subscriptions"]:
+                self.connection.executemany(f"DELETE FROM {table} WHERE room_id = ?", [(room_id,) for room_id in deleted])
+            self.connection.executemany("INSERT OR REPLACE INTO rooms (room_id, state) VALUES (?, ?)", rooms.items())
+            self.connection.executemany("DELETE FROM messages WHERE room_id = ?", [(room_id,) for room_id in messages.keys()])
+            self.connection.executemany("INSERT INTO messages (room_id, chat_id, message_id) VALUES (?, ?, ?)",
+                                        [(room_id, chat_id, message_id) for room_id, m in messages.items() for chat_id, message_id in m.items()])
+            self.connection.executemany("INSERT OR IGNORE INTO subscriptions (chat_id, room_id) VALUES (?, ?)",
+                                        [key for key, subscribed in subscriptions.items() if subscribed])
+            self.connection.executemany("DELETE FROM subscriptions WHERE chat_id = ? AND room_id = ?",
+                                        [key for key, subscribed in subscriptions.items() if not subscribed])
+            self.connection.executemany("INSERT OR REPLACE INTO digests (chat_id, message_id, state) VALUES (?, ?, ?)",
+                                        [(*key, state) for key, state in digests.items() if state != None])
+            self.connection.executemany("DELETE FROM digests WHERE chat_id = ? AND message_id = ?",
+                                        [key for key, state in digests.items() if state == None])
+
+    def restoreChanges(self, rooms: dict[str, str], messages: dict[str, dict[str, int]],
+                        subscriptions: dict[tuple[str, str], bool], digests: dict[tuple[str, int], str], deleted: set[str]) -> None:
+
+        """
+            把寫入失敗的一批修改合併回待寫入的修改，寫入期間產生的新修改優先
+            寫入時先刪除再插入，所以刪除的直播間可以直接合併，之後又被刪除的直播間則丟掉舊的修改
+        """
+
+        self.dirty_rooms = {room_id: state for room_id, state in rooms.items() if room_id not in self.deleted_rooms} | self.dirty_rooms
+        self.dirty_messages = {room_id: m for room_id, m in messages.items() if room_id not in self.deleted_rooms} | self.dirty_messages
+        self.dirty_subscriptions = {key: subscribed for key, subscribed in subscriptions.items()
+                                    if key[1] not in self.deleted_rooms} | self.dirty_subscriptions
+        self.dirty_digests = digests | self.dirty_digests
+        self.deleted_rooms = deleted | self.deleted_rooms
+
+    async def flush(self) -> None:
+
+        """
+            把累積的修改在一個transaction中寫入，在線程中執行以免阻塞event loop
+        """
+
+        async with self.flush_lock:
+            if not self.hasPendingChanges():
+                return
+            rooms, messages, subscriptions, digests, deleted = (self.dirty_rooms, self.dirty_messages, self.dirty_subscriptions,
+                                                                self.dirty_digests, self.deleted_rooms)
+            self.dirty_rooms, self.dirty_messages, self.dirty_subscriptions, self.dirty_digests, self.deleted_rooms = {}, {}, {}, {}, set()
+            try:
+                await to_thread(self.writeChanges, rooms, messages, subscriptions, digests, deleted)
+            except Exception as e:
+                # transaction已經回滾，這一批修改放回去，下次flush時重試
+                logger.error(f"Failed to write {self.path}, retry on next flush: {type(e).__name__}: {e}")
+                self.restoreChanges(rooms, messages, subscriptions, digests, deleted)
+                return
+            logger.info(f"Flushed {len(rooms)} rooms, {len(messages)} message sets, {len(subscriptions)} subscription changes, "
+                        f"{len(digests)} digests, {len(deleted)} deletions")
@@ -0,0 +1,313 @@
+from __future__ import annotations
+from asyncio import sleep
+from datetime import datetime, timezone, timedelta
+from time import time
+from typing import Callable
+from urllib.parse import parse_qs
+import random
+
+from .httpserver import TinyHTTPServer, HTTPRequest, HTTPResponse
+
+"""
+    stubserver.py: 本地的bilibili api和telegram bot api替身，用於benchmark
+    生成N個直播間的假數據，接口格式與 `liveroom.py` 中使用的api一致
+"""
+
+BASEINFOPATH = "/xlive/web-room/v1/index/getRoomBaseInfo"
+KEYFRAMEPATH = "/room/v1/Room/get_status_info_by_uids"
+
+class StubBilibiliServer():
+    """
+                    StubBilibiliServer Class
+            假的getRoomBaseInfo接口，room_id為1~num_rooms的直播間都存在
+            error_rate: 每個請求以此概率返回錯誤，error_kind為 "http"（HTTP 503）、"code"（code -500）或 "drop"（斷開連接）
+            開播狀態默認由room_id決定，transitionRooms可以讓直播間開播/下播
+    """
+
+    def __init__(self, num_rooms: int, live_ratio: float=0.1, latency: float=0,
+                    error_rate: float=0, error_kind: str="http", seed: int=0) -> None:
+        self.num_rooms: int = num_rooms
+        self.live_ratio: float = live_ratio
+        self.latency: float = latency               # 每個請求的附加延遲，單位：秒
+        self.error_rate: float = error_rate
+        self.error_kind: str = error_kind
+        self.random = random.Random(seed)
+        self.http = TinyHTTPServer()
+        self.http.addRoute(BASEINFOPATH, self.handleBaseInfo)
+        # 開播時間以server創建的時間為基準，同一直播間每次返回相同的開播時間
+        self.created_at: datetime = datetime.now(timezone(timedelta(hours=8)))
+        self.title_versions: dict[int, int] = {}        # room_id -> 標題修改次數
+        self.live_overrides: dict[int, datetime] = {}   # room_id -> transitionRooms後的開播時間，None為未開播
+        self.http.addRoute(KEYFRAMEPATH, self.handleKeyFrame)
+
+        # 統計
+        self.batch_requests: int = 0
+        self.keyframe_requests: int = 0
+        self.rooms_served: int = 0
+        self.errors_injected: int = 0
+
+    @property
+    def baseinfo_api(self) -> str:
+        return self.http.url + BASEINFOPATH
+
+    @property
+    def keyframe_api(self) -> str:
+        return self.http.url + KEYFRAMEPATH
+
+    async def start(self) -> None:
+        await self.http.start()
+
+    async def stop(self) -> None:
+        await self.http.stop()
+
+    def mutateRooms(self, count: int) -> list[int]:
+
+        """
+            隨機修改count個直播間的標題，返回被修改的room_id
+        """
+
+        room_ids = self.random.sample(range(1, self.num_rooms + 1), min(count, self.num_rooms))
+        for room_id in room_ids:
+            self.title_versions[room_id] = self.title_versions.get(room_id, 0) + 1
+        return room_ids
+
+    def isLiving(self, room_id: int) -> bool:
+        if room_id in self.live_overrides:
+            return self.live_overrides[room_id] != None
+        return (room_id * 2654435761 % 1000) < self.live_ratio * 1000
+
+    def transitionRooms(self, count: int) -> dict[int, bool]:
+
+        """
+            隨機切換count個直播間的開播狀態，返回 room_id -> 切換後是否在直播
+            新開播的直播間以當前時間為開播時間
+        """
+
+        now = datetime.now(timezone(timedelta(hours=8))).replace(microsecond=0)
+        transitions = {}
+        for room_id in self.random.sample(range(1, self.num_rooms + 1), min(count, self.num_rooms)):
+            is_living = not self.isLiving(room_id)
+            self.live_overrides[room_id] = now if is_living else None
+            transitions[room_id] = is_living
+        return transitions
+
+    def generateRoom(self, room_id: int) -> dict:
+
+        """
+            生成一個直播間的假數據，同一room_id總是生成相同的基本信息，標題只在mutateRooms後變化
+        """
+
+        is_living = self.isLiving(room_id)
+        if is_living:
+            live_time = self.live_overrides.get(room_id) or self.created_at - timedelta(minutes=room_id % 120)
+            live_time = live_time.strftime("%Y-%m-%d %H:%M:%S")
+        else:
+            live_time = "0000-00-00 00:00:00"
+        return {
+            "room_id": room_id,
+            "uid": room_id + 100000,
+            "area_id": room_id % 50,
+            "live_status": 1 if is_living else 0,
+            "live_url": f"https://live.bilibili.com/{room_id}",
+            "parent_area_id": room_id % 10,
+            "title": f"stub room {room_id} title v{self.title_versions.get(room_id, 0)}",
+            "parent_area_name": f"父分區{room_id % 10}",
+            "area_name": f"子分區{room_id % 50}",
+            "live_time": live_time,
+            "description": "",
+            "tags": "",
+            "attention": 0,
+            "online": 0,
+            "short_id": 0,
+            "uname": f"stub user {room_id}",
+            "cover": f"https://i0.hdslb.com/bfs/live/stub{room_id}.jpg",
+            "background": "",
+            "join_slide": 1,
+            "live_id": 0,
+            "live_id_str": "0"
+        }
+
+    async def handleBaseInfo(self, request: HTTPRequest) -> HTTPResponse:
+        if self.latency > 0:
+            await sleep(self.latency)
+
+        self.batch_requests += 1
+        if self.error_rate > 0 and self.random.random() < self.error_rate:
+            self.errors_injected += 1
+            return self.generateError()
+
+        by_room_ids = {}
+        for room_id in request.query.get("room_ids", []):
+            room_id = int(room_id)
+            if 0 < room_id <= self.num_rooms:
+                by_room_ids[str(room_id)] = self.generateRoom(room_id)
+        self.rooms_served += len(by_room_ids)
+
+        return HTTPResponse.fromJson({"code": 0, "message": "0", "ttl": 1, "data": {"by_uids": {}, "by_room_ids": by_room_ids}})
+
+    async def handleKeyFrame(self, request: HTTPRequest) -> HTTPResponse:
+        if self.latency > 0:
+            await sleep(self.latency)
+
+        self.keyframe_requests += 1
+        if self.error_rate > 0 and self.random.random() < self.error_rate:
+            self.errors_injected += 1
+            return self.generateError()
+
+        data = {}
+        for uid in request.query.get("uids[]", []):
+            room = self.generateRoom(int(uid) - 100000)
+            if 0 < room["room_id"] <= self.num_rooms:
+                data[uid] = {
+                    "uid": room["uid"],
+                    "room_id": room["room_id"],
+                    "live_status": room["live_status"],
+                    "title": room["title"],
+                    "keyframe": f"https://i0.hdslb.com/bfs/live-key-frame/stub{room['room_id']}.jpg" if room["live_status"] == 1 else ""
+                }
+        return HTTPResponse.fromJson({"code": 0, "msg": "success", "message": "success", "data": data if data != {} else []})
+
+    def generateError(self) -> HTTPResponse:
+        if self.error_kind == "code":
+            return HTTPResponse.fromJson({"code": -500, "message": "服务器错误", "ttl": 1})
+        if self.error_kind == "drop":
+            raise ConnectionResetError("injected connection drop")
+        return HTTPResponse(503, b"service unavailable", "text/plain")
+
+class StubTelegramServer():
+    """
+                    StubTelegramServer Class
+            假的telegram bot api，`Bot(token, base_url=stub.base_url)` 即可使用
+            photo為url時模擬telegram從cdn下載圖片，等待cdn_latency後分配新的file_id；
+            photo為file_id時直接返回，未知的file_id返回400
+            error_rate: 除getMe以外的請求以此概率返回502，bot端表現為NetworkError
+            observer不為None時，每個成功的調用都以 (method, params) 調用一次，用於統計通知延遲
+    """
+
+    def __init__(self, cdn_latency: float=0, api_latency: float=0, error_rate: float=0, seed: int=0) -> None:
+        self.cdn_latency: float = cdn_latency
+        self.api_latency: float = api_latency
+        self.error_rate: float = error_rate
+        self.random = random.Random(seed)
+        self.http = TinyHTTPServer()
+        self.http.addRoute("/bot", self.handleRequest, prefix=True)
+        self.methods = {
+            "getMe": self.getMe,
+            "sendPhoto": self.sendPhoto,
+            "sendMessage": self.sendMessage,
+            "editMessageText": self.editMessageText,
+            "answerCallbackQuery": self.returnTrue,
+            "setMyCommands": self.returnTrue,
+            "deleteWebhook": self.returnTrue,
+            "getUpdates": self.getUpdates,
+        }
+        self.observer: Callable[[str, dict], None] = None
+
+        self.message_id: int = 0
+        self.file_ids: set[str] = set()
+
+        # 統計
+        self.calls: dict[str, int] = {}
+        self.cdn_fetches: int = 0
+        self.errors_injected: int = 0
+
+    @property
+    def base_url(self) -> str:
+        return self.http.url + "/bot"
+
+    async def start(self) -> None:
+        await self.http.start()
+
+    async def stop(self) -> None:
+        await self.http.stop()
+
+    @staticmethod
+    def parseParams(request: HTTPRequest) -> dict:
+
+        """
+            bot api的參數可能是json或form，form中的非字串值是json編碼的
+        """
+
+        if request.headers.get("content-type", "").startswith("application/json"):
+            return request.json()
+        params = {}
+        for key, values in parse_qs(request.body.decode()).items():
+            params[key] = values[0]
+        return params
+
+    async def handleRequest(self, request: HTTPRequest) -> HTTPResponse:
+        # path: /bot<token>/<method>
+        method = request.path.rsplit("/", 1)[-1]
+        handler = self.methods.get(method)
+        if handler == None:
+            return HTTPResponse.fromJson({"ok": False, "error_code": 404, "description": "Not Found: method not found"}, 404)
+
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.api_latency > 0:
+            await sleep(self.api_latency)
+        if method != "getMe" and self.error_rate > 0 and self.random.random() < self.error_rate:
+            self.errors_injected += 1
+            return self.error(502, "Bad Gateway")
+
+        params = self.parseParams(request)
+        response = await handler(params)
+        if self.observer != None and response.status == 200:
+            self.observer(method, params)
+        return response
+
+    @staticmethod
+    def error(code: int, description: str) -> HTTPResponse:
+        return HTTPResponse.fromJson({"ok": False, "error_code": code, "description": description}, code)
+
+    def generateMessage(self, chat_id: str) -> dict:
+        self.message_id += 1
+        return {
+            "message_id": self.message_id,
+            "date": int(time()),
+            "chat": {"id": int(chat_id), "type": "private"}
+        }
+
+    async def returnTrue(self, params: dict) -> HTTPResponse:
+        return HTTPResponse.fromJson({"ok": True, "result": True})
+
+    async def getUpdates(self, params: dict) -> HTTPResponse:
+        # 沒有update，模擬long polling等待到超時
+        await sleep(min(float(params.get("timeout", 0)), 1))
+        return HTTPResponse.fromJson({"ok": True, "result": []})
+
+    async def sendMessage(self, params: dict) -> HTTPResponse:
+        message = self.generateMessage(params["chat_id"])
+        message["text"] = params.get("text", "")
+        return HTTPResponse.fromJson({"ok": True, "result": message})
+
+    async def editMessageText(self, params: dict) -> HTTPResponse:
+        message = {
+            "message_id": int(params["message_id"]),
+            "date": int(time()),
+            "chat": {"id": int(params["chat_id"]), "type": "private"},
+            "text": params.get("text", "")
+        }
+        return HTTPResponse.fromJson({"ok": True, "result": message})
+
+    async def getMe(self, params: dict) -> HTTPResponse:
+        return HTTPResponse.fromJson({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "stub", "username": "stub_bot"}})
+
+    async def sendPhoto(self, params: dict) -> HTTPResponse:
+        photo = params.get("photo", "")
+        if photo.startswith("http://") or photo.startswith("https://"):
+            if self.cdn_latency > 0:
+                await sleep(self.cdn_latency)
+            self.cdn_fetches += 1
+            file_id = f"stubfile{len(self.file_ids)}"
+            self.file_ids.add(file_id)
+        elif photo in self.file_ids:
+            file_id = photo
+        else:
+            return self.error(400, "Bad Request: wrong file identifier/HTTP URL specified")
+
+        message = self.generateMessage(params["chat_id"])
+        message["photo"] = [
+            {"file_id": file_id + "_s", "file_unique_id": file_id + "_s", "width": 320, "height": 180},
+            {"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 720}
+        ]
+        return HTTPResponse.fromJson({"ok": True, "result": message})
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+"""
+    subscriptionindex.py: chat和直播間之間的多對多訂閱關係
+"""
+
+class SubscriptionIndex():
+    """
+                    SubscriptionIndex Class
+            同時維護 直播間->訂閱者 和 訂閱者->直播間 兩個索引，
+            直播間的查詢和記錄只跟直播間本身有關，不隨訂閱者的數量增加
+    """
+
+    def __init__(self) -> None:
+        self.room_subscribers: dict[str, set[str]] = {}
+        self.chat_rooms: dict[str, set[str]] = {}
+
+    def subscribe(self, chat_id: str, room_id: str) -> bool:
+
+        """
+            添加訂閱，返回是否為新的訂閱關係
+        """
+
+        subscribers = self.room_subscribers.setdefault(room_id, set())
+        if chat_id in subscribers:
+            return False
+        subscribers.add(chat_id)
+        self.chat_rooms.setdefault(chat_id, set()).add(room_id)
+        return True
+
+    def unsubscribe(self, chat_id: str, room_id: str) -> bool:
+
+        """
+            取消訂閱，返回直播間是否已經沒有訂閱者
+        """
+
+        subscribers = self.room_subscribers.get(room_id)
+        if subscribers == None:
+            return True
+        subscribers.discard(chat_id)
+        rooms = self.chat_rooms.get(chat_id)
+        if rooms != None:
+            rooms.discard(room_id)
+            if rooms == set():
+                del self.chat_rooms[chat_id]
+        if subscribers == set():
+            del self.room_subscribers[room_id]
+            return True
+        return False
+
+    def removeRoom(self, room_id: str) -> set[str]:
+
+        """
+            刪除直播間的全部訂閱，返回原來的訂閱者
+        """
+
+        subscribers = self.room_subscribers.pop(room_id, set())
+        for chat_id in subscribers:
+            rooms = self.chat_rooms.get(chat_id)
+            if rooms != None:
+                rooms.discard(room_id)
+                if rooms == set():
+                    del self.chat_rooms[chat_id]
+        return subscribers
+
+    def getSubscribers(self, room_id: str) -> set[str]:
+        return self.room_subscribers.get(room_id, set())
+
+    def getRooms(self, chat_id: str) -> set[str]:
+        return self.chat_rooms.get(chat_id, set())
+
+    def isSubscribed(self, chat_id: str, room_id: str) -> bool:
+        return chat_id in self.room_subscribers.get(room_id, ())
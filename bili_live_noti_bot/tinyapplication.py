@@ -1,13 +1,17 @@
 from __future__ import annotations
 from telegram.ext import Updater
-from asyncio import Queue, sleep
+from asyncio import Queue, Semaphore, Task, create_task, sleep, wait_for
+from collections import deque
 from telegram import Bot, Message, MessageEntity, Update, BotCommand
+from time import monotonic
 from typing import NoReturn
 import telegram.error
 import logging
 import re
 import traceback
 
+from .metrics import Histogram
+
 from typing import TYPE_CHECKING
 if TYPE_CHECKING:
     from .bilibililivenotificationbot import BilibiliLiveNotificationBot
@@ -23,12 +27,27 @@ class TinyApplication():
             然後就自己寫了個簡單的，之類的？
     """
 
-    def __init__(self, tg_bot: Bot, owner) -> None:
-        self.update_queue: Queue = Queue()
+    def __init__(self, tg_bot: Bot, owner, webhook_url: str="", secret_token: str="",
+                    concurrency: int=8, max_pending: int=256, handler_timeout: float=60) -> None:
+        # 隊列有上限，滿了之後Updater/WebhookServer會等待，而不是無限堆積
+        self.update_queue: Queue = Queue(maxsize=max_pending)
         self.updater = Updater(tg_bot, self.update_queue)
         self.command_handlers: dict[str, CommandHandler] = {}
         self.owner: BilibiliLiveNotificationBot = owner
 
+        # webhook_url不為空時改用webhook接收update，update由WebhookServer放進update_queue
+        self.webhook_url: str = webhook_url
+        self.secret_token: str = secret_token
+
+        # 命令併發處理：全局併發上限，同一個chat的update按順序處理
+        self.handler_semaphore = Semaphore(concurrency)
+        self.pending_slots = Semaphore(max_pending)                 # 已經取出隊列、尚未處理完的update數量上限
+        self.chat_pending: dict[str, deque[Update]] = {}            # chat -> 等待處理的update
+        self.chat_tasks: set[Task] = set()
+        self.handler_timeout: float = handler_timeout
+        self.command_latency: dict[str, Histogram] = {}
+        self.timeouts: int = 0
+
     def addCommandHandlers(self, command_handlers: list[CommandHandler]) -> None:
 
         """
@@ -63,16 +82,18 @@ class TinyApplication():
         """
             處理接收到的bot update
             來源不是配置裡指定的chat_id會被忽略
-            我好像沒打算把bot放群裡面？
+            我好像沒打算把bot放群裡面？ 現在可以放了，群的chat_id也可以配置進去
         """
 
-        if update.message != None and update.message.chat_id == int(self.owner.chat_id):
+        chat_ids = self.owner.chat_ids
+        if update.message != None and str(update.message.chat_id) in chat_ids:
             logger.info(f"New message: text={update.message.text}")
             command, argument = self.parseCommand(update.message)
-        elif update.callback_query != None and update.callback_query.from_user.id == int(self.owner.chat_id):
+        elif update.callback_query != None and (str(update.callback_query.from_user.id) in chat_ids or
+                                                  (update.callback_query.message != None and str(update.callback_query.message.chat.id) in chat_ids)):
             logger.info(f"New message callback: {update.callback_query.data}")
-            # expected data: "cmd arg"
-            split = update.callback_query.data.split(" ")
+            # expected data: "cmd arg"，arg可以包含空格
+            split = update.callback_query.data.split(" ", 1)
             command = split[0]
             if len(split) > 1:
                 argument = split[1]
@@ -84,7 +105,30 @@ class TinyApplication():
         command_handler = self.command_handlers.get(command)
         if command_handler != None:
             logger.info(f"Run /{command} command handler")
-            await command_handler.handle(update, self, argument)
+            start = monotonic()
+            try:
+                await wait_for(command_handler.handle(update, self, argument), self.handler_timeout)
+            except TimeoutError:
+                self.timeouts += 1
+                logger.warning(f"/{command} command handler timed out after {self.handler_timeout}s")
+            finally:
+                self.command_latency.setdefault(command, Histogram()).observe(monotonic() - start)
+
+    @staticmethod
+    def getChatKey(update: Update) -> str:
+
+        """
+            update所屬的chat，同一個chat的update按順序處理
+        """
+
+        if update.effective_chat != None:
+            return str(update.effective_chat.id)
+        if update.effective_user != None:
+            return str(update.effective_user.id)
+        return ""
+
+    def getPendingCount(self) -> int:
+        return sum(len(pending) for pending in self.chat_pending.values()) + self.update_queue.qsize()
             
     async def start(self) -> NoReturn:
 
@@ -111,6 +155,81 @@ class TinyApplication():
                 logger.error(error_text)
                 exit(1)
 
+        if self.webhook_url != "":
+            await self.startWebhook()
+        else:
+            await self.startPolling()
+
+    async def processUpdates(self) -> NoReturn:
+
+        """
+            從update_queue取出update，按chat分組，每個chat一個task按順序處理
+            慢的命令（比如 /frame）只會阻塞同一個chat後面的update
+        """
+
+        while True:
+            await self.pending_slots.acquire()
+            update = await self.update_queue.get()
+            key = self.getChatKey(update)
+            pending = self.chat_pending.get(key)
+            if pending == None:
+                pending = self.chat_pending[key] = deque()
+                task = create_task(self.processChat(key, pending))
+                self.chat_tasks.add(task)
+                task.add_done_callback(self.chat_tasks.discard)
+            pending.append(update)
+
+    async def processChat(self, key: str, pending: deque[Update]) -> None:
+
+        """
+            按順序處理一個chat的update，處理完後退出
+        """
+
+        while len(pending) > 0:
+            update = pending.popleft()
+            try:
+                async with self.handler_semaphore:
+                    await self.handleUpdate(update)
+            except telegram.error.NetworkError as e:
+                logger.warning(f"NetworkError exception when handling update: {e}")
+            # 什麼情況
+            except Exception:
+                error_text = f"Unexpected error when handling update: {traceback.format_exc()}"
+                logger.error(error_text)
+                exit(1)
+            finally:
+                self.pending_slots.release()
+        del self.chat_pending[key]
+
+    async def startWebhook(self) -> NoReturn:
+
+        """
+            向telegram註冊webhook，然後處理WebhookServer收到的update
+        """
+
+        while True:
+            try:
+                await self.updater.bot.setWebhook(self.webhook_url, secret_token=self.secret_token if self.secret_token != "" else None,
+                                                    allowed_updates=[Update.MESSAGE, Update.CALLBACK_QUERY], drop_pending_updates=True)
+                break
+            except telegram.error.NetworkError:
+                logger.warning(f"NetworkError exception when setting webhook, will retry after 10s")
+                await sleep(10)
+            # 什麼情況
+            except Exception:
+                error_text = f"Unexpected error when setting webhook: {traceback.format_exc()}"
+                logger.error(error_text)
+                exit(1)
+
+        logger.info(f"Receive updates from webhook {self.webhook_url}")
+        await self.processUpdates()
+
+    async def startPolling(self) -> NoReturn:
+
+        """
+            long polling接收update，帶異常自動恢復
+        """
+
         while True:
             try:
                 if not self.updater._initialized:
@@ -118,9 +237,7 @@ class TinyApplication():
                 if not self.updater.running:
                     await self.updater.start_polling(drop_pending_updates=True)
                 logger.info("Start polling updates from telegram")
-                while True:
-                    update = await self.update_queue.get()
-                    await self.handleUpdate(update)
+                await self.processUpdates()
             except telegram.error.NetworkError:
                 logger.warning("NetworkError exception when polling updates, will shutdown and restart after 10s")
                 if self.updater.running:
@@ -0,0 +1,179 @@
+from __future__ import annotations
+from asyncio import sleep
+from collections import Counter
+from threading import Event, Lock, Thread, get_ident
+from time import monotonic
+from types import FrameType
+from typing import NoReturn
+import logging
+import os
+import sys
+
+from .metrics import Histogram
+
+logger = logging.getLogger("LoopWatchdog")
+
+"""
+    watchdog.py: 事件循環的卡頓檢測
+"""
+
+# 事件循環的延遲，正常情況下遠小於1ms
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+MAX_STACK_DEPTH = 32
+
+class LoopWatchdog():
+    """
+                    LoopWatchdog Class
+            整個bot共用一個事件循環，任何同步的耗時操作都會卡住所有功能
+            `run` 每interval秒醒來一次，醒來的時間比預期晚了多少就是事件循環的延遲
+            profile_threshold大於0時另外啟動一個採樣線程：延遲超過閾值時（事件循環還卡著）
+            每sample_interval秒抓一次事件循環所在線程的調用棧，卡頓結束後記錄日誌並累計到offenders
+    """
+
+    def __init__(self, interval: float=0.5, warn_threshold: float=1, profile_threshold: float=0, sample_interval: float=0.01) -> None:
+        self.interval: float = interval
+        self.warn_threshold: float = warn_threshold             # 沒有採樣時，延遲超過它就記錄日誌
+        self.profile_threshold: float = profile_threshold       # 為0時不採樣
+        self.sample_interval: float = sample_interval
+
+        self.lag: Histogram = Histogram(LAG_BUCKETS)
+        self.last_lag: float = 0
+        self.stalls: int = 0                                    # 延遲超過閾值的次數
+        self.next_wakeup: float = 0                             # 事件循環正常時 `run` 醒來的時間
+
+        # 採樣線程寫入，/stats 讀取
+        self.offenders: Counter[str] = Counter()                # 位置 -> 卡頓的秒數
+        self.worst_stall: tuple[float, str] = (0, "")           # (卡頓時長, 位置)
+        self.stats_lock = Lock()
+        self.loop_thread_id: int = None
+        self.sampler: Thread = None
+        self.stopped = Event()
+
+    async def run(self) -> NoReturn:
+
+        """
+            測量事件循環的延遲，需要在事件循環中運行
+        """
+
+        await sleep(0)
+        self.loop_thread_id = get_ident()
+        if self.profile_threshold > 0 and self.sampler == None:
+            self.sampler = Thread(target=self.sampleLoop, name="LoopWatchdog", daemon=True)
+            self.sampler.start()
+            logger.info(f"Sample stacks when the event loop is blocked for more than {self.profile_threshold}s")
+
+        try:
+            while True:
+                self.next_wakeup = monotonic() + self.interval
+                await sleep(self.interval)
+                self.last_lag = max(monotonic() - self.next_wakeup, 0)
+                self.lag.observe(self.last_lag)
+                if self.profile_threshold <= 0 and self.last_lag > self.warn_threshold:
+                    self.stalls += 1
+                    logger.warning(f"Event loop blocked for {self.last_lag:.3f}s")
+        finally:
+            self.stopped.set()
+
+    @staticmethod
+    def describeFrame(frame: FrameType, lineno: bool=True) -> str:
+        if lineno:
+            return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} {frame.f_code.co_name}"
+        return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+    @staticmethod
+    def locateFrame(frame: FrameType) -> str:
+
+        """
+            卡頓的位置：最內層的本項目函數，以及實際執行的最內層函數（比如json.loads裡面）
+            按函數而不是行號匯總，同一個函數裡的採樣不會分散開
+        """
+
+        innermost = LoopWatchdog.describeFrame(frame, False)
+        depth = 0
+        while frame != None and depth < MAX_STACK_DEPTH:
+            if frame.f_code.co_filename.startswith(PACKAGE_DIR):
+                own = LoopWatchdog.describeFrame(frame, False)
+                return own if own == innermost else f"{own} > {innermost}"
+            frame = frame.f_back
+            depth += 1
+        return innermost
+
+    @staticmethod
+    def formatStack(frame: FrameType) -> str:
+        lines = []
+        while frame != None and len(lines) < MAX_STACK_DEPTH:
+            lines.append("  " + LoopWatchdog.describeFrame(frame))
+            frame = frame.f_back
+        return "\n".join(reversed(lines))
+
+    def sampleLoop(self) -> None:
+
+        """
+            採樣線程：事件循環卡住時抓取調用棧，一次卡頓中的採樣合併後記錄
+            C函數（比如json.loads）執行期間不釋放GIL，採樣線程要等它返回才能醒來，醒來時看到的正是調用它的函數，
+            所以每次採樣按距離上一次採樣的時間加權，而不是按次數計算
+        """
+
+        stall_start = None
+        stall_time: Counter[str] = Counter()        # 位置 -> 秒數
+        stall_stack = ""
+        last_sample = monotonic()
+        while not self.stopped.wait(self.sample_interval):
+            now = monotonic()
+            if self.next_wakeup == 0 or now - self.next_wakeup < self.profile_threshold:
+                if stall_start != None:
+                    self.finishStall(now - stall_start, stall_time, stall_stack)
+                    stall_start = None
+                    stall_time = Counter()
+                last_sample = now
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+            # 事件循環已經回到select，卡頓其實已經結束，只是 `run` 還沒來得及醒來
+            if frame == None or (frame.f_code.co_name == "select" and frame.f_code.co_filename.endswith("selectors.py")):
+                last_sample = now
+                continue
+            if stall_start == None:
+                # 卡頓從next_wakeup開始，而不是第一次採樣時
+                stall_start = last_sample = self.next_wakeup
+                stall_stack = self.formatStack(frame)
+            stall_time[self.locateFrame(frame)] += now - last_sample
+            last_sample = now
+            del frame
+
+    def finishStall(self, duration: float, stall_time: Counter[str], stack: str) -> None:
+
+        """
+            一次卡頓結束，各個位置的耗時累計到offenders
+        """
+
+        location = stall_time.most_common(1)[0][0] if stall_time else "unknown"
+        with self.stats_lock:
+            self.stalls += 1
+            self.offenders.update(stall_time)
+            if duration > self.worst_stall[0]:
+                self.worst_stall = (duration, location)
+        logger.warning(f"Event loop blocked for {duration:.3f}s, mostly in {location} ({stall_time[location]:.3f}s), "
+                       f"stack of the first sample:\n{stack}")
+
+    def getStats(self, top: int=5) -> dict:
+
+        """
+            延遲的統計，以及卡頓時間最長的top個位置和它們大約佔用的秒數
+        """
+
+        with self.stats_lock:
+            offenders = self.offenders.most_common(top)
+            worst_stall = self.worst_stall
+            stalls = self.stalls
+        return {
+            "lag_p50": self.lag.quantile(0.5),
+            "lag_p95": self.lag.quantile(0.95),
+            "lag_max": self.lag.max,
+            "stalls": stalls,
+            "profiling": self.profile_threshold > 0,
+            "offenders": offenders,
+            "worst_stall": worst_stall
+        }
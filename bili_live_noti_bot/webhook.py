@@ -0,0 +1,75 @@
+from __future__ import annotations
+from hmac import compare_digest
+from json import JSONDecodeError
+from telegram import Update
+import logging
+
+from .httpserver import TinyHTTPServer, HTTPRequest, HTTPResponse
+
+from typing import TYPE_CHECKING
+if TYPE_CHECKING:
+    from .tinyapplication import TinyApplication
+
+logger = logging.getLogger("WebhookServer")
+
+"""
+    webhook.py: 接收telegram webhook推送的update
+"""
+
+SECRET_TOKEN_HEADER = "x-telegram-bot-api-secret-token"
+
+# 一個update的json通常只有幾KB
+MAX_UPDATE_SIZE = 256 * 1024
+
+class WebhookServer():
+    """
+                    WebhookServer Class
+            一個HTTP server可以服務多個bot，每個bot按path區分，各自有secret token
+            收到的update校驗後放進對應TinyApplication的update_queue，和long polling走同一條處理路徑
+    """
+
+    def __init__(self, host: str="0.0.0.0", port: int=8443) -> None:
+        self.server = TinyHTTPServer(host, port, max_body_size=MAX_UPDATE_SIZE)
+        self.applications: dict[str, TinyApplication] = {}
+        self.received: int = 0
+        self.rejected: int = 0
+
+    def addApplication(self, app: TinyApplication, path: str) -> None:
+
+        """
+            在path上接收app的update，app需要先設置secret_token
+        """
+
+        self.applications[path] = app
+        self.server.addRoute(path, self.handleRequest)
+        logger.info(f"Receive updates on {path}")
+
+    async def handleRequest(self, request: HTTPRequest) -> HTTPResponse:
+        app = self.applications.get(request.path)
+        if request.method != "POST":
+            return HTTPResponse(405, b"", "text/plain")
+        if app.secret_token != "" and not compare_digest(request.headers.get(SECRET_TOKEN_HEADER, ""), app.secret_token):
+            self.rejected += 1
+            logger.warning(f"Reject update on {request.path}: invalid secret token")
+            return HTTPResponse(403, b"", "text/plain")
+
+        try:
+            data = request.json()
+            # null、數組等也是合法的json，但de_json只接受dict，對null還會返回None
+            if not isinstance(data, dict):
+                raise TypeError(f"expected an object, got {type(data).__name__}")
+            update = Update.de_json(data, app.updater.bot)
+        except (JSONDecodeError, UnicodeDecodeError, TypeError, KeyError) as e:
+            self.rejected += 1
+            logger.warning(f"Reject update on {request.path}: {type(e).__name__}: {e}")
+            return HTTPResponse(400, b"", "text/plain")
+
+        self.received += 1
+        await app.update_queue.put(update)
+        return HTTPResponse(200, b"", "text/plain")
+
+    async def start(self) -> None:
+        await self.server.start()
+
+    async def stop(self) -> None:
+        await self.server.stop()